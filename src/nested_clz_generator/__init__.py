@@ -1,7 +1,20 @@
-from aqt import gui_hooks
+import sys
 
-from .basic2cloze import main
-from .compat import add_compat_aliases
+# Only register the add-on when Anki loads it; the maintenance scripts and the
+# nested-clz command import this package outside Anki.
+if "aqt" in sys.modules:
+    from aqt import gui_hooks
 
-gui_hooks.profile_did_open.append(add_compat_aliases)
-main()
+    from .basic2cloze import main
+    from .compat import add_compat_aliases
+    from .consts import ANKI_VERSION_TUPLE
+
+    gui_hooks.profile_did_open.append(add_compat_aliases)
+    main()
+
+    # CollectionOp, used by the bulk conversion and the maintenance runner, needs 2.1.45
+    if ANKI_VERSION_TUPLE >= (2, 1, 45):
+        from . import browser_conversion, maintenance_runner
+
+        browser_conversion.main()
+        maintenance_runner.main()
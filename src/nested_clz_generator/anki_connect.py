@@ -0,0 +1,479 @@
+"""
+AnkiConnect client shared by the maintenance scripts.
+
+All requests go through one requests.Session, so the TCP connection to
+localhost:8765 is kept alive between calls instead of being reopened for every
+note.  Connection errors and timeouts are retried a few times with
+exponential backoff, and the time spent in each action is counted so a run can
+report where it waited.
+
+fetch_batches() prefetches the next notesInfo batches on a background thread
+and NoteWriter can write batches behind the caller, so HTTP and the Python
+transforms overlap.  Both use bounded queues to keep memory flat on big decks.
+
+Both knobs that decide how hard Anki is pushed adapt AIMD-style (additive
+increase, multiplicative decrease) to what the client observes:
+  * the notesInfo batch size grows while requests stay under TARGET_LATENCY
+    and MAX_PAYLOAD_BYTES, and is halved when one goes over;
+  * the number of requests in flight grows by one after a fast request and is
+    halved after a slow one, never above MAX_IN_FLIGHT.
+Anki handles AnkiConnect requests on its GUI thread, so the bounds are what
+keep it responsive during long runs.
+
+This module must not import anki/aqt: the AnkiConnect scripts run outside Anki.
+"""
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+ANKI_CONNECT_URL = "http://localhost:8765"
+API_VERSION = 6
+
+# (connect, read) timeouts in seconds; notesInfo on big batches can be slow.
+DEFAULT_TIMEOUT = (3.05, 300)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5  # seconds, doubled after every failed attempt
+
+# Initial notesInfo batch size and the range the adaptive size stays in
+BATCH_SIZE = 50
+MIN_BATCH_SIZE = 5
+MAX_BATCH_SIZE = 500
+BATCH_SIZE_STEP = 10
+# A request slower than this, or moving more bytes, counts as "too big"
+TARGET_LATENCY = 0.5  # seconds
+MAX_PAYLOAD_BYTES = 8 * 1024 * 1024
+# Upper bound for concurrent requests (prefetch + background writes)
+MAX_IN_FLIGHT = 2
+# notesInfo batches fetched ahead of the one being processed (0 = no prefetch)
+PREFETCH_BATCHES = 2
+# flushed batches waiting to be written in the background (0 = write inline)
+WRITE_QUEUE_DEPTH = 2
+
+
+class AnkiConnectError(Exception):
+    pass
+
+
+class ActionStats:
+    __slots__ = ("calls", "seconds", "retries", "errors", "bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.retries = 0
+        self.errors = 0
+        self.bytes = 0
+
+
+class AdaptiveBatchSize:
+    """AIMD batch size: +step after a request within budget, halved otherwise."""
+
+    def __init__(
+        self,
+        initial: int = BATCH_SIZE,
+        minimum: int = MIN_BATCH_SIZE,
+        maximum: int = MAX_BATCH_SIZE,
+        step: int = BATCH_SIZE_STEP,
+        target_latency: float = TARGET_LATENCY,
+        max_payload_bytes: int = MAX_PAYLOAD_BYTES,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.target_latency = target_latency
+        self.max_payload_bytes = max_payload_bytes
+        self.size = max(minimum, min(maximum, initial))
+
+    def observe(self, seconds: float, payload_bytes: int):
+        if seconds > self.target_latency or payload_bytes > self.max_payload_bytes:
+            self.size = max(self.minimum, self.size // 2)
+        else:
+            self.size = min(self.maximum, self.size + self.step)
+
+
+class ConcurrencyGate:
+    """
+    Semaphore with an AIMD limit: starts at one request in flight, +1 after a
+    fast request, halved after a slow one, never above max_limit.
+    """
+
+    def __init__(self, max_limit: int = MAX_IN_FLIGHT):
+        self.max_limit = max(1, max_limit)
+        self.limit = 1
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def observe(self, slow: bool):
+        with self._cond:
+            if slow:
+                self.limit = max(1, self.limit // 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1)
+            self._cond.notify_all()
+
+
+class AnkiConnectClient:
+    def __init__(
+        self,
+        url: str = ANKI_CONNECT_URL,
+        timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        pool_size: int = 4,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        target_latency: float = TARGET_LATENCY,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # requests is only needed once a client talks to Anki; importing it
+        # here keeps --collection runs from loading it at all.
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.transient_errors = (requests.ConnectionError, requests.Timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats: Dict[str, ActionStats] = defaultdict(ActionStats)
+        # invoke() is called from the prefetch and writer threads too
+        self._stats_lock = threading.Lock()
+        self.target_latency = target_latency
+        self.gate = ConcurrencyGate(max_in_flight)
+        # (seconds, payload bytes) of the last request made by each thread
+        self._last = threading.local()
+
+    def invoke(self, action, **params):
+        payload = {"action": action, "version": API_VERSION, "params": params}
+        delay = self.backoff
+
+        for attempt in range(self.retries + 1):
+            try:
+                with self.gate:
+                    # Waiting for the gate is not Anki's latency
+                    start = time.perf_counter()
+                    response = self.session.post(
+                        self.url, json=payload, timeout=self.timeout
+                    )
+                response.raise_for_status()
+                resp = response.json()
+            except self.transient_errors:
+                last_attempt = attempt == self.retries
+                self.gate.observe(slow=True)
+                self._record(action, time.perf_counter() - start, retry=not last_attempt,
+                             error=last_attempt)
+                if last_attempt:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+                continue
+
+            seconds = time.perf_counter() - start
+            payload_bytes = len(response.request.body or b"") + len(response.content)
+            self._last.exchange = (seconds, payload_bytes)
+            self.gate.observe(slow=seconds > self.target_latency)
+
+            error = resp.get("error")
+            self._record(action, seconds, call=True, error=bool(error),
+                         payload_bytes=payload_bytes)
+            if error:
+                raise AnkiConnectError(f"AnkiConnect error: {error}")
+            return resp["result"]
+
+    def last_exchange(self) -> Tuple[float, int]:
+        """(seconds, request + response bytes) of this thread's last request."""
+        return getattr(self._last, "exchange", (0.0, 0))
+
+    def _record(
+        self, action, seconds, call=False, retry=False, error=False, payload_bytes=0
+    ):
+        with self._stats_lock:
+            stats = self.stats[action]
+            stats.bytes += payload_bytes
+            stats.seconds += seconds
+            stats.calls += call
+            stats.retries += retry
+            stats.errors += error
+
+    def format_stats(self) -> str:
+        lines = ["AnkiConnect latency:"]
+        for action, stats in sorted(self.stats.items()):
+            avg_ms = 1000 * stats.seconds / stats.calls if stats.calls else 0.0
+            lines.append(
+                f"  {action:<20} {stats.calls:>6} calls  {stats.seconds:8.2f}s total"
+                f"  {avg_ms:8.1f}ms avg  {stats.bytes / 1e6:8.2f}MB"
+                f"  {stats.retries} retries  {stats.errors} errors"
+            )
+        return "\n".join(lines)
+
+    def close(self):
+        self.session.close()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Blocking put that gives up once `stop` is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _chunks(note_ids: Sequence[int], sizer: Optional[AdaptiveBatchSize], batch_size: int):
+    position = 0
+    while position < len(note_ids):
+        size = sizer.size if sizer is not None else batch_size
+        yield note_ids[position : position + size]
+        position += size
+
+
+def fetch_batches(
+    note_ids: Sequence[int],
+    batch_size: int = BATCH_SIZE,
+    prefetch: int = PREFETCH_BATCHES,
+    client: Optional[AnkiConnectClient] = None,
+    adaptive: bool = True,
+) -> Iterator[list]:
+    """
+    Yield notesInfo results for note_ids in order (notes that no longer exist
+    are left out), starting with batch_size
+    notes per request.  With adaptive=True the size then follows
+    AdaptiveBatchSize; otherwise it stays fixed.
+
+    With prefetch > 0 a background thread keeps up to `prefetch` batches
+    ready while the caller processes the current one.
+    """
+    client = client or get_client()
+    sizer = AdaptiveBatchSize(initial=batch_size) if adaptive else None
+
+    def fetch(chunk):
+        notes_info = client.invoke("notesInfo", notes=chunk)
+        if sizer is not None:
+            sizer.observe(*client.last_exchange())
+        # notesInfo answers {} for notes deleted since findNotes
+        return [note_info for note_info in notes_info if note_info]
+
+    chunks = _chunks(note_ids, sizer, batch_size)
+
+    if prefetch <= 0:
+        for chunk in chunks:
+            yield fetch(chunk)
+        return
+
+    batches: queue.Queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not _put(batches, (fetch(chunk), None), stop):
+                    return
+        except BaseException as e:  # handed to the consumer below
+            _put(batches, (None, e), stop)
+            return
+        _put(batches, (None, None), stop)
+
+    producer = threading.Thread(target=produce, name="notesInfo-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            notes_info, error = batches.get()
+            if error is not None:
+                raise error
+            if notes_info is None:
+                return
+            yield notes_info
+    finally:
+        stop.set()
+        producer.join()
+
+
+class NoteWriter:
+    """
+    Collects updateNoteFields calls and sends them as a single `multi` request
+    on flush(), so a batch of notes costs one HTTP round-trip.
+
+    Errors reported for individual actions are mapped back to their note IDs
+    and kept in `failures`; the other notes of the batch are still written.
+    stream_failures() also hands each failure to a callback as soon as Anki
+    reports it, e.g. to write it to the change log.
+
+    With queue_depth > 0, flush() hands the batch to a background thread and
+    returns immediately (at most queue_depth batches wait); call close() at
+    the end to wait for the remaining writes before reading `written`,
+    `written_ids` and `failures`.
+
+    on_written, if given, is called with the note IDs of every batch Anki has
+    answered (written or rejected); it runs on the writer thread.
+    """
+
+    def __init__(
+        self,
+        client: Optional[AnkiConnectClient] = None,
+        queue_depth: int = 0,
+        on_written: Optional[Callable[[List[int]], None]] = None,
+    ):
+        self.client = client
+        self.on_written = on_written
+        self.pending: List[Tuple[int, Dict[str, str]]] = []
+        self.written = 0
+        self.written_ids: List[int] = []
+        self.failures: List[Tuple[int, str]] = []
+        self.on_failed: Optional[Callable[[int, str], None]] = None
+        # the writer thread reports failures while stream_failures() subscribes
+        self._failures_lock = threading.Lock()
+
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        if queue_depth > 0:
+            self._queue = queue.Queue(maxsize=queue_depth)
+            self._thread = threading.Thread(
+                target=self._drain, name="updateNoteFields-writer", daemon=True
+            )
+            self._thread.start()
+
+    def stream_failures(self, on_failed: Callable[[int, str], None]):
+        """
+        Call on_failed(note_id, error) for every failed update, starting with
+        the ones already in `failures`; later ones are reported on the writer
+        thread as each batch is answered.
+        """
+        with self._failures_lock:
+            for note_id, error in self.failures:
+                on_failed(note_id, error)
+            self.on_failed = on_failed
+
+    def update_fields(self, note_id: int, fields: Dict[str, str]):
+        self.pending.append((note_id, fields))
+
+    def flush(self) -> List[Tuple[int, str]]:
+        """
+        Send the pending updates; return the (note_id, error) pairs that failed.
+        In background mode the failures only show up in `failures` after close().
+        """
+        if not self.pending:
+            return []
+        pending, self.pending = self.pending, []
+
+        if self._queue is None:
+            return self._write(pending)
+
+        self._raise_background_error()
+        self._queue.put(pending)
+        return []
+
+    def close(self):
+        """Flush, then wait for all background writes to finish."""
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_background_error()
+
+    def _drain(self):
+        while True:
+            pending = self._queue.get()
+            if pending is None:
+                return
+            if self._error is not None:
+                continue  # keep draining so flush() never blocks
+            try:
+                self._write(pending)
+            except BaseException as e:
+                self._error = e
+
+    def _raise_background_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, pending: List[Tuple[int, Dict[str, str]]]) -> List[Tuple[int, str]]:
+        actions = [
+            {
+                "action": "updateNoteFields",
+                "version": API_VERSION,
+                "params": {"note": {"id": note_id, "fields": fields}},
+            }
+            for note_id, fields in pending
+        ]
+        client = self.client or get_client()
+        results = client.invoke("multi", actions=actions)
+
+        failed = []
+        for (note_id, _), result in zip(pending, results):
+            error = result.get("error") if isinstance(result, dict) else None
+            if error:
+                failed.append((note_id, str(error)))
+        self.written += len(pending) - len(failed)
+        failed_ids = {note_id for note_id, _ in failed}
+        self.written_ids.extend(
+            note_id for note_id, _ in pending if note_id not in failed_ids
+        )
+        with self._failures_lock:
+            self.failures.extend(failed)
+            if self.on_failed is not None:
+                for note_id, error in failed:
+                    self.on_failed(note_id, error)
+        if self.on_written is not None:
+            self.on_written([note_id for note_id, _ in pending])
+        return failed
+
+
+_client: Optional[AnkiConnectClient] = None
+
+
+def get_client() -> AnkiConnectClient:
+    global _client
+    if _client is None:
+        _client = AnkiConnectClient()
+    return _client
+
+
+def configure(**kwargs) -> AnkiConnectClient:
+    """Replace the shared client, e.g. configure(url=..., timeout=(3, 60))."""
+    global _client
+    if _client is not None:
+        _client.close()
+    _client = AnkiConnectClient(**kwargs)
+    return _client
+
+
+def use_client(client):
+    """
+    Make `client` the shared client.  Anything with invoke(), last_exchange(),
+    format_stats() and close() works, e.g. sqlite_backend.SqliteClient.
+    Passing None goes back to a default AnkiConnectClient on next use.
+    """
+    global _client
+    if _client is not None and _client is not client:
+        _client.close()
+    _client = client
+    return client
+
+
+def invoke(action, **params):
+    return get_client().invoke(action, **params)
+
+
+def print_stats():
+    print(get_client().format_stats())
@@ -1,20 +1,36 @@
 import re
+import time
 from re import Match
-import statistics
-from typing import Tuple, cast
+from typing import List, Optional, Tuple, cast
 from anki.hooks import wrap
 from anki.notes import Note
 from aqt import gui_hooks, mw
 from aqt.addcards import AddCards
 from aqt.editor import Editor
 from aqt.utils import tooltip
-import itertools
-from itertools import combinations
 
 
+from .cloze_combinations import (
+    DEFAULT_LIMIT,
+    combination_wrappers,
+    generate_combinations,
+    splice,
+    wrap_cloze,
+)
 from .consts import ANKI_VERSION_TUPLE
-from .model_finder import get_basic_note_type_ids, get_cloze_note_type_ids
+from .model_finder import (
+    get_basic_note_type_ids,
+    get_model,
+    is_basic_note_type,
+    is_cloze_note_type,
+)
 from .model_selector import target_model
+from .note_analysis import (
+    analyze_note,
+    note_analysis,
+    store_expansion,
+    stored_expansion,
+)
 
 try:
     from anki.notes import NoteFieldsCheckResult
@@ -26,25 +42,37 @@ try:
 except:
     pass
 
-CLOZE_RE = r"\{\{c\d+::[\s\S]*?\}\}"
+# Seconds the Add dialog's background expansion may take with DEFAULT_LIMIT
+EXPANSION_BUDGET = 1.0
+# Plan used once the budget is exceeded: a single cloze over all the clozes
+FALLBACK_LIMIT = 1
+
+
+class ExpansionTimeout(Exception):
+    pass
+
+
+def _check_deadline(deadline: Optional[float]):
+    if deadline is not None and time.perf_counter() > deadline:
+        raise ExpansionTimeout()
 
 
 def contains_cloze(note: Note):
-    for fld in note.fields:
-        m = re.search(CLOZE_RE, fld)
-        if m:
-            return True
-    return False
+    return analyze_note(note).has_clozes
 
 
 def find_clozes(note):
     """
     Finds all clozes in the note and returns them as a list.
+
+    The matches come from the note's analysis (see note_analysis), so the
+    fields are not scanned again inside the add-card hook.
     """
     clozes = {}
     original_cloze_hints = {}
-    for fld_index, fld in enumerate(note.fields):
-        for cloze_match in re.findall(CLOZE_RE, fld):
+    for fld_index, matches in enumerate(analyze_note(note).cloze_matches):
+        for match in matches:
+            cloze_match = match.group(0)
             res = cast(str, cloze_match).split("::")
             cloze_hint = ""
             if len(res) == 2:
@@ -58,118 +86,162 @@ def find_clozes(note):
             if cloze_num not in clozes:
                 clozes[cloze_num] = []
 
-            clozes[cloze_num].append((fld_index, cloze_match, cloze_text, cloze_hint))
+            clozes[cloze_num].append(
+                (fld_index, cloze_match, cloze_text, cloze_hint, match.span())
+            )
             original_cloze_hints[cloze_text] = cloze_hint
     return clozes, original_cloze_hints
 
 
-import itertools
- 
-
-def generate_combinations(clozes, limit):
-    """
-    Generates all unique combinations of the clozes and returns them as a list.
-    """
-    combinations = []    
-    # Generate combinations in ascending order
-    for i in reversed(range(1, len(clozes)-1)):
-        if len(combinations) + len(clozes) >= limit:
-            break
-        combination = tuple(clozes[i:])
-        if combination not in combinations:
-            combinations.append(combination)
-            
-    if len(combinations) + len(clozes) < limit:
-        for i in range(2, len(clozes)):
-            choose_i = itertools.combinations(clozes, i)
-            choose_i = sorted(
-                choose_i,
-                key=lambda c: statistics.mean([clozes.index(cloze) for cloze in c]),
-            )
-            choose_i = sorted(
-                choose_i,
-                key=lambda c: statistics.variance([clozes.index(cloze) for cloze in c]),
-            )
-            for combination in choose_i:
-                if len(combinations) + len(clozes) >= limit:
-                    break
-                if combination not in combinations:
-                    combinations.append(combination)
-    
-    # Add the final combination
-    final_comb = tuple(clozes)
-    if final_comb not in combinations and len(clozes) > 1:
-        combinations.append(final_comb)
-                    
-    return combinations
-
-
-def modify_clozes(note):
+def modify_clozes(note, limit: int = DEFAULT_LIMIT, deadline: Optional[float] = None):
     """
     Modifies the clozes on a note, in-place, to be replaced by the final clozes containing all combinations.
+
+    All wrappers of a cloze are computed first and every field is rebuilt once
+    from the offsets found by find_clozes.  Past `deadline` (a time.perf_counter
+    value) ExpansionTimeout is raised before any field is changed; it is checked
+    before the scan, between the planning steps and for every cloze wrapped,
+    so a single step can still overrun it.
     """
+    _check_deadline(deadline)
     clozes, original_cloze_hints = find_clozes(note)
+    _check_deadline(deadline)
     # cloze_keys = sorted(list(clozes.keys()))
     cloze_keys = list(clozes.keys())
-    combinations = generate_combinations(cloze_keys, 10)
-    for comb_index, combination in enumerate(combinations):
-        new_cloze = f"{{{{c{comb_index+len(clozes)+1}::"
-        for i, cloze_num in enumerate(combination):
-            to_iterate_clozes = {(cloze_text, field_index): (field_index,cloze,cloze_hint) for field_index, cloze, cloze_text, cloze_hint in clozes[cloze_num]}
-            
-            for (cloze_text,field_index),(field_index, cloze, cloze_hint) in to_iterate_clozes.items():
-                to_replace = cloze_text
-
-                if original_cloze_hints[cloze_text] != "":
-                    note.fields[field_index] = note.fields[field_index].replace(
-                        cloze_text,
-                        f"{new_cloze}{cloze_text}::{original_cloze_hints[cloze_text]}"
-                        + "}}",
-                    )
-
-                else:
-                    note.fields[field_index] = note.fields[field_index].replace(
-                        cloze_text, f"{new_cloze}{cloze_text}"+ "}}",
-                    )
+    combinations = generate_combinations(cloze_keys, limit)
+    _check_deadline(deadline)
+    wrappers = combination_wrappers(combinations, len(clozes) + 1)
+
+    edits = {}
+    for cloze_num, new_indices in wrappers.items():
+        _check_deadline(deadline)
+        for field_index, cloze, cloze_text, cloze_hint, (start, end) in clozes[cloze_num]:
+            # A hint containing "}" is rewritten by find_clozes, so cloze_text no
+            # longer occurs in the field and there is nothing to wrap.
+            if cloze_text != cloze:
+                continue
+            edits.setdefault(field_index, []).append(
+                (start, end, wrap_cloze(cloze_text, cloze_hint, new_indices))
+            )
+
+    for field_index, field_edits in edits.items():
+        note.fields[field_index] = splice(note.fields[field_index], field_edits)
+
+
+class _Fields:
+    """Only the fields of a note, so they can be expanded off the main thread."""
+
+    def __init__(self, fields: List[str]):
+        self.fields = list(fields)
+
+
+def expand_fields(fields: List[str], budget: float = EXPANSION_BUDGET) -> List[str]:
+    """
+    modify_clozes on a copy of `fields`.  If the full plan takes longer than
+    `budget` seconds the cheaper FALLBACK_LIMIT plan is used instead.
+    """
+    note = _Fields(fields)
+    with note_analysis(note):
+        try:
+            modify_clozes(note, deadline=time.perf_counter() + budget)
+        except ExpansionTimeout:
+            modify_clozes(note, FALLBACK_LIMIT)
+    return note.fields
 
 
 def main():
     def convert_basic_to_cloze(problem, note: Note):
-        if not (
-            note.note_type()["id"] in get_basic_note_type_ids() and contains_cloze(note)
-        ):
+        if not is_basic_note_type(note.mid):
             return problem
 
-        if not target_model(note):
-            tooltip("[Automatic Basic to Cloze] Cannot find 'Cloze' note type")
-            return problem
-
-        modify_clozes(note)
+        # contains_cloze, target_model and modify_clozes share one scan of the fields
+        with note_analysis(note):
+            if not contains_cloze(note):
+                return problem
+
+            # modify_clozes only wraps existing clozes, so the target stays the same
+            new_model = target_model(note)
+            if not new_model:
+                tooltip("[Automatic Basic to Cloze] Cannot find 'Cloze' note type")
+                return problem
+
+            # The Add dialog may already have expanded the clozes in the background
+            expanded = stored_expansion(note)
+            if expanded is not None:
+                note.fields[:] = expanded
+            else:
+                modify_clozes(note)
 
-        old_model = mw.col.models.get(note.mid)
-        new_model = target_model(note)
+            old_model = get_model(note.mid)
 
-        field_values = [
-            note[old_model["flds"][i]["name"]]
-            for i in range(min(len(old_model["flds"]), len(new_model["flds"])))
-        ]
-        tags = note.tags
+            field_values = [
+                note[old_model["flds"][i]["name"]]
+                for i in range(min(len(old_model["flds"]), len(new_model["flds"])))
+            ]
+            tags = note.tags
 
-        note.__init__(mw.col, new_model)
-        for i, value in enumerate(field_values):
-            note[new_model["flds"][i]["name"]] = value
-        note.tags = tags
+            note.__init__(mw.col, new_model)
+            for i, value in enumerate(field_values):
+                note[new_model["flds"][i]["name"]] = value
+            note.tags = tags
 
         return None
 
     gui_hooks.add_cards_will_add_note.append(convert_basic_to_cloze)
 
-    def change_notetype_from_cloze_to_basic_in_addcards_dialog(addcards: AddCards):
-        try:
+    # Expand the clozes of a Basic note in a QueryOp before the Add dialog adds
+    # it, so large notes do not freeze the editor; convert_basic_to_cloze then
+    # only copies the stored result and changes the note type.  The editor's
+    # note keeps its text until the add is accepted.
+    if ANKI_VERSION_TUPLE >= (2, 1, 45) and hasattr(AddCards, "_add_current_note"):
+        from aqt.operations import QueryOp
+
+        def _add_current_note_after_expansion(self, *, _old):
+            note = self.editor.note
             if (
-                addcards.notetype_chooser.selected_notetype_id
-                in get_cloze_note_type_ids()
+                note.id != 0
+                or not is_basic_note_type(note.mid)
+                or stored_expansion(note) is not None
+                or not contains_cloze(note)
             ):
+                return _old(self)
+            if getattr(self, "_nested_clz_expanding", False):
+                return  # Add pressed again while the expansion runs
+            self._nested_clz_expanding = True
+            fields = list(note.fields)
+
+            def dialog_open() -> bool:
+                # Closing the dialog clears the editor's note
+                return (
+                    not getattr(self, "_close_event_has_cleaned_up", False)
+                    and self.editor.note is note
+                )
+
+            def on_expanded(new_fields: List[str]):
+                self._nested_clz_expanding = False
+                if not dialog_open():
+                    return
+                store_expansion(note, fields, new_fields)
+                _old(self)
+
+            def on_failure(exception: Exception):
+                self._nested_clz_expanding = False
+                if dialog_open():
+                    _old(self)
+
+            QueryOp(
+                parent=self, op=lambda col: expand_fields(fields), success=on_expanded
+            ).failure(on_failure).without_collection().with_progress(
+                "Expanding clozes..."
+            ).run_in_background()
+
+        AddCards._add_current_note = wrap(
+            AddCards._add_current_note, _add_current_note_after_expansion, "around"
+        )
+
+    def change_notetype_from_cloze_to_basic_in_addcards_dialog(addcards: AddCards):
+        try:
+            if is_cloze_note_type(addcards.notetype_chooser.selected_notetype_id):
                 addcards.notetype_chooser.selected_notetype_id = (
                     get_basic_note_type_ids()[0]
                 )
@@ -185,7 +257,7 @@ def main():
     # adding the cloze buttons also enables the shortcut!
     # in older version the button and the shortcut exist by default
     def maybe_show_cloze_button(editor: Editor):
-        if editor.note.note_type()["id"] not in get_basic_note_type_ids():
+        if not is_basic_note_type(editor.note.mid):
             return
 
         if ANKI_VERSION_TUPLE >= (2, 1, 52):
@@ -218,7 +290,7 @@ def main():
         def _update_duplicate_display_ignore_cloze_problems_for_basic_notes(
             self, result
         ) -> None:
-            if self.note.note_type()["id"] in get_basic_note_type_ids():
+            if is_basic_note_type(self.note.mid):
                 if (
                     result == NoteFieldsCheckResult.NOTETYPE_NOT_CLOZE
                     or result == NoteFieldsCheckResult.FIELD_NOT_CLOZE
@@ -232,15 +304,14 @@ def main():
     elif ANKI_VERSION_TUPLE >= (2, 1, 40):
 
         def _onClozeNew(self, *, _old):
-            basicNoteTypes = get_basic_note_type_ids()
-            model_id = self.note.model()["id"]
-            if model_id in basicNoteTypes and self.addMode:
+            is_basic = is_basic_note_type(self.note.mid)
+            if is_basic and self.addMode:
                 model_type_backup = self.note.model()["type"]
                 self.note.model()["type"] = MODEL_CLOZE
 
             result = _old(self)
 
-            if model_id in basicNoteTypes and self.addMode:
+            if is_basic and self.addMode:
                 self.note.model()["type"] = model_type_backup
 
             return result
@@ -249,8 +320,7 @@ def main():
     else:
 
         def _onClozeNew(self, *, _old):
-            model_id = self.note.model()["id"]
-            if model_id in get_basic_note_type_ids() and self.addMode:
+            if is_basic_note_type(self.note.mid) and self.addMode:
                 hook_re_search()
                 result = _old(self)
                 unhook_re_search()
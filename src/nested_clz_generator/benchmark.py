@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmarks for the cloze transforms over the corpora in the repo.
+
+  python benchmark.py [CORPUS ...] [--function NAME] [--repeat N]
+                      [--output benchmark.json] [--baseline old.json]
+
+Without CORPUS the files shipped in the repository root are used
+(DEFAULT_CORPORA).  Each corpus is read once into a list of fields, its format
+being detected from the first line:
+
+  === Stripped Clozes Preview ...   strip_cloze_preview output, one field per block
+  === Modified Notes Log ===        a modified_notes log, the Before and After fields
+  === Pair #1 ===                   check output, the field lines of the diffs
+  === Synthetic Cloze Corpus ...    synthetic_corpus output, one JSON string per line
+
+For every (corpus, function) pair the fields go through the function `repeat`
+times and the best run gives fields/s and MB/s (UTF-8 size of the fields).
+Peak memory is measured in one more run under tracemalloc, so tracing does not
+slow the timed runs down.  Results are written as JSON; with --baseline the
+speedup against an earlier results file is printed as well.
+
+  python benchmark.py --scaling PROFILE [--scales 1,2,4,8] [--function NAME]
+
+measures every function on synthetic_corpus fields of PROFILE at each scale
+instead.  The exponent of seconds against input bytes (the log-log slope
+between the smallest and the largest scale) is about 1 for a linear function;
+above SUPERLINEAR_EXPONENT the function is flagged as super-linear.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import textwrap
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from . import (
+        make_all_clozes_consistent,
+        remedy_nested_clozes,
+        remove_redundant_hints,
+    )
+    from .check_clozes import normalize_clozes, parse_note_blocks
+    from .cloze_combinations import DEFAULT_LIMIT, generate_combination_positions
+    from .cloze_parser import TOKEN_PATTERN
+    from .synthetic_corpus import CORPUS_TITLE, PROFILES, generate_fields, read_corpus
+except ImportError:  # run as a standalone script
+    import make_all_clozes_consistent
+    import remedy_nested_clozes
+    import remove_redundant_hints
+    from check_clozes import normalize_clozes, parse_note_blocks
+    from cloze_combinations import DEFAULT_LIMIT, generate_combination_positions
+    from cloze_parser import TOKEN_PATTERN
+    from synthetic_corpus import CORPUS_TITLE, PROFILES, generate_fields, read_corpus
+
+RESULTS_VERSION = 1
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_CORPORA = [
+    "stripped_preview.txt",
+    "0Top::Studying::01Linear_Algebra_stripped_preview.txt",
+    "modified_notes_remove_duplicates.txt",
+    "checks.txt",
+]
+DEFAULT_REPEAT = 3
+DEFAULT_OUTPUT = "benchmark.json"
+DEFAULT_SCALES = [1, 2, 4, 8]
+# Synthetic fields per scale
+SCALING_FIELDS = 20
+SUPERLINEAR_EXPONENT = 1.3
+
+###############################################################################
+# Corpora
+###############################################################################
+PREVIEW_SEPARATOR = "\n" + "=" * 60 + "\n"
+SEPARATOR_LINE = re.compile(r"^(?:=+|-+)$")
+DIFF_FIELD_LINE = re.compile(r"^[-+ ] {6}(\S.*)$")
+
+
+def _clean_log_field(text: str) -> str:
+    lines = [
+        line
+        for line in textwrap.dedent(text).split("\n")
+        if not SEPARATOR_LINE.match(line.strip())
+    ]
+    return "\n".join(lines).strip()
+
+
+def preview_fields(text: str) -> List[str]:
+    blocks = text.split(PREVIEW_SEPARATOR)
+    # The first block starts with the "=== Stripped Clozes Preview" title
+    blocks[0] = blocks[0].split("\n", 1)[1] if "\n" in blocks[0] else ""
+    fields = (textwrap.dedent(block).strip() for block in blocks)
+    return [field for field in fields if field]
+
+
+def log_fields(text: str) -> List[str]:
+    fields = []
+    for _, before, after in parse_note_blocks(text.splitlines(keepends=True)):
+        fields.extend(field for field in map(_clean_log_field, (before, after)) if field)
+    return fields
+
+
+def diff_fields(text: str) -> List[str]:
+    fields = []
+    for line in text.splitlines():
+        match = DIFF_FIELD_LINE.match(line)
+        if match:
+            fields.append(match.group(1))
+    return fields
+
+
+CORPUS_FORMATS: List[Tuple[str, Callable[[str], List[str]]]] = [
+    ("=== Stripped Clozes Preview", preview_fields),
+    ("=== Modified Notes Log", log_fields),
+    ("=== Pair #", diff_fields),
+    (CORPUS_TITLE, read_corpus),
+]
+
+
+def load_corpus(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    for title, extract in CORPUS_FORMATS:
+        if text.startswith(title):
+            return extract(text)
+    raise ValueError(
+        f"'{path}' is not a preview, modified notes log, check output or synthetic corpus"
+    )
+
+
+###############################################################################
+# Benchmarked functions: prepare(field) runs untimed, run(prepared) is timed.
+###############################################################################
+def _modify_clozes(field: str):
+    note = {"fields": [{"name": "Text", "value": field}]}
+    try:
+        make_all_clozes_consistent.modify_clozes(note)
+    except make_all_clozes_consistent.WronglyFormatted:
+        pass
+    return note
+
+
+def _cloze_keys(field: str) -> List[str]:
+    """The distinct cloze openers of field, in order, as find_clozes keys them."""
+    keys = {}
+    for match in TOKEN_PATTERN.finditer(field):
+        if match.group(1) is not None:
+            keys.setdefault("{{c" + match.group(1), None)
+    return list(keys)
+
+
+def _generate_combinations(keys: List[str]) -> List[tuple]:
+    # generate_combinations itself returns a plan cached at import, so time
+    # the plan computation it caches
+    return [
+        tuple(keys[p] for p in combination)
+        for combination in generate_combination_positions(len(keys), DEFAULT_LIMIT)
+    ]
+
+
+def _identity(field: str) -> str:
+    return field
+
+
+BENCHMARKS: Dict[str, Tuple[Callable[[str], Any], Callable[[Any], Any]]] = {
+    "modify_clozes": (_identity, _modify_clozes),
+    "generate_combinations": (_cloze_keys, _generate_combinations),
+    "strip_nested_to_base_cloze": (
+        _identity,
+        make_all_clozes_consistent.strip_nested_to_base_cloze,
+    ),
+    "remove_hint_occurrences": (_identity, remove_redundant_hints.remove_hint_occurrences),
+    "remove_same_index_duplicate_clozes": (
+        _identity,
+        remedy_nested_clozes.remove_same_index_duplicate_clozes,
+    ),
+    "normalize_clozes": (_identity, normalize_clozes),
+}
+
+
+###############################################################################
+# Measuring
+###############################################################################
+def _run_all(run: Callable[[Any], Any], inputs: Sequence) -> float:
+    start = time.perf_counter()
+    for value in inputs:
+        run(value)
+    return time.perf_counter() - start
+
+
+def measure(fields: Sequence[str], function: str, repeat: int = DEFAULT_REPEAT) -> Dict:
+    """Best of `repeat` timed runs of one benchmark over fields, plus its peak memory."""
+    prepare, run = BENCHMARKS[function]
+    inputs = [prepare(field) for field in fields]
+    size = sum(len(field.encode("utf-8")) for field in fields)
+
+    # modify_clozes prints the notes it cannot handle
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        seconds = min(_run_all(run, inputs) for _ in range(repeat))
+
+        tracemalloc.start()
+        try:
+            _run_all(run, inputs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "function": function,
+        "fields": len(fields),
+        "bytes": size,
+        "seconds": seconds,
+        "fields_per_s": len(fields) / seconds if seconds else None,
+        "mb_per_s": size / 1e6 / seconds if seconds else None,
+        "peak_kib": peak / 1024,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _default_corpora() -> List[str]:
+    paths = [os.path.join(REPO_ROOT, name) for name in DEFAULT_CORPORA]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise SystemExit(
+            "The default corpora are not next to the package "
+            f"({', '.join(missing)}); pass the corpus files explicitly."
+        )
+    return paths
+
+
+def print_results(results: List[Dict], baseline: Optional[Dict] = None):
+    previous = {}
+    if baseline is not None:
+        previous = {(r["corpus"], r["function"]): r for r in baseline["results"]}
+
+    for result in results:
+        line = (
+            f"{result['corpus'][:40]:40} {result['function']:36}"
+            f" {result['fields_per_s'] or 0:12.0f} fields/s"
+            f" {result['mb_per_s'] or 0:8.2f} MB/s"
+            f" {result['peak_kib']:10.1f} KiB peak"
+        )
+        old = previous.get((result["corpus"], result["function"]))
+        if old is not None and result["seconds"]:
+            line += f"  x{old['seconds'] / result['seconds']:.2f}"
+        print(line)
+
+
+def scaling_exponent(points: Sequence[Dict]) -> Optional[float]:
+    """Log-log slope of seconds against bytes between the first and last point."""
+    first, last = points[0], points[-1]
+    if len(points) < 2 or not first["seconds"] or last["bytes"] <= first["bytes"]:
+        return None
+    return math.log(last["seconds"] / first["seconds"]) / math.log(last["bytes"] / first["bytes"])
+
+
+def measure_scaling(
+    profile: str, functions: List[str], scales: Sequence[float], repeat: int
+) -> List[Dict]:
+    """One series per function: measure() at every scale, and its exponent."""
+    corpora = [generate_fields(profile, SCALING_FIELDS, scale) for scale in scales]
+    series = []
+    for function in functions:
+        points = []
+        for scale, fields in zip(scales, corpora):
+            point = measure(fields, function, repeat)
+            point["scale"] = scale
+            points.append(point)
+        exponent = scaling_exponent(points)
+        series.append({
+            "profile": profile,
+            "function": function,
+            "exponent": exponent,
+            "superlinear": exponent is not None and exponent > SUPERLINEAR_EXPONENT,
+            "points": points,
+        })
+    return series
+
+
+def print_scaling(series: Dict):
+    print(f"{series['profile']} / {series['function']}")
+    for point in series["points"]:
+        print(
+            f"  x{point['scale']:<6g} {point['bytes'] / 1e6:9.3f} MB"
+            f" {point['seconds']:10.4f} s {point['peak_kib']:10.1f} KiB peak"
+        )
+    exponent = series["exponent"]
+    if exponent is None:
+        print("  exponent: n/a")
+    else:
+        flag = "  SUPER-LINEAR" if series["superlinear"] else ""
+        print(f"  exponent: {exponent:.2f}{flag}")
+
+
+def _write_results(output: str, repeat: int, **results):
+    data = {
+        "version": RESULTS_VERSION,
+        "timestamp": time.time(),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "repeat": repeat,
+        **results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    print(f"Results written to '{output}'.")
+
+
+def main(
+    corpora: Optional[List[str]] = None,
+    functions: Optional[List[str]] = None,
+    repeat: int = DEFAULT_REPEAT,
+    output: str = DEFAULT_OUTPUT,
+    baseline: Optional[str] = None,
+    scaling: Optional[str] = None,
+    scales: Optional[List[float]] = None,
+):
+    functions = functions or list(BENCHMARKS)
+    unknown = [name for name in functions if name not in BENCHMARKS]
+    if unknown:
+        raise SystemExit(
+            f"Unknown function(s) {', '.join(unknown)}; choose from {', '.join(BENCHMARKS)}"
+        )
+
+    if scaling is not None:
+        if scaling not in PROFILES:
+            raise SystemExit(f"Unknown profile {scaling}; choose from {', '.join(PROFILES)}")
+        all_series = []
+        for series in measure_scaling(scaling, functions, scales or DEFAULT_SCALES, repeat):
+            print_scaling(series)
+            all_series.append(series)
+        _write_results(output, repeat, scaling=all_series)
+        if any(series["superlinear"] for series in all_series):
+            sys.exit(1)
+        return
+
+    corpora = corpora or _default_corpora()
+
+    baseline_results = None
+    if baseline is not None:
+        with open(baseline, "r", encoding="utf-8") as f:
+            baseline_results = json.load(f)
+
+    results = []
+    for path in corpora:
+        fields = load_corpus(path)
+        for function in functions:
+            result = measure(fields, function, repeat)
+            result["corpus"] = os.path.basename(path)
+            results.append(result)
+            print_results([result], baseline_results)
+
+    _write_results(output, repeat, results=results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cloze transforms.")
+    parser.add_argument("corpora", nargs="*",
+                        help="Preview / modified notes / check files (default: the ones in the repository)")
+    parser.add_argument("--function", dest="functions", action="append", choices=list(BENCHMARKS),
+                        help="Only benchmark this function (repeatable; default: all)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="Timed runs per benchmark, the best one is kept (default: %(default)s)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="JSON results file (default: %(default)s)")
+    parser.add_argument("--baseline", default=None,
+                        help="Earlier results file to compare against")
+    parser.add_argument("--scaling", default=None, choices=list(PROFILES),
+                        help="Measure how the functions scale on this synthetic profile instead")
+    parser.add_argument("--scales", default=None,
+                        type=lambda value: [float(scale) for scale in value.split(",")],
+                        help="Comma-separated scales for --scaling (default: 1,2,4,8)")
+    args = parser.parse_args()
+    main(args.corpora, args.functions, args.repeat, args.output, args.baseline,
+         args.scaling, args.scales)
@@ -0,0 +1,140 @@
+"""
+Browser action: convert the selected Basic notes that contain clozes.
+
+Everything runs in one background CollectionOp: modify_clozes on every note,
+one update_notes call, one change_notetype_of_notes call per (old, new) note
+type pair, all merged into a single undo step.  Changing the note type is a
+schema change (the next sync is a one-way full sync), so the user is asked
+first, as Anki's own Change Note Type does.
+"""
+from typing import Dict, FrozenSet, List, Sequence, Tuple
+
+from anki.collection import Collection, OpChanges
+from anki.notes import NoteId
+from aqt import gui_hooks, mw
+from aqt.browser import Browser
+from aqt.operations import CollectionOp
+from aqt.qt import QAction, qconnect
+from aqt.utils import tooltip
+
+from .basic2cloze import modify_clozes
+from .model_finder import get_basic_note_type_ids, get_cloze_note_type_ids
+from .model_selector import clozeHideAllType
+from .note_analysis import note_analysis
+
+UNDO_NAME = "Convert Basic to Cloze"
+# Notes converted between two progress updates
+PROGRESS_EVERY = 100
+
+
+class ConversionResult:
+    """What convert_notes returns to CollectionOp (it only needs `changes`)."""
+
+    def __init__(self, changes: OpChanges, converted: int, skipped_hide_all: int):
+        self.changes = changes
+        self.converted = converted
+        self.skipped_hide_all = skipped_hide_all
+
+
+def _field_map(col: Collection, old_id, new_id) -> List[int]:
+    """New field i takes old field i, as convert_basic_to_cloze copies them."""
+    old_count = len(col.models.get(old_id)["flds"])
+    new_count = len(col.models.get(new_id)["flds"])
+    return [i if i < old_count else -1 for i in range(new_count)]
+
+
+def _update_progress(done: int, total: int):
+    mw.taskman.run_on_main(
+        lambda: mw.progress.update(
+            label=f"Converting notes... {done}/{total}", value=done, max=total
+        )
+    )
+
+
+def convert_notes(
+    col: Collection,
+    note_ids: Sequence[NoteId],
+    basic_ids: FrozenSet[int],
+    cloze_id,
+    hide_all_id,
+) -> ConversionResult:
+    """
+    Runs in the background: the note type ids are resolved beforehand on the
+    main thread, so only `col` is used here.  Notes that need the Cloze (Hide
+    all) note type are skipped, and counted, when hide_all_id is None.
+    """
+    undo_entry = col.add_custom_undo_entry(UNDO_NAME)
+
+    notes = []
+    skipped_hide_all = 0
+    groups: Dict[Tuple[int, int], List[NoteId]] = {}
+    for done, note_id in enumerate(note_ids, start=1):
+        note = col.get_note(note_id)
+        if note.mid in basic_ids:
+            with note_analysis(note) as analysis:
+                target_id = hide_all_id if analysis.hide_all else cloze_id
+                if analysis.has_clozes and not target_id:
+                    skipped_hide_all += 1
+                elif analysis.has_clozes:
+                    modify_clozes(note)
+                    notes.append(note)
+                    groups.setdefault((note.mid, target_id), []).append(note_id)
+        if done % PROGRESS_EVERY == 0:
+            _update_progress(done, len(note_ids))
+
+    if notes:
+        col.update_notes(notes)
+        for (old_id, new_id), group_ids in groups.items():
+            request = col.models.change_notetype_info(
+                old_notetype_id=old_id, new_notetype_id=new_id
+            ).input
+            request.note_ids.extend(group_ids)
+            del request.new_fields[:]
+            request.new_fields.extend(_field_map(col, old_id, new_id))
+            col.models.change_notetype_of_notes(request)
+
+    changes = col.merge_undo_entries(undo_entry)
+    return ConversionResult(changes, len(notes), skipped_hide_all)
+
+
+def _report(browser: Browser, result: ConversionResult):
+    message = f"Converted {result.converted} notes to Cloze."
+    if result.skipped_hide_all:
+        message += (
+            f" {result.skipped_hide_all} notes with '::!' clozes were skipped:"
+            f" cannot find the '{clozeHideAllType}' note type."
+        )
+    tooltip(message, parent=browser)
+
+
+def convert_selected_notes(browser: Browser):
+    note_ids = browser.selected_notes()
+    if not note_ids:
+        tooltip("No notes selected.", parent=browser)
+        return
+
+    cloze_ids = get_cloze_note_type_ids()
+    if not cloze_ids:
+        tooltip("[Automatic Basic to Cloze] Cannot find 'Cloze' note type", parent=browser)
+        return
+    basic_ids = frozenset(get_basic_note_type_ids())
+    hide_all_id = mw.col.models.id_for_name(clozeHideAllType)
+
+    if not mw.confirm_schema_modification():
+        return
+
+    CollectionOp(
+        parent=browser,
+        op=lambda col: convert_notes(col, note_ids, basic_ids, cloze_ids[0], hide_all_id),
+    ).success(lambda result: _report(browser, result)).run_in_background()
+
+
+def add_browser_action(browser: Browser):
+    action = QAction(UNDO_NAME, browser)
+    qconnect(action.triggered, lambda: convert_selected_notes(browser))
+    browser.form.menu_Notes.addSeparator()
+    browser.form.menu_Notes.addAction(action)
+
+
+def main():
+    gui_hooks.browser_menus_did_init.append(add_browser_action)
@@ -0,0 +1,121 @@
+"""
+Structured change log written by the mutating maintenance scripts.
+
+One JSON object per line, written as soon as it is known:
+
+  {"type": "change", "note_id": 1, "field": "Text", "before": "...",
+   "after": "...", "stage": "clip", "timestamp": 1700000000.0}
+  {"type": "failure", "note_id": 2, "stage": "write", "error": "...",
+   "timestamp": 1700000000.0}
+
+Failure records may also carry the "fields" the failing stage was given.
+
+The file is compressed when its name ends in .gz (gzip) or .zst (zstd, needs
+the zstandard package).  Appending, as --resume does, adds a new gzip member /
+zstd frame, which both formats read back as one stream.
+
+This module must not import anki/aqt: the AnkiConnect scripts run outside Anki.
+"""
+import gzip
+import io
+import json
+import threading
+import time
+from typing import IO, Iterator, Optional
+
+DEFAULT_CHANGE_LOG = "changes.jsonl"
+
+
+def open_text(path: str, mode: str = "r") -> IO[str]:
+    """Open a possibly compressed text file; mode is "r", "w" or "a"."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError(
+                f"'{path}' is zstd-compressed: install the zstandard package"
+            ) from e
+        raw = open(path, mode + "b")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                raw, read_across_frames=True, closefd=True
+            )
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class ChangeLog:
+    def __init__(self, path: str, stage: str, append: bool = False):
+        self.path = path
+        self.stage = stage
+        self.changes = 0
+        self.failures = 0
+        self._file: Optional[IO[str]] = open_text(path, "a" if append else "w")
+        # NoteWriter reports write failures from its own thread
+        self._lock = threading.Lock()
+
+    def change(self, note_id: int, field: str, before: str, after: str):
+        self._write({
+            "type": "change",
+            "note_id": note_id,
+            "field": field,
+            "before": before,
+            "after": after,
+            "stage": self.stage,
+            "timestamp": time.time(),
+        })
+        self.changes += 1
+
+    def failure(
+        self,
+        note_id: int,
+        error: str,
+        stage: Optional[str] = None,
+        fields: Optional[dict] = None,
+    ):
+        record = {
+            "type": "failure",
+            "note_id": note_id,
+            "stage": stage or self.stage,
+            "error": error,
+            "timestamp": time.time(),
+        }
+        if fields is not None:
+            record["fields"] = fields
+        self._write(record)
+        with self._lock:
+            self.failures += 1
+
+    def write_failure(self, note_id: int, error: str):
+        """NoteWriter.stream_failures callback for updates Anki rejected."""
+        self.failure(note_id, error, stage="write")
+
+    def _write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_change_log(path: str) -> Iterator[dict]:
+    """Yield the records of a change log, one line at a time."""
+    with open_text(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 
+import argparse
+import contextlib
 import sys
-import re
 import difflib
-
-# Regex to detect only the cloze markup tokens:
-#   - opener: {{c\d+::
-#   - closer: }}
-TOKEN_REGEX = re.compile(r"(\{\{c\d+::|\}\})")
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional
+
+try:
+    from .change_log import read_change_log
+    from .cloze_parser import markup_free_digest, parse_field, remove_cloze_markup
+except ImportError:  # run as a standalone script
+    from change_log import read_change_log
+    from cloze_parser import markup_free_digest, parse_field, remove_cloze_markup
+
+# Blocks sent to a worker at a time
+CHUNK_BLOCKS = 64
+# Fields with more normalized lines than this are not run through difflib
+MAX_DIFF_LINES = 200
 
 def normalize_clozes(original_text: str) -> str:
     """
@@ -18,49 +29,33 @@ def normalize_clozes(original_text: str) -> str:
       '{{c10::Hello}}' => 'Hello'
       'Nested {{c5::abc {{c2::def}} ghi}}' => 'Nested abc def ghi'
     """
-    result = []
-    stack = []
-    last_pos = 0
-
-    for match in TOKEN_REGEX.finditer(original_text):
-        start, end = match.start(), match.end()
-        token = match.group(0)
+    return remove_cloze_markup(parse_field(original_text))
 
-        # Add all literal text prior to this token
-        result.append(original_text[last_pos:start])
-
-        if token.startswith("{{c"):
-            # opener
-            stack.append(True)
-        else:
-            # closer
-            if stack:
-                stack.pop()
-            else:
-                # stray '}}' => treat it as text
-                result.append(token)
-
-        last_pos = end
-
-    # Add any remaining text after the last token
-    result.append(original_text[last_pos:])
-    return "".join(result)
+def only_markup_changed(before: str, after: str) -> bool:
+    """True if before and after differ only in cloze markup, compared by digest."""
+    return before == after or markup_free_digest(before) == markup_free_digest(after)
 
 def compare_before_after(before: str, after: str):
     """
     Return (is_same, diff_text):
       - is_same = True if they differ only in cloze markup
       - diff_text = a unified diff if they differ in real text
-    """
-    nb = normalize_clozes(before)
-    na = normalize_clozes(after)
 
-    if nb == na:
+    The sides are only normalized and diffed when their digests differ, and
+    fields longer than MAX_DIFF_LINES get a short summary instead of a diff.
+    """
+    if only_markup_changed(before, after):
         return True, ""
 
+    nb = normalize_clozes(before).splitlines()
+    na = normalize_clozes(after).splitlines()
+
+    if max(len(nb), len(na)) > MAX_DIFF_LINES:
+        return False, capped_diff(nb, na)
+
     diff = difflib.unified_diff(
-        nb.splitlines(),
-        na.splitlines(),
+        nb,
+        na,
         fromfile="before (normalized)",
         tofile="after (normalized)",
         lineterm=""
@@ -68,6 +63,24 @@ def compare_before_after(before: str, after: str):
     diff_text = "\n".join(diff)
     return False, diff_text
 
+def capped_diff(nb: List[str], na: List[str]) -> str:
+    """Diff-like summary of two long normalized fields: their first differing line."""
+    first = 0
+    while first < len(nb) and first < len(na) and nb[first] == na[first]:
+        first += 1
+
+    lines = [
+        "--- before (normalized)",
+        "+++ after (normalized)",
+        f"@@ diff skipped ({len(nb)} / {len(na)} lines, over {MAX_DIFF_LINES}); "
+        f"first difference at line {first + 1} @@",
+    ]
+    if first < len(nb):
+        lines.append("-" + nb[first])
+    if first < len(na):
+        lines.append("+" + na[first])
+    return "\n".join(lines)
+
 def parse_note_blocks(lines):
     """
     Generator function that yields (note_id, before_text, after_text).
@@ -83,6 +96,9 @@ def parse_note_blocks(lines):
       <some lines>
 
     (blank lines in between)
+
+    `lines` can be any iterable of lines, e.g. an open file, so the log is
+    read incrementally and only the current block is held in memory.
     """
     note_id = None
     before_text = []
@@ -91,9 +107,8 @@ def parse_note_blocks(lines):
     reading_before = False
     reading_after = False
 
-    i = 0
-    while i < len(lines):
-        line = lines[i].rstrip("\n")
+    for line in lines:
+        line = line.rstrip("\n")
 
         # Detect "Note ID: <number>"
         if line.startswith("Note ID: "):
@@ -107,21 +122,18 @@ def parse_note_blocks(lines):
             after_text = []
             reading_before = False
             reading_after = False
-            i += 1
             continue
 
         # Detect "Before:"
         if line.strip() == "Before:":
             reading_before = True
             reading_after = False
-            i += 1
             continue
 
         # Detect "After:"
         if line.strip() == "After:":
             reading_before = False
             reading_after = True
-            i += 1
             continue
 
         # If we're reading the 'Before' text
@@ -132,48 +144,144 @@ def parse_note_blocks(lines):
         elif reading_after:
             after_text.append(line)
 
-        i += 1
-
     # End of file => yield the last block if any
     if note_id is not None:
         yield (note_id, "\n".join(before_text), "\n".join(after_text))
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python check_cloze_differences.py <modified_notes.txt>")
-        sys.exit(1)
-
-    filename = sys.argv[1]
-    with open(filename, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    blocks = list(parse_note_blocks(lines))
-    if not blocks:
+def change_log_blocks(path: str):
+    """Same as parse_note_blocks, for the JSONL change logs (one block per field)."""
+    for record in read_change_log(path):
+        if record["type"] == "change":
+            yield (str(record["note_id"]), record["before"], record["after"])
+
+def is_change_log(path: str) -> bool:
+    return any(path.endswith(ext) for ext in (".jsonl", ".jsonl.gz", ".jsonl.zst"))
+
+def check_block(block_count: int, nid: str, before: str, after: str) -> Optional[str]:
+    """The report for one block, or None for a block with no text."""
+    before = before.strip("\n")
+    after = after.strip("\n")
+
+    # If both are empty, skip
+    if not before and not after:
+        return None
+
+    is_same, diff_text = compare_before_after(before, after)
+
+    report = [f"=== Note ID: {nid} (Block {block_count}) ==="]
+    if is_same:
+        report.append("  => No difference except for clozes.")
+    else:
+        report.append("  => Content differs beyond just cloze markup!")
+        if diff_text.strip():
+            report.append("----- Diff (Normalized) -----")
+            report.append(diff_text)
+            report.append("----------------------------")
+    report.append("")
+    return "\n".join(report)
+
+def block_differs(nid: str, before: str, after: str) -> Optional[str]:
+    """The note ID of a block whose content differs, for --summary."""
+    if only_markup_changed(before.strip("\n"), after.strip("\n")):
+        return None
+    return nid
+
+def check_blocks(chunk: List[tuple], summary: bool = False) -> list:
+    """
+    check_block over a chunk of (block_count, nid, before, after); runs in a
+    worker.  With summary=True only block_differs is computed.
+    """
+    if summary:
+        return [block_differs(*block[1:]) for block in chunk]
+    return [check_block(*block) for block in chunk]
+
+def _chunked(blocks, size: int) -> Iterator[List[tuple]]:
+    chunk = []
+    for block_count, (nid, before, after) in enumerate(blocks, start=1):
+        chunk.append((block_count, nid, before, after))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def checked_chunks(blocks, workers: int, summary: bool = False) -> Iterator[list]:
+    """
+    Yield the check_blocks results chunk by chunk, in log order.  With
+    workers > 1 the chunks are checked in a process pool with at most
+    2 * workers chunks in flight, so memory stays bounded whatever the size
+    of the log.
+    """
+    chunks = _chunked(blocks, CHUNK_BLOCKS)
+    if workers <= 1:
+        for chunk in chunks:
+            yield check_blocks(chunk, summary)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight: deque = deque()
+        for chunk in chunks:
+            in_flight.append(executor.submit(check_blocks, chunk, summary))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def print_summary(checked: int, differing: List[str]):
+    print(f"Blocks checked: {checked}")
+    print(f"Only cloze markup changed: {checked - len(differing)}")
+    print(f"Content differs: {len(differing)}")
+    for nid in differing:
+        print(nid)
+
+def main(filename: str = None, workers: int = 1, summary: bool = False):
+    """
+    Print a report per block, or with summary=True only the counts and the
+    IDs of the notes whose content differs (exit status 1 if there are any).
+    """
+    if filename is None:
+        if len(sys.argv) < 2:
+            print("Usage: python check_cloze_differences.py <modified_notes.txt>")
+            sys.exit(1)
+        filename = sys.argv[1]
+
+    checked = 0
+    differing = []
+    with contextlib.ExitStack() as stack:
+        if is_change_log(filename):
+            blocks = change_log_blocks(filename)
+        else:
+            blocks = parse_note_blocks(stack.enter_context(open(filename, "r", encoding="utf-8")))
+
+        found = False
+        for results in checked_chunks(blocks, workers, summary):
+            found = True
+            checked += len(results)
+            for result in results:
+                if result is None:
+                    continue
+                if summary:
+                    differing.append(result)
+                else:
+                    print(result)
+
+    if not found:
         print("No 'Note ID:' blocks found.")
         sys.exit(0)
 
-    block_count = 0
-    for (nid, before, after) in blocks:
-        block_count += 1
-        before = before.strip("\n")
-        after = after.strip("\n")
-
-        # If both are empty, skip
-        if not before and not after:
-            continue
-
-        is_same, diff_text = compare_before_after(before, after)
-
-        print(f"=== Note ID: {nid} (Block {block_count}) ===")
-        if is_same:
-            print("  => No difference except for clozes.")
-        else:
-            print("  => Content differs beyond just cloze markup!")
-            if diff_text.strip():
-                print("----- Diff (Normalized) -----")
-                print(diff_text)
-                print("----------------------------")
-        print()
+    if summary:
+        print_summary(checked, differing)
+        if differing:
+            sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Check that a modification log only changed cloze markup."
+    )
+    parser.add_argument("log_file", help="modified_notes.txt or a JSONL change log")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes used for the comparisons (default: 1)")
+    parser.add_argument("--summary", action="store_true",
+                        help="Only print counts and the IDs of notes whose content differs")
+    args = parser.parse_args()
+    main(args.log_file, args.workers, args.summary)
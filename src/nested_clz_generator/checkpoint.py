@@ -0,0 +1,142 @@
+"""
+On-disk checkpoints for long AnkiConnect maintenance runs.
+
+A checkpoint records which notes a run has finished, the offset reached in
+the note list and the updates that were sent to Anki but not yet confirmed.
+It is rewritten atomically (temp file + os.replace) after every batch, so a
+crash or a closed Anki leaves the last complete state on disk.  With
+--resume a script replays the unconfirmed updates (updateNoteFields is
+idempotent) and skips the finished notes.
+
+Processed note IDs are stored sorted and delta-encoded, which keeps the file
+small for 10k+ note decks.
+
+This module must not import anki/aqt: the AnkiConnect scripts run outside Anki.
+"""
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+CHECKPOINT_VERSION = 1
+
+
+def default_checkpoint_path(name: str) -> str:
+    return os.path.join(os.getcwd(), f".{name}.checkpoint.json")
+
+
+def _delta_encode(ids: Iterable[int]) -> List[int]:
+    encoded = []
+    previous = 0
+    for note_id in sorted(ids):
+        encoded.append(note_id - previous)
+        previous = note_id
+    return encoded
+
+
+def _delta_decode(deltas: Iterable[int]) -> List[int]:
+    ids = []
+    current = 0
+    for delta in deltas:
+        current += delta
+        ids.append(current)
+    return ids
+
+
+class Checkpoint:
+    def __init__(self, path: str, query: str):
+        self.path = path
+        self.query = query
+        self.offset = 0
+        self.processed: set = set()
+        # note_id -> fields of updates handed to the writer but not confirmed
+        self.pending: Dict[int, Dict[str, str]] = {}
+        # start time of the interrupted run, reused as its watermark on resume
+        self.started_at: Optional[float] = None
+        # the writer thread confirms updates while the main thread saves
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, query: str) -> "Checkpoint":
+        """Read the checkpoint at `path`; a missing file gives an empty one."""
+        checkpoint = cls(path, query)
+        if not os.path.exists(path):
+            return checkpoint
+
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version in '{path}'")
+        if data["query"] != query:
+            raise ValueError(
+                f"Checkpoint '{path}' was written for query '{data['query']}', "
+                f"not '{query}'"
+            )
+
+        checkpoint.offset = data["offset"]
+        checkpoint.started_at = data.get("started_at")
+        checkpoint.processed = set(_delta_decode(data["processed"]))
+        checkpoint.pending = {
+            int(note_id): fields for note_id, fields in data["pending"].items()
+        }
+        return checkpoint
+
+    def remaining(self, note_ids: List[int]) -> List[int]:
+        return [note_id for note_id in note_ids if note_id not in self.processed]
+
+    def add_pending(self, note_id: int, fields: Dict[str, str]):
+        with self._lock:
+            self.pending[note_id] = fields
+
+    def mark_written(self, note_ids: Iterable[int]):
+        """NoteWriter callback: these updates reached Anki (or were rejected)."""
+        with self._lock:
+            for note_id in note_ids:
+                self.pending.pop(note_id, None)
+
+    def batch_done(self, note_ids: Iterable[int]):
+        """Record a processed batch and save."""
+        with self._lock:
+            for note_id in note_ids:
+                self.processed.add(note_id)
+                self.offset += 1
+        self.save()
+
+    def save(self):
+        with self._lock:
+            data = {
+                "version": CHECKPOINT_VERSION,
+                "query": self.query,
+                "offset": self.offset,
+                "started_at": self.started_at,
+                "processed": _delta_encode(self.processed),
+                "pending": {str(note_id): f for note_id, f in self.pending.items()},
+            }
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Delete the checkpoint after a run that finished cleanly."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def replay_pending(checkpoint: Checkpoint, writer) -> int:
+    """Queue the unconfirmed updates of an interrupted run on `writer`."""
+    pending = list(checkpoint.pending.items())
+    for note_id, fields in pending:
+        writer.update_fields(note_id, fields)
+    writer.flush()
+    return len(pending)
+
+
+def open_checkpoint(path: Optional[str], name: str, query: str, resume: bool) -> Checkpoint:
+    path = path or default_checkpoint_path(name)
+    if resume:
+        return Checkpoint.load(path, query)
+    return Checkpoint(path, query)
@@ -0,0 +1,308 @@
+"""
+nested-clz: one command for the cloze maintenance tools.
+
+  nested-clz strip|remedy|clip|hints|consistent [--query Q] [--workers N] ...
+      run that maintenance_pipeline stage over the notes matching Q and write
+      the changes back (see maintenance_pipeline for the options)
+  nested-clz preview DECK [--query Q] [--workers N]
+      write DECK_stripped_preview.txt without touching Anki
+  nested-clz check LOG [--workers N] [--summary]
+      check that a modified_notes.txt log or a JSONL change log only changed
+      cloze markup
+  nested-clz bench [CORPUS ...] [--function F] [--output FILE] [--baseline FILE]
+      benchmark the cloze transforms over the corpora shipped in the repository
+  nested-clz bench --scaling PROFILE [--scales 1,2,4,8] [--function F]
+      measure how the transforms scale on synthetic fields of PROFILE
+  nested-clz synth PROFILE [--count N] [--scale X] [--seed S] [--notes-info FILE]
+      write a seeded synthetic corpus (and a fake notesInfo payload)
+
+Only argparse is imported up front; each subcommand imports its modules
+(requests, tqdm, the transforms) when it runs, so `nested-clz --help` and
+`nested-clz check` start quickly.
+
+This module must not import anki/aqt: the AnkiConnect scripts run outside Anki.
+"""
+import argparse
+import sys
+from typing import List, Optional
+
+DECK_QUERY = "deck:0Top::Studying"
+
+STAGE_COMMANDS = {
+    "strip": "Strip nested clozes down to their base cloze",
+    "remedy": "Remove repeated same-index cloze openers",
+    "clip": "Remove the markup of clozes with index > 9",
+    "hints": "Remove hints that repeat a cloze answer",
+    "consistent": "Re-nest the clozes of every note consistently",
+}
+
+
+def _run_stage(args):
+    try:
+        from . import maintenance_pipeline
+        from .sqlite_backend import collection_backend
+    except ImportError:  # run as a standalone script
+        import maintenance_pipeline
+        from sqlite_backend import collection_backend
+
+    if args.queue_depth is None:
+        args.queue_depth = maintenance_pipeline.WRITE_QUEUE_DEPTH
+    with collection_backend(args.collection):
+        maintenance_pipeline.main(
+            args.query,
+            [args.command],
+            args.queue_depth,
+            args.workers,
+            args.resume,
+            args.checkpoint,
+            args.incremental,
+            args.watermark,
+            args.batch_size or maintenance_pipeline.BATCH_SIZE,
+            args.change_log,
+        )
+
+
+def _run_preview(args):
+    try:
+        from . import strip_cloze_preview
+        from .sqlite_backend import collection_backend
+    except ImportError:  # run as a standalone script
+        import strip_cloze_preview
+        from sqlite_backend import collection_backend
+
+    with collection_backend(args.collection):
+        strip_cloze_preview.main(
+            args.deck_name,
+            args.query,
+            args.batch_size or strip_cloze_preview.BATCH_SIZE,
+            args.workers,
+        )
+
+
+def _run_check(args):
+    try:
+        from . import check_clozes
+    except ImportError:  # run as a standalone script
+        import check_clozes
+
+    check_clozes.main(args.log_file, args.workers, args.summary)
+
+
+def _run_bench(args):
+    try:
+        from . import benchmark
+    except ImportError:  # run as a standalone script
+        import benchmark
+
+    benchmark.main(
+        args.corpora,
+        args.functions,
+        args.repeat,
+        args.output,
+        args.baseline,
+        args.scaling,
+        args.scales,
+    )
+
+
+def _run_synth(args):
+    try:
+        from . import synthetic_corpus
+    except ImportError:  # run as a standalone script
+        import synthetic_corpus
+
+    synthetic_corpus.main(
+        args.profile, args.count, args.scale, args.seed, args.output, args.notes_info
+    )
+
+
+def _note_options() -> argparse.ArgumentParser:
+    """Options shared by every subcommand that reads notes."""
+    parent = argparse.ArgumentParser(add_help=False)
+    parent.add_argument(
+        "--query", default=None, help=f"Anki search query (default: {DECK_QUERY})"
+    )
+    parent.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Initial notesInfo batch size, adapted to Anki's latency (default: 50)",
+    )
+    parent.add_argument(
+        "--collection",
+        default=None,
+        help="Edit this collection.anki2 directly instead of using AnkiConnect "
+        "(close Anki and back the file up first)",
+    )
+    return parent
+
+
+def _write_options() -> argparse.ArgumentParser:
+    """Options shared by the subcommands that write notes back."""
+    parent = argparse.ArgumentParser(add_help=False)
+    parent.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes used for the transforms (default: 1, in-process)",
+    )
+    parent.add_argument(
+        "--queue-depth",
+        type=int,
+        default=None,
+        help="Batches fetched ahead / written behind (default: 2, 0 = strictly sequential)",
+    )
+    parent.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process notes edited since the last run",
+    )
+    parent.add_argument("--watermark", default=None, help="Watermark file")
+    parent.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from its checkpoint",
+    )
+    parent.add_argument("--checkpoint", default=None, help="Checkpoint file")
+    parent.add_argument(
+        "--change-log",
+        default="changes.jsonl",
+        help="JSONL change log; .gz / .zst names are compressed (default: %(default)s)",
+    )
+    return parent
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="nested-clz", description="Cloze maintenance tools for Anki."
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+    note_options = _note_options()
+    write_options = _write_options()
+
+    for command, help_text in STAGE_COMMANDS.items():
+        stage = subparsers.add_parser(
+            command, parents=[note_options, write_options], help=help_text
+        )
+        stage.set_defaults(func=_run_stage)
+
+    preview = subparsers.add_parser(
+        "preview",
+        parents=[note_options],
+        help="Write a preview of the stripped clozes without changing Anki",
+    )
+    preview.add_argument("deck_name", help="Name of the deck to preview")
+    preview.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes used for the stripping (default: 1, in-process)",
+    )
+    preview.set_defaults(func=_run_preview)
+
+    check = subparsers.add_parser(
+        "check", help="Check that a modification log only changed cloze markup"
+    )
+    check.add_argument("log_file", help="modified_notes.txt or a JSONL change log")
+    check.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes used for the comparisons (default: 1)",
+    )
+    check.add_argument(
+        "--summary",
+        action="store_true",
+        help="Only print counts and the IDs of notes whose content differs "
+        "(exit status 1 if there are any)",
+    )
+    check.set_defaults(func=_run_check)
+
+    bench = subparsers.add_parser(
+        "bench", help="Benchmark the cloze transforms over preview / log corpora"
+    )
+    bench.add_argument(
+        "corpora",
+        nargs="*",
+        help="Preview / modified notes / check files (default: the ones in the repository)",
+    )
+    bench.add_argument(
+        "--function",
+        dest="functions",
+        action="append",
+        help="Only benchmark this function (repeatable; default: all)",
+    )
+    bench.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Timed runs per benchmark, the best one is kept (default: %(default)s)",
+    )
+    bench.add_argument(
+        "--output",
+        default="benchmark.json",
+        help="JSON results file (default: %(default)s)",
+    )
+    bench.add_argument(
+        "--baseline", default=None, help="Earlier results file to compare against"
+    )
+    bench.add_argument(
+        "--scaling",
+        default=None,
+        metavar="PROFILE",
+        help="Measure how the functions scale on this synthetic_corpus profile instead",
+    )
+    bench.add_argument(
+        "--scales",
+        default=None,
+        type=lambda value: [float(scale) for scale in value.split(",")],
+        help="Comma-separated scales for --scaling (default: 1,2,4,8)",
+    )
+    bench.set_defaults(func=_run_bench)
+
+    synth = subparsers.add_parser(
+        "synth", help="Write a seeded synthetic cloze corpus for scaling tests"
+    )
+    synth.add_argument(
+        "profile",
+        help="deep_nesting, many_indices, huge_latex, stray_closers or hints_everywhere",
+    )
+    synth.add_argument(
+        "--count", type=int, default=50, help="Number of fields (default: %(default)s)"
+    )
+    synth.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplies the field size and the profile's knob (default: 1)",
+    )
+    synth.add_argument(
+        "--seed", type=int, default=0, help="Random seed (default: %(default)s)"
+    )
+    synth.add_argument(
+        "--output", default=None, help="Corpus file (default: synthetic_PROFILE.txt)"
+    )
+    synth.add_argument(
+        "--notes-info",
+        default=None,
+        help="Also write the fields as a notesInfo JSON payload",
+    )
+    synth.set_defaults(func=_run_synth)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command in STAGE_COMMANDS:
+        if args.collection and args.resume:
+            parser.error("--resume does not apply to --collection runs (they are one transaction)")
+        args.query = args.query or DECK_QUERY
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
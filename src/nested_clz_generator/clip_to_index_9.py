@@ -1,17 +1,38 @@
 #!/usr/bin/env python3
-import re
-import requests
-from tqdm import tqdm
+import argparse
 import os
 
+try:
+    from .anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from .change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from .checkpoint import open_checkpoint, replay_pending
+    from .sqlite_backend import add_collection_argument, collection_backend
+    from .watermark import open_watermark
+    from .cloze_parser import parse_field, remove_high_index_markup
+except ImportError:  # run as a standalone script
+    from anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from checkpoint import open_checkpoint, replay_pending
+    from sqlite_backend import add_collection_argument, collection_backend
+    from watermark import open_watermark
+    from cloze_parser import parse_field, remove_high_index_markup
+
 ###############################################################################
 # 1) Token-based parser configuration
 ###############################################################################
-# We look for:
-#   1) An opener of the form {{c(\d+)::  (capturing the index)
-#   2) A closer of the form }}
-# Anything else is literal text that we preserve as-is.
-TOKEN_PATTERN = re.compile(r"(\{\{c(\d+)::|\}\})", flags=re.DOTALL)
+# Tokenizing lives in cloze_parser (shared with the other maintenance scripts).
 
 def remove_clozes_index_gt_9_keep_content(field_text: str) -> str:
     """
@@ -24,84 +45,47 @@ def remove_clozes_index_gt_9_keep_content(field_text: str) -> str:
       - Any literal text outside clozes is always preserved.
     """
 
-    result = []
-    last_pos = 0
-
-    # Stack of (cloze_index, keep_markup_boolean)
-    # - keep_markup_boolean = True if the opener+closer should appear in final text
-    # - if False, we skip the opener and closer, but keep the text in between
-    stack = []
-
-    for match in TOKEN_PATTERN.finditer(field_text):
-        start = match.start()
-        end = match.end()
-        token = match.group(0)      # e.g. "{{c10::" or "}}"
-        idx_str = match.group(2)    # e.g. "10" if opener, None if closer
-
-        # Always copy the literal text from last_pos to start
-        # (unless we have some future reason to skip it, but we do NOT skip text).
-        result.append(field_text[last_pos:start])
-
-        if token.startswith("{{c"):
-            # It's an opener: {{cX::
-            idx = int(idx_str)
-            if idx > 9:
-                # We do NOT keep the markup (opener), but keep the text inside
-                # So push (idx, False) => skip the opener & closer tokens
-                stack.append((idx, False))
-            else:
-                # Keep it as-is
-                stack.append((idx, True))
-                result.append(token)
-        else:
-            # It's a closer: "}}"
-            if stack:
-                top_idx, keep_markup = stack.pop()
-                if keep_markup:
-                    # If we decided to keep it, append the closer
-                    result.append(token)
-            else:
-                # A stray closer (no opener on the stack)
-                # We'll just keep it for safety (uncommon scenario)
-                result.append(token)
-
-        last_pos = end
-
-    # Append any trailing text after the last token
-    result.append(field_text[last_pos:])
-
-    return "".join(result)
-
-###############################################################################
-# 2) AnkiConnect helper
-###############################################################################
-def invoke(action, **params):
-    payload = {"action": action, "version": 6, "params": params}
-    response = requests.post("http://localhost:8765", json=payload).json()
-    if response.get("error"):
-        raise Exception(f"AnkiConnect error: {response['error']}")
-    return response["result"]
+    return remove_high_index_markup(parse_field(field_text), max_index=9)
 
 ###############################################################################
 # 3) Main script that processes all notes
 ###############################################################################
-def main():
+def main(
+    resume: bool = False,
+    checkpoint_path: str = None,
+    incremental: bool = False,
+    watermark_path: str = None,
+    change_log_path: str = DEFAULT_CHANGE_LOG,
+):
+    from tqdm import tqdm
+
     print("Finding all notes in your collection...")
-    note_ids = invoke("findNotes", query="deck:*")  # or "deck:MyDeck" etc.
+    query = "deck:*"  # or "deck:MyDeck" etc.
+    watermark = open_watermark(watermark_path, "clip_to_index_9", query)
+    checkpoint = open_checkpoint(checkpoint_path, "clip_to_index_9", query, resume)
+    note_ids = watermark.find_notes(incremental, checkpoint.started_at)
+    checkpoint.started_at = watermark.started_at
     print(f"Found {len(note_ids)} notes.\n")
 
-    updated_count = 0
-    batch_size = 50
+    writer = NoteWriter(queue_depth=WRITE_QUEUE_DEPTH, on_written=checkpoint.mark_written)
+    batch_size = BATCH_SIZE  # initial size, adapted by fetch_batches
+    if resume:
+        replayed = replay_pending(checkpoint, writer)
+        note_ids = checkpoint.remaining(note_ids)
+        print(f"Resuming: {len(checkpoint.processed)} notes already done, "
+              f"{replayed} unconfirmed updates re-sent, {len(note_ids)} left.\n")
 
     log_file_path = os.path.join(os.getcwd(), "removed_clozes_gt_9.txt")
-    with open(log_file_path, "w", encoding="utf-8") as log_file:
-        log_file.write("=== Removed Clozes with Index > 9 (Markup Only) ===\n\n")
+    # On resume the logs of the interrupted run are kept and extended
+    with open(log_file_path, "a" if resume else "w", encoding="utf-8") as log_file, \
+            ChangeLog(change_log_path, "clip", append=resume) as change_log:
+        writer.stream_failures(change_log.write_failure)
+        if not resume:
+            log_file.write("=== Removed Clozes with Index > 9 (Markup Only) ===\n\n")
 
         with tqdm(total=len(note_ids), desc="Processing", unit="note") as pbar:
-            for start_index in range(0, len(note_ids), batch_size):
-                batch_ids = note_ids[start_index : start_index + batch_size]
-                notes_info = invoke("notesInfo", notes=batch_ids)
-
+            # The next batches are prefetched while this one is processed
+            for notes_info in fetch_batches(note_ids, batch_size):
                 for note_info in notes_info:
                     note_id = note_info["noteId"]
                     fields = note_info["fields"]
@@ -125,14 +109,12 @@ def main():
 
                     # If changed, update the note in Anki + log the difference
                     if changed:
-                        invoke("updateNoteFields", note={
-                            "id": note_id,
-                            "fields": updated_fields
-                        })
-                        updated_count += 1
+                        checkpoint.add_pending(note_id, updated_fields)
+                        writer.update_fields(note_id, updated_fields)
 
                         log_file.write(f"Note ID: {note_id}\n")
                         for fname, (old_val, new_val) in changed_fields.items():
+                            change_log.change(note_id, fname, old_val, new_val)
                             log_file.write(f"  Field: {fname}\n")
                             log_file.write("    Before:\n")
                             log_file.write(f"      {old_val}\n\n")
@@ -142,7 +124,38 @@ def main():
 
                     pbar.update(1)
 
-    print(f"\nDone! Updated {updated_count} notes. See 'removed_clozes_gt_9.txt' for details.")
+                # One `multi` request writes the whole batch (in the background)
+                writer.flush()
+                checkpoint.batch_done(note_info["noteId"] for note_info in notes_info)
+
+        writer.close()
+        checkpoint.remove()
+        watermark.finish(writer.written_ids, [failed_id for failed_id, _ in writer.failures])
+        if writer.failures:
+            log_file.write(f"\n Write failures {len(writer.failures)}\n")
+            for failed_id, error in writer.failures:
+                log_file.write(f"  {failed_id}: {error}\n")
+
+    print(f"\nDone! Updated {writer.written} notes. See 'removed_clozes_gt_9.txt' for details.")
+    if writer.failures:
+        print(f"{len(writer.failures)} notes could not be updated.")
+    print_stats()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Remove the markup of clozes with index > 9.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from its checkpoint")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file (default: .clip_to_index_9.checkpoint.json)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process notes edited since the last run")
+    parser.add_argument("--watermark", default=None,
+                        help="Watermark file (default: .clip_to_index_9.watermark.json)")
+    parser.add_argument("--change-log", default=DEFAULT_CHANGE_LOG,
+                        help="JSONL change log; .gz / .zst names are compressed (default: %(default)s)")
+    add_collection_argument(parser)
+    args = parser.parse_args()
+    if args.collection and args.resume:
+        parser.error("--resume does not apply to --collection runs (they are one transaction)")
+    with collection_backend(args.collection):
+        main(args.resume, args.checkpoint, args.incremental, args.watermark, args.change_log)
@@ -0,0 +1,167 @@
+"""
+Ranked cloze combinations shared by the add-on and the AnkiConnect scripts.
+
+generate_combinations used to materialize every k-subset of the clozes, sort
+it twice (statistics.mean, then statistics.variance of the positions) and
+dedupe with list membership.  The same order is produced here lazily:
+
+  * subsets of size k are ranked by (variance, mean, lexicographic positions);
+    for integer positions that is the integer key
+    (k * sum(p*p) - sum(p)**2, sum(p), positions), so no floats are involved;
+  * subsets are generated span by span (max position - min position).  A
+    subset with span d has k * sum of squared deviations >= k * d*d / 2, so
+    once the best pending subset beats that bound for the next span it can be
+    yielded without looking at wider subsets.
+
+The caller stops pulling as soon as `limit` is reached, so only the spans
+needed to fill the limit are ever generated.
+
+The result only depends on the number of clozes and the limit, so plans are
+cached per (n, limit) as position tuples; the common ones are built at import.
+
+This module must not import anki/aqt: the AnkiConnect scripts run outside Anki.
+"""
+import heapq
+import itertools
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# The limit used by modify_clozes in the add-on and the scripts.
+DEFAULT_LIMIT = 10
+# Plans for up to this many distinct clozes are built when the module loads.
+PRECOMPUTED_MAX_N = 20
+
+Plan = Tuple[Tuple[int, ...], ...]
+_plans: Dict[Tuple[int, int], Plan] = {}
+
+
+def ranked_combinations(n: int, size: int) -> Iterator[Tuple[int, ...]]:
+    """
+    Yield the `size`-subsets of range(n) in the order of the original double
+    sort: by variance, then mean, then itertools.combinations order.
+    """
+    if size < 2 or size > n:
+        return
+
+    heap: List[Tuple[int, int, Tuple[int, ...]]] = []
+    for span in range(size - 1, n):
+        # Every subset of this span (or wider) has 2 * key >= size * span**2.
+        bound = size * span * span
+        while heap and 2 * heap[0][0] < bound:
+            yield heapq.heappop(heap)[2]
+
+        for low in range(0, n - span):
+            high = low + span
+            for inner in itertools.combinations(range(low + 1, high), size - 2):
+                positions = (low,) + inner + (high,)
+                s1 = sum(positions)
+                s2 = sum(p * p for p in positions)
+                heapq.heappush(heap, (size * s2 - s1 * s1, s1, positions))
+
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def generate_combination_positions(n: int, limit: int) -> List[Tuple[int, ...]]:
+    """
+    Same as generate_combinations, but over cloze positions 0..n-1.
+    """
+    positions: List[Tuple[int, ...]] = []
+    seen = set()
+
+    # Suffixes, shortest first
+    for i in reversed(range(1, n - 1)):
+        if len(positions) + n >= limit:
+            break
+        suffix = tuple(range(i, n))
+        if suffix not in seen:
+            seen.add(suffix)
+            positions.append(suffix)
+
+    if len(positions) + n < limit:
+        for size in range(2, n):
+            if len(positions) + n >= limit:
+                break
+            for combination in ranked_combinations(n, size):
+                if len(positions) + n >= limit:
+                    break
+                if combination not in seen:
+                    seen.add(combination)
+                    positions.append(combination)
+
+    # Add the final combination
+    final_comb = tuple(range(n))
+    if final_comb not in seen and n > 1:
+        positions.append(final_comb)
+
+    return positions
+
+
+def combination_plan(n: int, limit: int) -> Plan:
+    """Cached generate_combination_positions(n, limit)."""
+    key = (n, limit)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = tuple(generate_combination_positions(n, limit))
+    return plan
+
+
+def precompute_plans(limit: int = DEFAULT_LIMIT, max_n: int = PRECOMPUTED_MAX_N):
+    for n in range(max_n + 1):
+        combination_plan(n, limit)
+
+
+def generate_combinations(clozes: Sequence, limit: int) -> List[tuple]:
+    """
+    Generates all unique combinations of the clozes and returns them as a list.
+
+    The clozes must be distinct (they are the keys of find_clozes' dict).
+    """
+    return [
+        tuple(clozes[p] for p in combination)
+        for combination in combination_plan(len(clozes), limit)
+    ]
+
+
+###############################################################################
+# Applying combinations to a field
+###############################################################################
+def combination_wrappers(combinations: Iterable[tuple], first_index: int) -> Dict:
+    """
+    Map each cloze key to the new cloze numbers that must wrap it, outermost
+    first: combination i becomes cloze number first_index + i.
+    """
+    wrappers: Dict = {}
+    for comb_index, combination in enumerate(combinations):
+        for cloze_num in combination:
+            wrappers.setdefault(cloze_num, []).append(first_index + comb_index)
+    return wrappers
+
+
+def wrap_cloze(cloze_text: str, cloze_hint: str, new_indices: Sequence[int]) -> str:
+    """
+    Nest cloze_text inside one new cloze per index, e.g. with [4, 6]:
+    {{c1::x::h}} -> {{c4::{{c6::{{c1::x::h}}::h}}::h}}
+    """
+    prefix = "".join(f"{{{{c{index}::" for index in new_indices)
+    suffix = (f"::{cloze_hint}}}}}" if cloze_hint != "" else "}}") * len(new_indices)
+    return prefix + cloze_text + suffix
+
+
+def splice(text: str, edits: List[Tuple[int, int, str]]) -> str:
+    """
+    Replace text[start:end] for every (start, end, replacement) in one pass.
+    Edits are offsets into the original text and must not overlap.
+    """
+    if not edits:
+        return text
+    result = []
+    last_pos = 0
+    for start, end, replacement in sorted(edits):
+        result.append(text[last_pos:start])
+        result.append(replacement)
+        last_pos = end
+    result.append(text[last_pos:])
+    return "".join(result)
+
+
+precompute_plans()
@@ -0,0 +1,291 @@
+"""
+Single-pass cloze tokenizer shared by the maintenance scripts.
+
+A field is scanned once with TOKEN_PATTERN and turned into a small tree of
+ClozeNode objects (opener index, text offsets, nesting depth, trailing hint
+span).  The transforms below only walk that token list and copy literal
+slices of the original text, so each of them costs one pass over the field.
+
+This module must not import anki/aqt: the AnkiConnect scripts run outside Anki.
+"""
+import hashlib
+import re
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+###############################################################################
+# Tokenizer
+###############################################################################
+# We look for:
+#   1) An opener of the form {{c(\d+)::  (capturing the index)
+#   2) A closer of the form }}
+# Anything else is literal text that we preserve as-is.
+TOKEN_PATTERN = re.compile(r"\{\{c(\d+)::|\}\}")
+
+
+class ClozeNode:
+    """
+    One {{cX:: ... }} cloze inside a field.
+
+    Offsets index into ParsedField.text:
+      text[start:content_start]      -> the opener, e.g. "{{c3::"
+      text[content_start:content_end] -> everything up to the closer
+      text[hint_start:content_end]   -> trailing '::hint' segments (may be empty)
+      text[content_end:end]          -> the closer "}}"
+
+    An opener without a matching closer keeps content_end/end/hint_start = None.
+    """
+
+    __slots__ = (
+        "label",
+        "index",
+        "start",
+        "content_start",
+        "content_end",
+        "end",
+        "hint_start",
+        "depth",
+        "parent",
+        "children",
+    )
+
+    def __init__(self, label: str, start: int, content_start: int, parent, depth: int):
+        self.label = label  # index exactly as written, e.g. "07"
+        self.index = int(label)
+        self.start = start
+        self.content_start = content_start
+        self.content_end: Optional[int] = None
+        self.end: Optional[int] = None
+        self.hint_start: Optional[int] = None
+        self.depth = depth
+        self.parent: Optional["ClozeNode"] = parent
+        self.children: List["ClozeNode"] = []
+
+    @property
+    def closed(self) -> bool:
+        return self.end is not None
+
+    def __repr__(self):
+        return f"ClozeNode(c{self.label}, {self.start}:{self.end}, depth={self.depth})"
+
+
+# (start, end, node, is_opener); node is None for a stray closer.
+Token = Tuple[int, int, Optional[ClozeNode], bool]
+
+
+class ParsedField:
+    """The result of parse_field: the original text plus its cloze tokens and tree."""
+
+    __slots__ = ("text", "tokens", "roots", "nodes")
+
+    def __init__(self, text: str, tokens: List[Token], roots, nodes):
+        self.text = text
+        self.tokens = tokens
+        self.roots: List[ClozeNode] = roots
+        self.nodes: List[ClozeNode] = nodes
+
+    @property
+    def has_clozes(self) -> bool:
+        return bool(self.nodes)
+
+
+def trailing_hint_start(text: str, lo: int, hi: int) -> int:
+    """
+    Return the offset where the trailing '::hint' segments of text[lo:hi] begin,
+    or hi if there are none.
+
+    Equivalent to repeatedly stripping r'::[^:\\}]+$' from text[lo:hi], but done
+    with rfind on the original string instead of building new strings.
+    """
+    while True:
+        colon = text.rfind(":", lo, hi)
+        # The hint must be non-empty, preceded by "::", and free of '}'.
+        if (
+            colon <= lo
+            or colon + 1 >= hi
+            or text[colon - 1] != ":"
+            or text.find("}", colon + 1, hi) != -1
+        ):
+            return hi
+        hi = colon - 1
+
+
+def parse_field(text: str) -> ParsedField:
+    """
+    Scan `text` once and return its cloze tokens and node tree.
+
+    Openers always open a new node; a closer closes the innermost open node,
+    or is recorded as stray (node None) when nothing is open.
+    """
+    tokens: List[Token] = []
+    roots: List[ClozeNode] = []
+    nodes: List[ClozeNode] = []
+    stack: List[ClozeNode] = []
+    last_pos = 0
+
+    for match in TOKEN_PATTERN.finditer(text):
+        start, end = match.span()
+        label = match.group(1)
+
+        if label is not None:
+            parent = stack[-1] if stack else None
+            node = ClozeNode(label, start, end, parent, len(stack))
+            if parent is None:
+                roots.append(node)
+            else:
+                parent.children.append(node)
+            nodes.append(node)
+            stack.append(node)
+            tokens.append((start, end, node, True))
+        elif stack:
+            node = stack.pop()
+            node.content_end = start
+            node.end = end
+            node.hint_start = trailing_hint_start(text, last_pos, start)
+            tokens.append((start, end, node, False))
+        else:
+            tokens.append((start, end, None, False))
+
+        last_pos = end
+
+    return ParsedField(text, tokens, roots, nodes)
+
+
+def markup_free_digest(text: str) -> bytes:
+    """
+    Digest of remove_cloze_markup(text), hashed slice by slice without
+    building the node tree or the normalized string.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    depth = 0
+    last_pos = 0
+
+    for match in TOKEN_PATTERN.finditer(text):
+        if match.group(1) is not None:
+            depth += 1
+        elif depth:
+            depth -= 1
+        else:
+            continue  # stray closers stay in the text
+        start, end = match.span()
+        hasher.update(text[last_pos:start].encode("utf-8"))
+        last_pos = end
+
+    hasher.update(text[last_pos:].encode("utf-8"))
+    return hasher.digest()
+
+
+def _as_parsed(field: Union[str, ParsedField]) -> ParsedField:
+    return field if isinstance(field, ParsedField) else parse_field(field)
+
+
+###############################################################################
+# Rebuilding
+###############################################################################
+def rebuild(
+    parsed: ParsedField,
+    render_open: Callable[[ClozeNode], str],
+    render_close: Callable[[ClozeNode], Optional[str]],
+) -> str:
+    """
+    Emit the field once, copying literal text between tokens unchanged.
+
+    render_open(node) returns the replacement for an opener ("" drops it).
+    render_close(node) returns the replacement for a closer; "" drops only the
+    closer, None drops the closer *and* the trailing hints in front of it.
+    Stray closers are always kept.
+    """
+    text = parsed.text
+    result = []
+    last_pos = 0
+
+    for start, end, node, is_opener in parsed.tokens:
+        if node is None:
+            result.append(text[last_pos:end])
+        elif is_opener:
+            result.append(text[last_pos:start])
+            result.append(render_open(node))
+        else:
+            closer = render_close(node)
+            if closer is None:
+                result.append(text[last_pos : node.hint_start])
+            else:
+                result.append(text[last_pos:start])
+                result.append(closer)
+        last_pos = end
+
+    result.append(text[last_pos:])
+    return "".join(result)
+
+
+###############################################################################
+# Transforms
+###############################################################################
+def remove_cloze_markup(field: Union[str, ParsedField]) -> str:
+    """Drop every opener and matched closer, keeping the content (and stray '}}')."""
+    parsed = _as_parsed(field)
+    if not parsed.nodes:
+        return parsed.text
+    return rebuild(parsed, lambda node: "", lambda node: "")
+
+
+def remove_high_index_markup(field: Union[str, ParsedField], max_index: int = 9) -> str:
+    """Drop the markup of clozes whose index is above max_index, keeping their text."""
+    parsed = _as_parsed(field)
+    text = parsed.text
+
+    def render_open(node):
+        return "" if node.index > max_index else text[node.start : node.content_start]
+
+    def render_close(node):
+        return "" if node.index > max_index else "}}"
+
+    return rebuild(parsed, render_open, render_close)
+
+
+def remove_repeated_openers(field: Union[str, ParsedField]) -> str:
+    """
+    Drop an opener (and its closer) whose parent has the same index and was kept,
+    e.g. {{c7::{{c7::x}}}} -> {{c7::x}}.
+    """
+    parsed = _as_parsed(field)
+    text = parsed.text
+    repeated: Dict[ClozeNode, bool] = {}
+
+    def render_open(node):
+        parent = node.parent
+        is_repeated = (
+            parent is not None and parent.label == node.label and not repeated[parent]
+        )
+        repeated[node] = is_repeated
+        return "" if is_repeated else text[node.start : node.content_start]
+
+    def render_close(node):
+        return "" if repeated[node] else "}}"
+
+    return rebuild(parsed, render_open, render_close)
+
+
+def strip_to_base_cloze(field: Union[str, ParsedField], max_base_index: int = 5) -> str:
+    """
+    Collapse nested clozes into one cloze using the smallest index of the chain.
+
+    Only the node whose index equals the base writes markup (and keeps its
+    hints); every other node loses its opener, closer and trailing hints.
+    Chains whose base is above max_base_index lose all markup.
+    """
+    parsed = _as_parsed(field)
+    written: Dict[ClozeNode, bool] = {}
+    bases: Dict[ClozeNode, int] = {}
+
+    def render_open(node):
+        parent = node.parent
+        base = node.index if parent is None else min(bases[parent], node.index)
+        bases[node] = base
+        is_written = base <= max_base_index and node.index == base
+        written[node] = is_written
+        return f"{{{{c{base}::" if is_written else ""
+
+    def render_close(node):
+        return "}}" if written[node] else None
+
+    return rebuild(parsed, render_open, render_close)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Run several maintenance scripts as one pass over the deck.
+
+Each note is fetched once with notesInfo, every selected stage is applied to
+its fields in memory (in the given order), and the note is written back once
+with updateNoteFields (one `multi` request per batch).  Stages reuse the
+transforms of the standalone scripts:
+
+  remedy      remedy_nested_clozes.remove_same_index_duplicate_clozes
+  clip        clip_to_index_9.remove_clozes_index_gt_9_keep_content
+  strip       strip_cloze_preview.strip_nested_baseindex_hint
+  hints       remove_redundant_hints.remove_hint_occurrences
+  consistent  make_all_clozes_consistent.modify_clozes
+
+With --workers N the stages run in a process pool, one notesInfo batch per
+task; results are consumed in batch order, so the log and the writes are the
+same as with a single process.
+
+Usage:
+  python maintenance_pipeline.py --query "deck:0Top::Studying" remedy clip hints consistent
+"""
+import argparse
+import copy
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+try:
+    from . import (
+        clip_to_index_9,
+        make_all_clozes_consistent,
+        remedy_nested_clozes,
+        remove_redundant_hints,
+        strip_cloze_preview,
+    )
+    from .anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from .change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from .checkpoint import open_checkpoint, replay_pending
+    from .watermark import open_watermark
+    from .sqlite_backend import add_collection_argument, collection_backend
+except ImportError:  # run as a standalone script
+    import clip_to_index_9
+    import make_all_clozes_consistent
+    import remedy_nested_clozes
+    import remove_redundant_hints
+    import strip_cloze_preview
+    from anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from checkpoint import open_checkpoint, replay_pending
+    from watermark import open_watermark
+    from sqlite_backend import add_collection_argument, collection_backend
+
+###############################################################################
+# Configuration
+###############################################################################
+DECK_QUERY = "deck:0Top::Studying"
+
+# Fields are handled as an ordered {field_name: value} mapping.
+Fields = Dict[str, str]
+
+
+class StageFailed(Exception):
+    pass
+
+
+###############################################################################
+# Stages: each takes the current fields and returns the new fields.
+# A stage must not mutate its input.
+###############################################################################
+def _per_field(transform: Callable[[str], str], skip: Callable[[str], bool]):
+    def stage(fields: Fields) -> Fields:
+        return {
+            name: value if skip(name) else transform(value)
+            for name, value in fields.items()
+        }
+
+    return stage
+
+
+def consistent_stage(fields: Fields) -> Fields:
+    """Strip nested clozes and re-nest them, as make_all_clozes_consistent.main does."""
+    if any(make_all_clozes_consistent.should_skip_field(name) for name in fields):
+        return fields
+
+    note_data = {
+        "fields": [{"name": name, "value": value} for name, value in fields.items()]
+    }
+    try:
+        make_all_clozes_consistent.modify_clozes(note_data)
+    except make_all_clozes_consistent.WronglyFormatted as e:
+        raise StageFailed("consistent") from e
+    return {fd["name"]: fd["value"] for fd in note_data["fields"]}
+
+
+STAGES: Dict[str, Callable[[Fields], Fields]] = {
+    "remedy": _per_field(
+        remedy_nested_clozes.remove_same_index_duplicate_clozes, lambda name: False
+    ),
+    "clip": _per_field(
+        clip_to_index_9.remove_clozes_index_gt_9_keep_content,
+        lambda name: name == "Occlusion",
+    ),
+    "strip": _per_field(
+        strip_cloze_preview.strip_nested_baseindex_hint,
+        strip_cloze_preview.should_skip_field,
+    ),
+    "hints": _per_field(
+        remove_redundant_hints.remove_hint_occurrences,
+        remove_redundant_hints.should_skip_field,
+    ),
+    "consistent": consistent_stage,
+}
+DEFAULT_STAGES = ["remedy", "clip", "strip", "hints", "consistent"]
+
+
+def run_stages(fields: Fields, stage_names: List[str], failures: list) -> Fields:
+    """
+    Apply the named stages in order.  A stage that fails leaves the fields as
+    they were before it and is recorded in `failures`; later stages still run.
+    """
+    for stage_name in stage_names:
+        try:
+            fields = STAGES[stage_name](fields)
+        except StageFailed:
+            failures.append((stage_name, copy.deepcopy(fields)))
+    return fields
+
+
+# (note_id, old_fields, new_fields, [(stage_name, fields_before_stage), ...])
+NoteResult = Tuple[int, Fields, Fields, list]
+
+
+def transform_batch(notes_info: list, stage_names: List[str]) -> Tuple[list, float]:
+    """
+    Run the stages over one notesInfo batch.  Pure function of its arguments,
+    so it can run in a worker process.  Returns the per-note results and the
+    seconds spent transforming.
+    """
+    start = time.perf_counter()
+    results: List[NoteResult] = []
+    for note_info in notes_info:
+        old_fields = {name: data["value"] for name, data in note_info["fields"].items()}
+        note_failures: list = []
+        new_fields = run_stages(old_fields, stage_names, note_failures)
+        results.append((note_info["noteId"], old_fields, new_fields, note_failures))
+    return results, time.perf_counter() - start
+
+
+def transformed_batches(
+    batches: Iterable[list], stage_names: List[str], workers: int, timings: list
+) -> Iterator[List[NoteResult]]:
+    """
+    Yield transform_batch results in batch order, using `workers` processes
+    when workers > 1.  At most 2 * workers batches are in flight, so memory
+    stays bounded.  The transform time of each batch is appended to `timings`.
+    """
+    if workers <= 1:
+        for notes_info in batches:
+            results, seconds = transform_batch(notes_info, stage_names)
+            timings.append(seconds)
+            yield results
+        return
+
+    # The prefetch and writer threads are already running: a forked worker
+    # would inherit their locks in whatever state they happen to be in.
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=spawn) as executor:
+        in_flight: deque = deque()
+        for notes_info in batches:
+            in_flight.append(executor.submit(transform_batch, notes_info, stage_names))
+            if len(in_flight) >= 2 * workers:
+                results, seconds = in_flight.popleft().result()
+                timings.append(seconds)
+                yield results
+        while in_flight:
+            results, seconds = in_flight.popleft().result()
+            timings.append(seconds)
+            yield results
+
+
+###############################################################################
+# MAIN
+###############################################################################
+def main(
+    query: str = DECK_QUERY,
+    stage_names: List[str] = DEFAULT_STAGES,
+    queue_depth: int = WRITE_QUEUE_DEPTH,
+    workers: int = 1,
+    resume: bool = False,
+    checkpoint_path: str = None,
+    incremental: bool = False,
+    watermark_path: str = None,
+    batch_size: int = BATCH_SIZE,
+    change_log_path: str = DEFAULT_CHANGE_LOG,
+):
+    from tqdm import tqdm
+
+    unknown = [name for name in stage_names if name not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stage(s): {', '.join(unknown)}")
+
+    # Runs with other stages keep their own checkpoint and watermark
+    run_name = "maintenance_pipeline"
+    if list(stage_names) != DEFAULT_STAGES:
+        run_name += "-" + "-".join(stage_names)
+    watermark = open_watermark(watermark_path, run_name, query)
+    checkpoint = open_checkpoint(checkpoint_path, run_name, query, resume)
+    note_ids = watermark.find_notes(incremental, checkpoint.started_at)
+    checkpoint.started_at = watermark.started_at
+    print(f"Found {len(note_ids)} notes for query '{query}'.")
+    print(f"Stages: {' -> '.join(stage_names)}")
+
+    writer = NoteWriter(queue_depth=queue_depth, on_written=checkpoint.mark_written)
+    if resume:
+        replayed = replay_pending(checkpoint, writer)
+        note_ids = checkpoint.remaining(note_ids)
+        print(f"Resuming: {len(checkpoint.processed)} notes already done, "
+              f"{replayed} unconfirmed updates re-sent, {len(note_ids)} left.")
+    if not note_ids:
+        writer.close()
+        checkpoint.remove()
+        watermark.finish(writer.written_ids, [])
+        return
+
+    timings: List[float] = []
+    start_time = time.perf_counter()
+    log_path = os.path.join(os.getcwd(), "modified_notes.txt")
+
+    # On resume the logs of the interrupted run are kept and extended
+    with open(log_path, "a" if resume else "w", encoding="utf-8") as log_file, ChangeLog(
+        change_log_path, "+".join(stage_names), append=resume
+    ) as change_log:
+        writer.stream_failures(change_log.write_failure)
+        if not resume:
+            log_file.write("=== Modified Notes Log ===\n\n")
+
+        with tqdm(total=len(note_ids), desc="Processing", unit="note") as pbar:
+            batches = fetch_batches(note_ids, batch_size, prefetch=queue_depth)
+            for results in transformed_batches(batches, stage_names, workers, timings):
+                for note_id, old_fields, new_fields, note_failures in results:
+                    for stage_name, fields in note_failures:
+                        change_log.failure(
+                            note_id, "stage failed", stage=stage_name, fields=fields
+                        )
+
+                    changed_fields = {
+                        name: value
+                        for name, value in new_fields.items()
+                        if value != old_fields[name]
+                    }
+                    if changed_fields:
+                        checkpoint.add_pending(note_id, changed_fields)
+                        writer.update_fields(note_id, changed_fields)
+
+                        log_file.write(f"Note ID: {note_id}\n")
+                        for fname, new_val in changed_fields.items():
+                            change_log.change(note_id, fname, old_fields[fname], new_val)
+                            log_file.write(f"  Field: {fname}\n")
+                            log_file.write("    Before:\n")
+                            log_file.write(f"      {old_fields[fname]}\n\n")
+                            log_file.write("    After:\n")
+                            log_file.write(f"      {new_val}\n\n")
+                        log_file.write("=" * 60 + "\n\n")
+
+                    pbar.update(1)
+
+                writer.flush()
+                checkpoint.batch_done(note_id for note_id, *_ in results)
+
+        writer.close()
+        checkpoint.remove()
+        watermark.finish(
+            writer.written_ids, [failed_id for failed_id, _ in writer.failures]
+        )
+
+        log_file.write(f"\n Failures {change_log.failures} (see {change_log_path})\n")
+
+    elapsed = time.perf_counter() - start_time
+    transform_seconds = sum(timings)
+    print(f"Done! Updated {writer.written} notes. See '{log_path}' for details.")
+    # Share of the wall time the workers spent transforming (1.0 = always
+    # busy); low values mean the run waits on Anki, not on the transforms.
+    utilisation = transform_seconds / (elapsed * max(1, workers)) if elapsed else 0.0
+    print(
+        f"Transforms: {transform_seconds:.2f}s in {workers} worker(s) during "
+        f"{elapsed:.2f}s wall (worker utilisation {utilisation:.0%})"
+    )
+    print_stats()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run several cloze maintenance stages in one pass."
+    )
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        help=f"Stages to apply, in order: {', '.join(STAGES)} "
+        f"(default: {' '.join(DEFAULT_STAGES)})",
+    )
+    parser.add_argument("--query", default=DECK_QUERY, help="AnkiConnect search query")
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=WRITE_QUEUE_DEPTH,
+        help="Batches fetched ahead / written behind (0 = strictly sequential)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help=f"Initial notesInfo batch size, adapted to Anki's latency (default: {BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes used for the transforms (default: 1, in-process)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from its checkpoint",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="Checkpoint file (default: .maintenance_pipeline[-<stages>].checkpoint.json)",
+    )
+    parser.add_argument(
+        "--change-log",
+        default=DEFAULT_CHANGE_LOG,
+        help="JSONL change log; .gz / .zst names are compressed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process notes edited since the last run",
+    )
+    parser.add_argument(
+        "--watermark",
+        default=None,
+        help="Watermark file (default: .maintenance_pipeline[-<stages>].watermark.json)",
+    )
+    add_collection_argument(parser)
+    args = parser.parse_args()
+    # Not choices=: with nargs="*" Python < 3.12 also checks the empty default
+    unknown = [stage for stage in args.stages if stage not in STAGES]
+    if unknown:
+        parser.error(
+            f"unknown stage(s) {', '.join(unknown)}; choose from {', '.join(STAGES)}"
+        )
+    if args.collection and args.resume:
+        parser.error("--resume does not apply to --collection runs (they are one transaction)")
+    with collection_backend(args.collection):
+        main(
+            args.query,
+            args.stages or DEFAULT_STAGES,
+            args.queue_depth,
+            args.workers,
+            args.resume,
+            args.checkpoint,
+            args.incremental,
+            args.watermark,
+            args.batch_size,
+            args.change_log,
+        )
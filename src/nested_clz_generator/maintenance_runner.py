@@ -0,0 +1,122 @@
+"""
+Tools > Cloze maintenance: run the maintenance_pipeline stages inside Anki.
+
+The stages are the same transforms the AnkiConnect scripts use, but notes are
+read with col.find_notes / col.get_note and saved with col.update_notes in a
+background CollectionOp, so there is no JSON or HTTP round trip.  The whole
+run is one undo step.
+"""
+from typing import List
+
+from anki.collection import Collection, OpChanges
+from aqt import gui_hooks, mw
+from aqt.operations import CollectionOp
+from aqt.qt import QAction, QMenu, qconnect
+from aqt.utils import getText, tooltip
+
+from .cli import STAGE_COMMANDS
+from .maintenance_pipeline import DECK_QUERY, DEFAULT_STAGES, run_stages
+
+MENU_NAME = "Cloze maintenance"
+# Changed notes saved per update_notes call
+UPDATE_BATCH = 500
+# Notes processed between two progress updates
+PROGRESS_EVERY = 200
+
+
+class MaintenanceResult:
+    """What run_maintenance returns to CollectionOp (it only needs `changes`)."""
+
+    def __init__(self, changes: OpChanges, checked: int, updated: int, failed: int):
+        self.changes = changes
+        self.checked = checked
+        self.updated = updated
+        self.failed = failed
+
+
+def _update_progress(done: int, total: int):
+    mw.taskman.run_on_main(
+        lambda: mw.progress.update(
+            label=f"Cloze maintenance... {done}/{total}", value=done, max=total
+        )
+    )
+
+
+def run_maintenance(col: Collection, query: str, stage_names: List[str]) -> MaintenanceResult:
+    """
+    Apply the stages to every note matching query; runs in the background.
+    A failing stage leaves the note as it was before that stage, as in
+    maintenance_pipeline.
+    """
+    undo_entry = col.add_custom_undo_entry(f"{MENU_NAME}: {' + '.join(stage_names)}")
+    note_ids = col.find_notes(query)
+
+    pending = []
+    updated = failed = 0
+    for done, note_id in enumerate(note_ids, start=1):
+        note = col.get_note(note_id)
+        old_fields = dict(note.items())
+        stage_failures: list = []
+        new_fields = run_stages(old_fields, stage_names, stage_failures)
+        if stage_failures:
+            failed += 1
+
+        if new_fields != old_fields:
+            for name, value in new_fields.items():
+                note[name] = value
+            pending.append(note)
+            if len(pending) >= UPDATE_BATCH:
+                col.update_notes(pending)
+                updated += len(pending)
+                pending = []
+
+        if done % PROGRESS_EVERY == 0:
+            _update_progress(done, len(note_ids))
+
+    if pending:
+        col.update_notes(pending)
+        updated += len(pending)
+
+    changes = col.merge_undo_entries(undo_entry)
+    return MaintenanceResult(changes, len(note_ids), updated, failed)
+
+
+def _report(result: MaintenanceResult):
+    message = f"Checked {result.checked} notes, updated {result.updated}."
+    if result.failed:
+        message += f" {result.failed} notes failed a stage and were partly left unchanged."
+    tooltip(message, parent=mw)
+
+
+def run_stages_from_menu(stage_names: List[str]):
+    query, ok = getText(
+        f"Run {', '.join(stage_names)} on the notes matching:",
+        parent=mw,
+        default=DECK_QUERY,
+        title=MENU_NAME,
+    )
+    if not ok or not query.strip():
+        return
+
+    CollectionOp(
+        parent=mw, op=lambda col: run_maintenance(col, query, stage_names)
+    ).success(_report).run_in_background()
+
+
+def add_tools_menu():
+    menu = QMenu(MENU_NAME, mw)
+    for stage_name, help_text in STAGE_COMMANDS.items():
+        action = QAction(help_text, menu)
+        qconnect(action.triggered, lambda _=False, name=stage_name: run_stages_from_menu([name]))
+        menu.addAction(action)
+
+    menu.addSeparator()
+    action = QAction("Run all stages", menu)
+    qconnect(action.triggered, lambda: run_stages_from_menu(DEFAULT_STAGES))
+    menu.addAction(action)
+
+    mw.form.menuTools.addMenu(menu)
+
+
+def main():
+    gui_hooks.main_window_did_init.append(add_tools_menu)
@@ -1,16 +1,51 @@
 #!/usr/bin/env python3
+import argparse
 from typing import cast
-import requests
 import re
-import statistics
-import itertools
 import os
-from tqdm import tqdm
+
+try:
+    from .anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from .change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from .checkpoint import open_checkpoint, replay_pending
+    from .sqlite_backend import add_collection_argument, collection_backend
+    from .watermark import open_watermark
+    from .cloze_combinations import (
+        combination_wrappers,
+        generate_combinations,
+        splice,
+        wrap_cloze,
+    )
+    from .cloze_parser import parse_field, strip_to_base_cloze, trailing_hint_start
+except ImportError:  # run as a standalone script
+    from anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from checkpoint import open_checkpoint, replay_pending
+    from sqlite_backend import add_collection_argument, collection_backend
+    from watermark import open_watermark
+    from cloze_combinations import (
+        combination_wrappers,
+        generate_combinations,
+        splice,
+        wrap_cloze,
+    )
+    from cloze_parser import parse_field, strip_to_base_cloze, trailing_hint_start
 
 ###############################################################################
 # AnkiConnect config
 ###############################################################################
-ANKI_CONNECT_URL = "http://localhost:8765"
 
 ###############################################################################
 # Regex to match any single cloze (which may internally have nested clozes).
@@ -18,7 +53,7 @@ ANKI_CONNECT_URL = "http://localhost:8765"
 CLOZE_RE = r"\{\{c\d+::[\s\S]*?\}\}"
 
 # We define a maximum base index for which we KEEP cloze markup (<= 5 is OK).
-MAX_BASE_INDEX = 6
+MAX_BASE_INDEX = 5
 # We'll limit final cloze combos to 10, per your original code.
 COMBO_LIMIT = 10
 
@@ -42,10 +77,6 @@ def find_clozes_in_text(text: str):
     """
     return re.findall(CLOZE_RE, text)
 
-TOKEN_REGEX = re.compile(r'(\{\{c(\d+)::|\}\})')
-MAX_BASE_INDEX = 5
-TOKEN_PATTERN = re.compile(r"(\{\{c(\d+)::|\}\})", flags=re.DOTALL)
-
 def remove_all_trailing_hints(s: str) -> str:
     """
     Remove *all* trailing '::someHint' segments from the end of s,
@@ -56,12 +87,7 @@ def remove_all_trailing_hints(s: str) -> str:
       "some text::h1:extra" -> (unchanged, because 'h1:extra' has a colon)
       "some text" -> unchanged
     """
-    while True:
-        new_s = re.sub(r'::[^:\}]+$', '', s)
-        if new_s == s:
-            break
-        s = new_s
-    return s
+    return s[: trailing_hint_start(s, 0, len(s))]
 
 def strip_nested_to_base_cloze(field_text: str) -> str:
     """
@@ -81,66 +107,8 @@ def strip_nested_to_base_cloze(field_text: str) -> str:
       - {{c7::{{c2::nested::hint2::extra}}::outerHint}} => base=2 => => {{c2::nested::hint2::extra}}
         (outerHint is removed)
     """
+    return strip_to_base_cloze(parse_field(field_text), MAX_BASE_INDEX)
 
-    result = []
-    last_pos = 0
-
-    # Stack of (base_idx, is_written)
-    #  - base_idx = the min index so far in this snippet chain
-    #  - is_written = True => physically write this snippet's markup
-    stack = []
-
-    for match in TOKEN_PATTERN.finditer(field_text):
-        start = match.start()
-        end = match.end()
-        token = match.group(0)       # e.g. "{{c7::" or "}}"
-        idx_str = match.group(2)     # e.g. "7" if opener, else None
-
-        # Copy literal text from [last_pos..start)
-        result.append(field_text[last_pos:start])
-
-        if token.startswith("{{c"):
-            # It's an opener: {{cX::
-            x = int(idx_str)
-            if not stack:
-                # No parent snippet => base = x
-                base = x
-            else:
-                parent_base, _ = stack[-1]
-                base = min(parent_base, x)
-
-            # If base <= 9, we only physically write markup if x == base
-            if base <= MAX_BASE_INDEX and x == base:
-                stack.append((base, True))
-                # Actually write the opener
-                result.append(f"{{{{c{base}::")
-            else:
-                stack.append((base, False))
-
-        else:
-            # It's a closer "}}"
-            if stack:
-                base_idx, is_written = stack.pop()
-
-                if is_written and base_idx <= MAX_BASE_INDEX:
-                    # physically write the closer
-                    result.append("}}")
-                else:
-                    # remove all trailing hints from the last piece of text
-                    if result:
-                        result[-1] = remove_all_trailing_hints(result[-1])
-            else:
-                # Stray closer => keep literal
-                result.append(token)
-
-        last_pos = end
-
-    # leftover text
-    result.append(field_text[last_pos:])
-
-    return "".join(result)
-
-failures = []
 ###############################################################################
 # 3) find_clozes() as in your snippet (after we've stripped nested)
 ###############################################################################
@@ -152,7 +120,8 @@ def find_clozes(note):
     original_cloze_hints = {}
     for fld_index, field_dict in enumerate(note["fields"]):
         fld = field_dict["value"]
-        for cloze_match in re.findall(CLOZE_RE, fld):
+        for match in re.finditer(CLOZE_RE, fld):
+            cloze_match = match.group(0)
             res = cast(str, cloze_match).split("::")
             cloze_hint = ""
             try:
@@ -165,55 +134,21 @@ def find_clozes(note):
                     cloze_text = f"{cloze_num}::"+cloze_text+f"::{cloze_hint}"+"}}"
             except:
                 print(note)
-                failures.append(note)
                 raise WronglyFormatted
 
             if cloze_num not in clozes:
                 clozes[cloze_num] = []
 
-            clozes[cloze_num].append((fld_index, cloze_match, cloze_text, cloze_hint))
+            clozes[cloze_num].append(
+                (fld_index, cloze_match, cloze_text, cloze_hint, match.span())
+            )
             original_cloze_hints[cloze_text] = cloze_hint
     return clozes, original_cloze_hints
 
 ###############################################################################
 # 4) generate_combinations: same logic as your original
 ###############################################################################
-def generate_combinations(clozes, limit):
-    """
-    Generates all unique combinations of the clozes and returns them as a list.
-    """
-    combinations = []    
-    # Generate combinations in ascending order
-    for i in reversed(range(1, len(clozes)-1)):
-        if len(combinations) + len(clozes) >= limit:
-            break
-        combination = tuple(clozes[i:])
-        if combination not in combinations:
-            combinations.append(combination)
-            
-    if len(combinations) + len(clozes) < limit:
-        for i in range(2, len(clozes)):
-            choose_i = itertools.combinations(clozes, i)
-            choose_i = sorted(
-                choose_i,
-                key=lambda c: statistics.mean([clozes.index(cloze) for cloze in c]),
-            )
-            choose_i = sorted(
-                choose_i,
-                key=lambda c: statistics.variance([clozes.index(cloze) for cloze in c]),
-            )
-            for combination in choose_i:
-                if len(combinations) + len(clozes) >= limit:
-                    break
-                if combination not in combinations:
-                    combinations.append(combination)
-    
-    # Add the final combination
-    final_comb = tuple(clozes)
-    if final_comb not in combinations and len(clozes) > 1:
-        combinations.append(final_comb)
-                    
-    return combinations
+# Shared with the add-on, see cloze_combinations.generate_combinations
 
 class WronglyFormatted(Exception):
     pass
@@ -226,7 +161,8 @@ def modify_clozes(note):
        so only the smallest base index remains. 
        If base index > 5 => remove markup entirely.
     2) Re-scan for single clozes => generate combos
-    3) Wrap them in nested combos (like your original code).
+    3) Wrap them in nested combos (like your original code), rebuilding
+       each field once from the match offsets.
     """
     # Step A: strip in each non-"Occlusion" field
     for fd in note["fields"]:
@@ -243,58 +179,69 @@ def modify_clozes(note):
     cloze_keys = list(clozes.keys())
     combos = generate_combinations(cloze_keys, COMBO_LIMIT)
 
-    for comb_index, combo in enumerate(combos):
-        new_cloze = f"{{{{c{comb_index+len(clozes)+1}::"
-        for cloze_num in combo:
-            to_iterate_clozes = {(cloze_text, field_index): (field_index,cloze,cloze_hint) for field_index, cloze, cloze_text, cloze_hint in clozes[cloze_num]}
-            
-            
-            for (cloze_text,field_index),(field_index, cloze, cloze_hint) in to_iterate_clozes.items():
-                
-                
-                if original_hints[cloze_text] != "":
-                    replaced_str = f"{new_cloze}{cloze_text}::{original_hints[cloze_text]}" + "}}"
-                else:
-                    replaced_str = f"{new_cloze}{cloze_text}" + "}}"
-
-                # Update the field, if we're not skipping it
-                # Because maybe the snippet belongs to an "Occlusion" field => skip
-                if not should_skip_field(note["fields"][field_index]["name"]):
-                    old_field_val = note["fields"][field_index]["value"]
-                    new_field_val = old_field_val.replace(cloze_text, replaced_str, 1)
-                    note["fields"][field_index]["value"] = new_field_val
-
-###############################################################################
-# 6) AnkiConnect helper
-###############################################################################
-def invoke(action, **params):
-    payload = {"action": action, "version": 6, "params": params}
-    resp = requests.post(ANKI_CONNECT_URL, json=payload).json()
-    if resp.get("error"):
-        raise Exception(f"AnkiConnect error: {resp['error']}")
-    return resp["result"]
+    wrappers = combination_wrappers(combos, len(clozes) + 1)
+
+    # Collect every wrapping against the offsets of the stripped fields,
+    # then rebuild each field once.
+    edits = {}
+    for cloze_num, new_indices in wrappers.items():
+        for field_index, cloze, cloze_text, cloze_hint, (start, end) in clozes[cloze_num]:
+            # Because maybe the snippet belongs to an "Occlusion" field => skip
+            if should_skip_field(note["fields"][field_index]["name"]):
+                continue
+            # A hint containing "}" is rewritten by find_clozes, so cloze_text
+            # does not occur in the field and there is nothing to wrap.
+            if cloze_text != cloze:
+                continue
+            replaced_str = wrap_cloze(cloze_text, original_hints[cloze_text], new_indices)
+            edits.setdefault(field_index, []).append((start, end, replaced_str))
+
+    for field_index, field_edits in edits.items():
+        fd = note["fields"][field_index]
+        fd["value"] = splice(fd["value"], field_edits)
 
 ###############################################################################
 # 7) MAIN script to do everything
 ###############################################################################
-def main():
-    note_ids = invoke("findNotes", query="deck:0Top::Studying")
+def main(
+    resume: bool = False,
+    checkpoint_path: str = None,
+    incremental: bool = False,
+    watermark_path: str = None,
+    change_log_path: str = DEFAULT_CHANGE_LOG,
+):
+    from tqdm import tqdm
+
+    query = "deck:0Top::Studying"
+    watermark = open_watermark(watermark_path, "make_all_clozes_consistent", query)
+    checkpoint = open_checkpoint(checkpoint_path, "make_all_clozes_consistent", query, resume)
+    note_ids = watermark.find_notes(incremental, checkpoint.started_at)
+    checkpoint.started_at = watermark.started_at
     print(f"Found {len(note_ids)} notes in total.")
+
+    writer = NoteWriter(queue_depth=WRITE_QUEUE_DEPTH, on_written=checkpoint.mark_written)
+    if resume:
+        replayed = replay_pending(checkpoint, writer)
+        note_ids = checkpoint.remaining(note_ids)
+        print(f"Resuming: {len(checkpoint.processed)} notes already done, "
+              f"{replayed} unconfirmed updates re-sent, {len(note_ids)} left.")
     if not note_ids:
+        writer.close()
+        checkpoint.remove()
+        watermark.finish(writer.written_ids, [])
         return
 
-    BATCH_SIZE = 50
-    updated_count = 0
-
     log_path = os.path.join(os.getcwd(), "modified_notes.txt")
-    with open(log_path, "w", encoding="utf-8") as log_file:
-        log_file.write("=== Modified Notes Log ===\n\n")
+    # On resume the logs of the interrupted run are kept and extended
+    with open(log_path, "a" if resume else "w", encoding="utf-8") as log_file, \
+            ChangeLog(change_log_path, "consistent", append=resume) as change_log:
+        writer.stream_failures(change_log.write_failure)
+        if not resume:
+            log_file.write("=== Modified Notes Log ===\n\n")
 
         with tqdm(total=len(note_ids), desc="Processing", unit="note") as pbar:
-            for start_i in range(0, len(note_ids), BATCH_SIZE):
-                chunk = note_ids[start_i : start_i + BATCH_SIZE]
-                notes_info = invoke("notesInfo", notes=chunk)
-
+            # The next batches are prefetched while this one is processed
+            for notes_info in fetch_batches(note_ids, BATCH_SIZE):
                 for note_info in notes_info:
                     note_id = note_info["noteId"]
                     fields = note_info["fields"]
@@ -337,17 +284,15 @@ def main():
                             for i, fdict in enumerate(note_data["fields"]):
                                 fields_to_update[fdict["name"]] = fdict["value"]
 
-                            # Update in Anki
-                            invoke("updateNoteFields", note={
-                                "id": note_id,
-                                "fields": fields_to_update
-                            })
-                            updated_count += 1
+                            # Queue the update; the batch is written by writer.flush()
+                            checkpoint.add_pending(note_id, fields_to_update)
+                            writer.update_fields(note_id, fields_to_update)
 
                             # Log before/after
                             log_file.write(f"Note ID: {note_id}\n")
                             for i, fdict in enumerate(note_data["fields"]):
                                 if old_vals[i] != new_vals[i]:
+                                    change_log.change(note_id, fdict["name"], old_vals[i], new_vals[i])
                                     log_file.write(f"  Field: {fdict['name']}\n")
                                     log_file.write("    Before:\n")
                                     log_file.write(f"      {old_vals[i]}\n\n")
@@ -355,17 +300,38 @@ def main():
                                     log_file.write(f"      {new_vals[i]}\n\n")
                             log_file.write("="*60 + "\n\n")
                     except WronglyFormatted:
-                        failures.append(note_data)
-                        pass
+                        change_log.failure(note_id, "wrongly formatted cloze")
 
                     pbar.update(1)
 
-        log_file.write(f"\n Failures {len(failures)}\n")
-        for failure in failures:
-            log_file.write(str(failure))
-            log_file.write("\n")
+                # One `multi` request writes the whole batch (in the background)
+                writer.flush()
+                checkpoint.batch_done(note_info["noteId"] for note_info in notes_info)
+
+        writer.close()
+        checkpoint.remove()
+        watermark.finish(writer.written_ids, [failed_id for failed_id, _ in writer.failures])
+
+        log_file.write(f"\n Failures {change_log.failures} (see {change_log_path})\n")
 
-    print(f"Done! Updated {updated_count} notes. See '{log_path}' for details.")
+    print(f"Done! Updated {writer.written} notes. See '{log_path}' for details.")
+    print_stats()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Re-nest the clozes of every note consistently.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from its checkpoint")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file (default: .make_all_clozes_consistent.checkpoint.json)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process notes edited since the last run")
+    parser.add_argument("--watermark", default=None,
+                        help="Watermark file (default: .make_all_clozes_consistent.watermark.json)")
+    parser.add_argument("--change-log", default=DEFAULT_CHANGE_LOG,
+                        help="JSONL change log; .gz / .zst names are compressed (default: %(default)s)")
+    add_collection_argument(parser)
+    args = parser.parse_args()
+    if args.collection and args.resume:
+        parser.error("--resume does not apply to --collection runs (they are one transaction)")
+    with collection_backend(args.collection):
+        main(args.resume, args.checkpoint, args.incremental, args.watermark, args.change_log)
@@ -1,11 +1,18 @@
 from anki.hooks import addHook
-from aqt import mw
+from aqt import gui_hooks, mw
 from aqt.utils import tooltip, tr
 
 from .consts import ANKI_VERSION_TUPLE
 
+# Resolved lazily by _ensure_models and dropped by invalidate_models whenever
+# the note types may have changed, so the editor hooks never query the
+# collection for them.
 _basic_note_type_ids = []
 _cloze_note_type_ids = []
+_basic_note_type_id_set = frozenset()
+_cloze_note_type_id_set = frozenset()
+_models = {}
+_models_loaded = False
 
 
 def model_ids_for_names(names):
@@ -16,7 +23,11 @@ def get_models():
     """Prepare note type"""
     global _basic_note_type_ids
     global _cloze_note_type_ids
+    global _basic_note_type_id_set
+    global _cloze_note_type_id_set
+    global _models_loaded
 
+    _models.clear()
     if ANKI_VERSION_TUPLE >= (2, 1, 45):
         _basic_note_type_ids = model_ids_for_names(
             ["Basic", tr.notetypes_basic_name()])
@@ -26,6 +37,9 @@ def get_models():
         from anki.lang import _
         _basic_note_type_ids = model_ids_for_names(["Basic", _("Basic")])
         _cloze_note_type_ids = model_ids_for_names(["Cloze", _("Cloze")])
+    _basic_note_type_id_set = frozenset(_basic_note_type_ids)
+    _cloze_note_type_id_set = frozenset(_cloze_note_type_ids)
+    _models_loaded = True
 
     if not _basic_note_type_ids:
         tooltip("[Automatic Basic to Cloze] Cannot find 'Basic' note type")
@@ -34,12 +48,65 @@ def get_models():
         tooltip("[Automatic Basic to Cloze] Cannot find 'Cloze' note type")
 
 
+def invalidate_models(*args):
+    """Forget the resolved note types; the next lookup resolves them again."""
+    global _models_loaded
+    _models_loaded = False
+    _models.clear()
+
+
+def _ensure_models():
+    if not _models_loaded and mw.col is not None:
+        get_models()
+
+
+def _on_operation_did_execute(changes, handler):
+    if changes.notetype:
+        invalidate_models()
+
+
 addHook("profileLoaded", get_models)
+addHook("unloadProfile", invalidate_models)
+if ANKI_VERSION_TUPLE >= (2, 1, 45):
+    gui_hooks.operation_did_execute.append(_on_operation_did_execute)
+else:
+    # Older versions report note type edits through the legacy hooks only
+    addHook("newModel", invalidate_models)
+    addHook("reset", invalidate_models)
 
 
 def get_basic_note_type_ids():
+    _ensure_models()
     return _basic_note_type_ids
 
 
 def get_cloze_note_type_ids():
+    _ensure_models()
     return _cloze_note_type_ids
+
+
+def is_basic_note_type(note_type_id) -> bool:
+    _ensure_models()
+    return note_type_id in _basic_note_type_id_set
+
+
+def is_cloze_note_type(note_type_id) -> bool:
+    _ensure_models()
+    return note_type_id in _cloze_note_type_id_set
+
+
+def get_model(note_type_id):
+    """mw.col.models.get, cached until the note types change."""
+    _ensure_models()
+    model = _models.get(note_type_id)
+    if model is None:
+        model = mw.col.models.get(note_type_id)
+        if model is not None:
+            _models[note_type_id] = model
+    return model
+
+
+def get_cloze_model():
+    """The model Basic notes with clozes are converted to, or None."""
+    cloze_ids = get_cloze_note_type_ids()
+    return get_model(cloze_ids[0]) if cloze_ids else None
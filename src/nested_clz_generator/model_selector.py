@@ -1,25 +1,22 @@
-import re
-
-from aqt import mw
-
-from .model_finder import get_basic_note_type_ids, get_cloze_note_type_ids
+from .model_finder import get_cloze_model, is_basic_note_type
+from .note_analysis import analyze_note
 
 clozeHideAllType = "Cloze (Hide all)"
 
 
 def target_model(note):
-    if note.note_type()['id'] not in get_basic_note_type_ids():
+    if not is_basic_note_type(note.mid):
         return None
 
+    analysis = analyze_note(note)
+
     # Cloze (Hide All) type
-    for _, val in note.items():
-        if re.search(r"\{\{c(\d+)::!", val):
-            return clozeHideAllType
+    if analysis.hide_all:
+        return clozeHideAllType
 
     # Basic cloze type
-    for _, val in note.items():
-        if re.search(r"\{\{c(\d+)::", val):
-            return mw.col.models.get(get_cloze_note_type_ids()[0]) if get_cloze_note_type_ids() else None
+    if analysis.has_openers:
+        return get_cloze_model()
 
     # None for no-change
     return None
@@ -0,0 +1,98 @@
+"""
+One scan of a note's fields for the add-card hook chain.
+
+convert_basic_to_cloze, target_model and modify_clozes all need to know which
+clozes a note has.  NoteAnalysis scans every field once with compiled
+patterns; inside `with note_analysis(note):` the result is cached on the note
+and reused by analyze_note for as long as the fields are the same strings.
+
+store_expansion / stored_expansion keep the result of modify_clozes next to
+the note, without changing its fields, until the note is actually added.
+"""
+import re
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Sequence
+
+CLOZE_RE = re.compile(r"\{\{c\d+::[\s\S]*?\}\}")
+OPENER_RE = re.compile(r"\{\{c(\d+)::")
+HIDE_ALL_RE = re.compile(r"\{\{c(\d+)::!")
+
+_CACHE_ATTR = "_nested_clz_analysis"
+_EXPANDED_ATTR = "_nested_clz_expanded"
+
+
+def _same_strings(fields: Sequence[str], scanned: Sequence[str]) -> bool:
+    return len(fields) == len(scanned) and all(
+        new is old for new, old in zip(fields, scanned)
+    )
+
+
+class NoteAnalysis:
+    """
+    What the hooks need to know about a note's fields:
+      cloze_matches[i] -> the CLOZE_RE matches of field i, in order
+      has_openers      -> some field contains a '{{cN::' opener
+      hide_all         -> some field contains a '{{cN::!' (Cloze (Hide all)) opener
+    """
+
+    __slots__ = ("fields", "cloze_matches", "has_openers", "hide_all")
+
+    def __init__(self, fields: Sequence[str]):
+        self.fields = tuple(fields)
+        self.cloze_matches: List[List[re.Match]] = []
+        self.has_openers = False
+        self.hide_all = False
+
+        for fld in self.fields:
+            matches = list(CLOZE_RE.finditer(fld))
+            self.cloze_matches.append(matches)
+            # Every cloze starts with an opener; only look again without one
+            if matches or OPENER_RE.search(fld):
+                self.has_openers = True
+                if not self.hide_all and "::!" in fld and HIDE_ALL_RE.search(fld):
+                    self.hide_all = True
+
+    @property
+    def has_clozes(self) -> bool:
+        return any(self.cloze_matches)
+
+    def is_current(self, fields: Sequence[str]) -> bool:
+        """True if `fields` are still the strings this analysis scanned."""
+        return _same_strings(fields, self.fields)
+
+
+def analyze_note(note) -> NoteAnalysis:
+    """The cached analysis of note, or a fresh one if there is none or the fields changed."""
+    analysis = getattr(note, _CACHE_ATTR, None)
+    if analysis is not None and analysis.is_current(note.fields):
+        return analysis
+    return NoteAnalysis(note.fields)
+
+
+@contextmanager
+def note_analysis(note) -> Iterator[NoteAnalysis]:
+    """Cache the analysis of note on it until the block ends."""
+    analysis = NoteAnalysis(note.fields)
+    setattr(note, _CACHE_ATTR, analysis)
+    try:
+        yield analysis
+    finally:
+        if getattr(note, _CACHE_ATTR, None) is analysis:
+            delattr(note, _CACHE_ATTR)
+
+
+def store_expansion(note, fields: Sequence[str], expanded: Sequence[str]):
+    """Keep `expanded`, the modify_clozes result for `fields`, on note."""
+    setattr(note, _EXPANDED_ATTR, (tuple(fields), list(expanded)))
+
+
+def stored_expansion(note) -> Optional[List[str]]:
+    """The stored expansion of note's fields, or None if they changed since."""
+    stored = getattr(note, _EXPANDED_ATTR, None)
+    if stored is None:
+        return None
+    fields, expanded = stored
+    # The editor saves equal text as new strings, so compare by value
+    if tuple(note.fields) != fields:
+        return None
+    return list(expanded)
@@ -1,14 +1,35 @@
 #!/usr/bin/env python3
-import re
-import requests
-from tqdm import tqdm
+import argparse
 import os
 
+try:
+    from .anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from .change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from .cloze_parser import parse_field, remove_repeated_openers
+    from .sqlite_backend import add_collection_argument, collection_backend
+    from .watermark import open_watermark
+except ImportError:  # run as a standalone script
+    from anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from cloze_parser import parse_field, remove_repeated_openers
+    from sqlite_backend import add_collection_argument, collection_backend
+    from watermark import open_watermark
+
 ###############################################################################
 # Configuration
 ###############################################################################
-ANKI_CONNECT_URL = "http://localhost:8765"  # Change if you run on a non-default port
-TOKEN_PATTERN = re.compile(r"(\{\{c(\d+)::|\}\})")
 
 ###############################################################################
 # 1) Remove repeated same-index clozes via a token-based approach
@@ -28,81 +49,39 @@ def remove_same_index_duplicate_clozes(field_text: str) -> str:
     closed yet are removed, along with their matching '}}'.
     """
 
-    result = []
-    last_pos = 0
-    stack = []  # will hold tuples of (index, is_repeated)
-
-    for match in TOKEN_PATTERN.finditer(field_text):
-        start = match.start()
-        end = match.end()
-        token = match.group(0)  # e.g. "{{c7::" or "}}"
-        idx = match.group(2)    # the cloze index if opener
-
-        # Include literal text before this token
-        result.append(field_text[last_pos:start])
-
-        if token.startswith("{{c"):
-            # It's an opener: {{cX::
-            if stack and stack[-1][0] == idx and stack[-1][1] is False:
-                # The same index is already "open" => repeated opener
-                # Mark this as repeated so we skip it and its matching closer
-                stack.append((idx, True))
-                # Do NOT add the token to the result
-            else:
-                # Normal opener
-                stack.append((idx, False))
-                result.append(token)
-        else:
-            # It's a closer: "}}"
-            if stack:
-                top_idx, is_repeated = stack.pop()
-                if not is_repeated:
-                    # If opener wasn't repeated, output the closer
-                    result.append(token)
-            else:
-                # No matching opener -> keep it as is (uncommon, but safe)
-                result.append(token)
-
-        last_pos = end
-
-    # Remainder of text after last token
-    result.append(field_text[last_pos:])
-
-    return "".join(result)
-
-###############################################################################
-# 2) AnkiConnect helper
-###############################################################################
-def invoke(action, **params):
-    payload = {"action": action, "version": 6, "params": params}
-    response = requests.post(ANKI_CONNECT_URL, json=payload).json()
-    if response.get("error"):
-        raise Exception(f"AnkiConnect error: {response['error']}")
-    return response["result"]
+    return remove_repeated_openers(parse_field(field_text))
 
 ###############################################################################
 # 3) Main script
 ###############################################################################
-def main():
+def main(
+    incremental: bool = False,
+    watermark_path: str = None,
+    change_log_path: str = DEFAULT_CHANGE_LOG,
+):
+    from tqdm import tqdm
+
     print("Finding all notes in your collection...")
-    note_ids = invoke("findNotes", query="deck:0Top::Studying")  # or "deck:MyDeck" etc.
+    query = "deck:0Top::Studying"  # or "deck:MyDeck" etc.
+    watermark = open_watermark(watermark_path, "remedy_nested_clozes", query)
+    note_ids = watermark.find_notes(incremental)
     print(f"Found {len(note_ids)} notes.\n")
 
-    updated_count = 0
-    batch_size = 50
+    writer = NoteWriter(queue_depth=WRITE_QUEUE_DEPTH)
+    batch_size = BATCH_SIZE  # initial size, adapted by fetch_batches
 
     # We'll write all modifications to this file in the current directory
     log_file_path = os.path.join(os.getcwd(), "modified_notes.txt")
 
-    with open(log_file_path, "w", encoding="utf-8") as log_file:
+    with open(log_file_path, "w", encoding="utf-8") as log_file, \
+            ChangeLog(change_log_path, "remedy") as change_log:
+        writer.stream_failures(change_log.write_failure)
         log_file.write("=== Modified Notes Log ===\n\n")
         
         # Process notes in batches
         with tqdm(total=len(note_ids), desc="Processing", unit="note") as pbar:
-            for start_index in range(0, len(note_ids), batch_size):
-                batch_ids = note_ids[start_index : start_index + batch_size]
-                notes_info = invoke("notesInfo", notes=batch_ids)
-
+            # The next batches are prefetched while this one is processed
+            for notes_info in fetch_batches(note_ids, batch_size):
                 for note_info in notes_info:
                     note_id = note_info["noteId"]
                     fields = note_info["fields"]
@@ -122,16 +101,13 @@ def main():
 
                     # If changed, update the note in Anki and record to log
                     if changed:
-                        # Update in Anki
-                        invoke("updateNoteFields", note={
-                            "id": note_id,
-                            "fields": updated_fields
-                        })
-                        updated_count += 1
+                        # Queue the update; the batch is written by writer.flush()
+                        writer.update_fields(note_id, updated_fields)
 
                         # Log changes
                         log_file.write(f"Note ID: {note_id}\n")
                         for fname, (old_val, new_val) in changed_fields.items():
+                            change_log.change(note_id, fname, old_val, new_val)
                             log_file.write(f"  Field: {fname}\n")
                             log_file.write("    Before:\n")
                             log_file.write(f"      {old_val}\n\n")
@@ -142,7 +118,30 @@ def main():
 
                     pbar.update(1)
 
-    print(f"\nDone! Updated {updated_count} notes. See 'modified_notes.txt' for details.")
+                # One `multi` request writes the whole batch (in the background)
+                writer.flush()
+
+        writer.close()
+        watermark.finish(writer.written_ids, [failed_id for failed_id, _ in writer.failures])
+        if writer.failures:
+            log_file.write(f"\n Write failures {len(writer.failures)}\n")
+            for failed_id, error in writer.failures:
+                log_file.write(f"  {failed_id}: {error}\n")
+
+    print(f"\nDone! Updated {writer.written} notes. See 'modified_notes.txt' for details.")
+    if writer.failures:
+        print(f"{len(writer.failures)} notes could not be updated.")
+    print_stats()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Remove repeated same-index cloze openers.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process notes edited since the last run")
+    parser.add_argument("--watermark", default=None,
+                        help="Watermark file (default: .remedy_nested_clozes.watermark.json)")
+    parser.add_argument("--change-log", default=DEFAULT_CHANGE_LOG,
+                        help="JSONL change log; .gz / .zst names are compressed (default: %(default)s)")
+    add_collection_argument(parser)
+    args = parser.parse_args()
+    with collection_backend(args.collection):
+        main(args.incremental, args.watermark, args.change_log)
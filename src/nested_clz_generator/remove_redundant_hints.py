@@ -1,25 +1,38 @@
 #!/usr/bin/env python3
+import argparse
+import bisect
 import re
-import requests
 import os
-from tqdm import tqdm
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from .anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from .change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from .watermark import open_watermark
+    from .sqlite_backend import add_collection_argument, collection_backend
+except ImportError:  # run as a standalone script
+    from anki_connect import (
+        BATCH_SIZE,
+        WRITE_QUEUE_DEPTH,
+        NoteWriter,
+        fetch_batches,
+        print_stats,
+    )
+    from change_log import DEFAULT_CHANGE_LOG, ChangeLog
+    from watermark import open_watermark
+    from sqlite_backend import add_collection_argument, collection_backend
 
 ###############################################################################
 # AnkiConnect configuration and deck selection
 ###############################################################################
-ANKI_CONNECT_URL = "http://localhost:8765"
 DECK_QUERY = "deck:0Top::Studying"  # Adjust as needed
 
-###############################################################################
-# AnkiConnect helper function
-###############################################################################
-def invoke(action, **params):
-    payload = {"action": action, "version": 6, "params": params}
-    resp = requests.post(ANKI_CONNECT_URL, json=payload).json()
-    if resp.get("error"):
-        raise Exception("AnkiConnect error: " + str(resp["error"]))
-    return resp["result"]
-
 ###############################################################################
 # Field skipping logic
 ###############################################################################
@@ -60,24 +73,210 @@ def extract_innermost_cloze_questions(text: str) -> set:
 ###############################################################################
 # Cloze marker processing and selective hint removal
 ###############################################################################
+# The question / hint of a cloze that extract_innermost_cloze_questions matches
+SIMPLE_QUESTION = re.compile(r"[^{}:]+")
+SIMPLE_HINT = re.compile(r"[^{}]+")
+
+
+class _OpenCloze:
+    """
+    A cloze whose closing '}}' has not been reached yet.
+
+    Text offsets:
+      text[start:question_start]          -> the opener, e.g. "{{c3::"
+      text[question_start:question_end]   -> the question (question_end is None
+                                             until the '::' of the hint or '}}')
+      text[question_end + 2:]             -> the hint, up to the closer
+
+    out_start / hint_out index the output pieces of the opener and of the '::'
+    that starts the hint.  simple_start / simple_end delimit the innermost
+    clozes found inside the question (see _scan).
+    """
+
+    __slots__ = (
+        "start",
+        "label",
+        "question_start",
+        "question_end",
+        "out_start",
+        "hint_out",
+        "simple_start",
+        "simple_end",
+        "question_clozes",
+        "hint_clozes",
+    )
+
+    def __init__(
+        self,
+        start: int,
+        label: str,
+        question_start: int,
+        out_start: int,
+        simple_start: int,
+    ):
+        self.start = start
+        self.label = label
+        self.question_start = question_start
+        self.question_end: Optional[int] = None
+        self.out_start = out_start
+        self.hint_out: Optional[int] = None
+        self.simple_start = simple_start
+        self.simple_end = simple_start
+        self.question_clozes = False  # nested clozes in the question
+        self.hint_clozes = False  # nested clozes in the hint
+
+
+def _scan(text: str, i: int, single: bool) -> Tuple[str, int]:
+    """
+    Iterative scanner behind process_text (single=False) and process_cloze
+    (single=True: stop after the cloze at i).
+
+    It jumps between '{{c', '::' and '}}' with str.find, copies the literal
+    runs as slices and keeps the open clozes on a stack.  Every closed cloze
+    that extract_innermost_cloze_questions would match is numbered in order and
+    indexed by its stripped question, so the innermost questions of a cloze
+    are the ones numbered between its opener and its '::', found with a
+    bisect instead of re-joining and re-matching its question.
+    """
+    n = len(text)
+    out: List[str] = []
+    stack: List[_OpenCloze] = []
+    innermost: Dict[str, List[int]] = {}
+    simple_count = 0
+    # Next occurrence of each token at or after i (n if there is none)
+    next_open = next_sep = next_close = -1
+
+    def hint_is_redundant(cloze: _OpenCloze, hint_end: int) -> bool:
+        hint_start = cloze.question_end + 2
+        if cloze.simple_end > cloze.simple_start:
+            # Innermost questions never contain '{', a nested cloze does
+            if cloze.hint_clozes:
+                return False
+            positions = innermost.get(text[hint_start:hint_end].strip())
+            if not positions:
+                return False
+            k = bisect.bisect_left(positions, cloze.simple_start)
+            return k < len(positions) and positions[k] < cloze.simple_end
+
+        # No innermost cloze: the hint must repeat the whole question, so a
+        # nested cloze ('{{c') has to be on both sides or on neither.
+        if cloze.question_clozes != cloze.hint_clozes:
+            return False
+        if not cloze.question_clozes:
+            question = text[cloze.question_start:cloze.question_end]
+            return question.strip() == text[hint_start:hint_end].strip()
+        question = "".join(out[cloze.out_start + 1:cloze.hint_out])
+        return question.strip() == "".join(out[cloze.hint_out + 1:]).strip()
+
+    while True:
+        if next_open < i:
+            next_open = text.find("{{c", i)
+            if next_open < 0:
+                next_open = n
+
+        if not stack:
+            j = next_open
+        else:
+            cloze = stack[-1]
+            if next_close < i:
+                next_close = text.find("}}", i)
+                if next_close < 0:
+                    next_close = n
+            j = min(next_open, next_close)
+            if cloze.question_end is None:
+                if next_sep < i:
+                    next_sep = text.find("::", i)
+                    if next_sep < 0:
+                        next_sep = n
+                j = min(j, next_sep)
+
+        if j > i:
+            out.append(text[i:j])
+        i = j
+        if i == n:
+            break
+
+        if i == next_open:
+            digits_end = i + 3
+            while digits_end < n and text[digits_end].isdigit():
+                digits_end += 1
+            if stack:
+                if stack[-1].question_end is None:
+                    stack[-1].question_clozes = True
+                else:
+                    stack[-1].hint_clozes = True
+            if not text.startswith("::", digits_end):
+                # Not well-formed: the rest of the text is kept unmodified.
+                out.append(text[i:])
+                i = n
+                break
+            stack.append(_OpenCloze(i, text[i + 3:digits_end], digits_end + 2, len(out), simple_count))
+            out.append(text[i:digits_end + 2])
+            i = digits_end + 2
+            continue
+
+        if i == next_sep and cloze.question_end is None:
+            # The hint separator
+            cloze.question_end = i
+            cloze.simple_end = simple_count
+            cloze.hint_out = len(out)
+            out.append("::")
+            i += 2
+            continue
+
+        # The closer of the innermost open cloze
+        hint_removed = False
+        if cloze.question_end is None:
+            cloze.question_end = i
+            simple_hint = True
+        else:
+            hint_removed = hint_is_redundant(cloze, i)
+            if hint_removed:
+                del out[cloze.hint_out:]
+            simple_hint = hint_removed or (
+                not cloze.hint_clozes
+                and SIMPLE_HINT.fullmatch(text, cloze.question_end + 2, i) is not None
+            )
+        out.append("}}")
+        stack.pop()
+
+        if (
+            simple_hint
+            and cloze.label.isdecimal()
+            and not cloze.question_clozes
+            and SIMPLE_QUESTION.fullmatch(text, cloze.question_start, cloze.question_end)
+        ):
+            question = text[cloze.question_start:cloze.question_end].strip()
+            innermost.setdefault(question, []).append(simple_count)
+            simple_count += 1
+
+        i += 2
+        if single and not stack:
+            return "".join(out), i
+
+    # End of text inside open clozes, innermost first: a cloze still in its
+    # question is kept unmodified, one in its hint gets its hint checked and
+    # a closing '}}'.
+    while stack:
+        cloze = stack.pop()
+        if cloze.question_end is None:
+            del out[cloze.out_start:]
+            out.append(text[cloze.start:])
+        else:
+            if hint_is_redundant(cloze, n):
+                del out[cloze.hint_out:]
+            out.append("}}")
+    return "".join(out), n
+
 def process_text(text: str, i: int = 0) -> str:
     """
     Processes the full text, scanning for cloze markers that start with exactly '{{c'
-    (with two opening braces). When found, delegates to process_cloze.
+    (with two opening braces), and removes their redundant hints (see process_cloze).
     Other text is passed through unchanged.
     """
-    result = []
-    while i < len(text):
-        # Look for a cloze marker that starts with exactly "{{" followed by 'c'
-        if text.startswith("{{", i) and text.startswith("{{c", i):
-            processed, i = process_cloze(text, i)
-            result.append(processed)
-        else:
-            result.append(text[i])
-            i += 1
-    return "".join(result)
+    return _scan(text, i, single=False)[0]
 
-def process_cloze(text: str, i: int) -> (str, int):
+def process_cloze(text: str, i: int) -> Tuple[str, int]:
     """
     Processes a cloze marker that starts at index i.
     
@@ -85,72 +284,11 @@ def process_cloze(text: str, i: int) -> (str, int):
         {{c<number>::<question>[::<hint>]}}
     
     This function returns a tuple: the processed cloze marker (with its hint removed
-    if the hint exactly matches one of the innermost cloze questions from the question part)
-    and the index position after the cloze marker.
+    if the hint exactly matches one of the innermost cloze questions from the question part,
+    or the whole question if it has none) and the index position after the cloze marker.
+    A marker that is not well-formed is returned unmodified up to the end of the text.
     """
-    start = i
-    i += 3  # Skip over "{{c"
-    
-    # Read cloze number (digits)
-    num_start = i
-    while i < len(text) and text[i].isdigit():
-        i += 1
-    cloze_num = text[num_start:i]
-    
-    # Expect the literal "::"
-    if not text.startswith("::", i):
-        # If not well-formed, return the remainder unmodified.
-        return text[start:], len(text)
-    i += 2  # Skip "::"
-    
-    # Collect the question part (which may include nested cloze markers)
-    question_parts = []
-    while i < len(text):
-        if text.startswith("}}", i):
-            # End of marker without a hint; return as is.
-            i += 2
-            return "{{c" + cloze_num + "::" + "".join(question_parts) + "}}", i
-        if text.startswith("::", i):
-            # Found a hint separator. Process the hint.
-            i += 2  # Skip the "::" starting the hint
-            hint_parts = []
-            while i < len(text):
-                if text.startswith("}}", i):
-                    break
-                if text.startswith("{{c", i):
-                    nested, i = process_cloze(text, i)
-                    hint_parts.append(nested)
-                else:
-                    hint_parts.append(text[i])
-                    i += 1
-            hint_text = "".join(hint_parts).strip()
-            
-            # Determine the innermost cloze questions from the question part.
-            inner_questions = extract_innermost_cloze_questions("".join(question_parts))
-            # If no nested cloze marker was found, treat the entire question as the innermost text.
-            if not inner_questions:
-                inner_questions = { "".join(question_parts).strip() }
-            
-            # Remove the hint (i.e. set final_hint to empty) only if it exactly matches one
-            # of the innermost cloze questions.
-            if hint_text in inner_questions:
-                final_hint = ""
-            else:
-                final_hint = "::" + "".join(hint_parts)
-            
-            # Skip the closing "}}"
-            if text.startswith("}}", i):
-                i += 2
-            return "{{c" + cloze_num + "::" + "".join(question_parts) + final_hint + "}}", i
-        if text.startswith("{{c", i):
-            # Process a nested cloze marker recursively.
-            nested, i = process_cloze(text, i)
-            question_parts.append(nested)
-        else:
-            question_parts.append(text[i])
-            i += 1
-    # If we exit the loop without encountering a proper closing, return the text unmodified.
-    return text[start:], i
+    return _scan(text, i, single=True)
 
 def remove_hint_occurrences(text: str) -> str:
     """
@@ -187,22 +325,31 @@ def process_note(note: dict) -> (dict, bool):
 ###############################################################################
 # MAIN script: Process notes, update Anki, and log modifications.
 ###############################################################################
-def main():
-    note_ids = invoke("findNotes", query=DECK_QUERY)
+def main(
+    incremental: bool = False,
+    watermark_path: str = None,
+    change_log_path: str = DEFAULT_CHANGE_LOG,
+):
+    from tqdm import tqdm
+
+    watermark = open_watermark(watermark_path, "remove_redundant_hints", DECK_QUERY)
+    note_ids = watermark.find_notes(incremental)
     print(f"Found {len(note_ids)} notes for deck query '{DECK_QUERY}'.")
     if not note_ids:
+        watermark.finish([], [])
         return
 
-    updated_count = 0
-    BATCH_SIZE = 50
+    writer = NoteWriter(queue_depth=WRITE_QUEUE_DEPTH)
     log_path = os.path.join(os.getcwd(), "modified_notes.txt")
     
-    with open(log_path, "w", encoding="utf-8") as log_file:
+    with open(log_path, "w", encoding="utf-8") as log_file, \
+            ChangeLog(change_log_path, "hints") as change_log:
+        writer.stream_failures(change_log.write_failure)
         log_file.write("=== Modified Notes Log ===\n\n")
         
-        for i in tqdm(range(0, len(note_ids), BATCH_SIZE), desc="Processing notes"):
-            batch_ids = note_ids[i:i+BATCH_SIZE]
-            notes_info = invoke("notesInfo", notes=batch_ids)
+        # Batch sizes adapt to Anki's latency, so count batches without a total
+        batches = fetch_batches(note_ids, BATCH_SIZE)
+        for notes_info in tqdm(batches, desc="Processing notes", unit="batch"):
             
             for note in notes_info:
                 note_id = note["noteId"]
@@ -218,18 +365,41 @@ def main():
                         if not should_skip_field(fname) and note["fields"][fname]["value"] != original_fields.get(fname, "")
                     }
                     if update_fields:
-                        invoke("updateNoteFields", note={"id": note_id, "fields": update_fields})
-                        updated_count += 1
+                        writer.update_fields(note_id, update_fields)
                         # Log the before/after changes
                         log_file.write(f"Note ID: {note_id}\n")
                         for fname, new_val in update_fields.items():
+                            change_log.change(note_id, fname, original_fields[fname], new_val)
                             log_file.write(f"Field: {fname}\n")
                             log_file.write("Before:\n" + original_fields[fname] + "\n")
                             log_file.write("After:\n" + new_val + "\n")
                             log_file.write("-" * 40 + "\n")
                         log_file.write("=" * 60 + "\n\n")
-                        
-    print(f"Done! Updated {updated_count} notes. See '{log_path}' for details.")
+
+            # One `multi` request writes the whole batch (in the background)
+            writer.flush()
+
+        writer.close()
+        watermark.finish(writer.written_ids, [failed_id for failed_id, _ in writer.failures])
+        if writer.failures:
+            log_file.write(f"\n Write failures {len(writer.failures)}\n")
+            for failed_id, error in writer.failures:
+                log_file.write(f"  {failed_id}: {error}\n")
+
+    print(f"Done! Updated {writer.written} notes. See '{log_path}' for details.")
+    if writer.failures:
+        print(f"{len(writer.failures)} notes could not be updated.")
+    print_stats()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Remove hints that repeat a cloze answer.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process notes edited since the last run")
+    parser.add_argument("--watermark", default=None,
+                        help="Watermark file (default: .remove_redundant_hints.watermark.json)")
+    parser.add_argument("--change-log", default=DEFAULT_CHANGE_LOG,
+                        help="JSONL change log; .gz / .zst names are compressed (default: %(default)s)")
+    add_collection_argument(parser)
+    args = parser.parse_args()
+    with collection_backend(args.collection):
+        main(args.incremental, args.watermark, args.change_log)
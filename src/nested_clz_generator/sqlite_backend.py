@@ -0,0 +1,480 @@
+"""
+Offline backend: edit a collection.anki2 file directly instead of going
+through AnkiConnect.
+
+SqliteClient answers the AnkiConnect actions the maintenance scripts use
+(findNotes, notesInfo, notesModTime, updateNoteFields, multi) from the
+collection's SQLite database, so fetch_batches, NoteWriter and the scripts
+work unchanged once it is installed with anki_connect.use_client().  Notes
+are read from the `notes` table and `flds` is split on \\x1f; updates set
+`flds`, `sfld`, `csum`, `mod` and `usn = -1` (so the next sync uploads them).
+Nothing is committed until the run finishes: collection_backend() commits
+all changes in one transaction, or rolls them back if the run fails.
+
+Cards are not touched.  When an update changes the cloze numbers of a Cloze
+note (`consistent` adds c(n+1)..., `clip` and `strip` remove numbers), Anki
+would add or delete cards but this backend does not.  Those notes are counted
+and reported at the end; open the collection in Anki afterwards and run
+Tools > Check Database (adds the missing cards) and Tools > Empty Cards
+(deletes the cards left without a cloze).
+
+Only a subset of the search syntax is understood by findNotes: space-separated
+`deck:` (with * wildcards and subdecks), `edited:N`, `nid:` and `note:`
+terms, optionally inside one pair of parentheses.  As in Anki, `edited:N`
+counts N days back from the collection's next day cutoff.
+
+Anki must be closed while a collection is edited, and the file should be
+backed up first.
+
+This module must not import anki/aqt: the AnkiConnect scripts run outside Anki.
+"""
+import contextlib
+import datetime
+import fnmatch
+import hashlib
+import html
+import json
+import os
+import pathlib
+import re
+import shlex
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    from .anki_connect import ActionStats, AnkiConnectError, use_client
+except ImportError:  # run as a standalone script
+    from anki_connect import ActionStats, AnkiConnectError, use_client
+
+FIELD_SEPARATOR = "\x1f"
+SECONDS_PER_DAY = 86400
+# Anki's defaults when the collection config does not set them
+DEFAULT_ROLLOVER_HOUR = 4
+DEFAULT_SCHED_VERSION = 2
+NOTETYPE_KIND_CLOZE = 1
+
+_CLOZE_NUMBER = re.compile(r"\{\{c(\d+)::")
+
+_IMG_SRC = re.compile(r"<img[^>]*?src=[\"']?([^\"'>\s]+)[^>]*>", re.IGNORECASE)
+_HTML_TAG = re.compile(r"<[^>]*>", re.DOTALL)
+
+
+def strip_html_preserving_media(text: str) -> str:
+    """Anki's sort field / checksum text: tags removed, image names kept."""
+    text = _IMG_SRC.sub(r" \1 ", text)
+    return html.unescape(_HTML_TAG.sub("", text)).strip()
+
+
+def field_checksum(first_field: str) -> int:
+    digest = hashlib.sha1(strip_html_preserving_media(first_field).encode("utf-8"))
+    return int(digest.hexdigest()[:8], 16)
+
+
+def cloze_numbers(fields: List[str]) -> set:
+    """The cloze numbers a Cloze note has cards for."""
+    return {int(number) for value in fields for number in _CLOZE_NUMBER.findall(value)}
+
+
+def _protobuf_uint(blob: bytes, wanted_field: int) -> int:
+    """Read a top-level varint field of a protobuf message (0 if absent)."""
+    position = 0
+
+    def varint() -> int:
+        nonlocal position
+        value = shift = 0
+        while True:
+            byte = blob[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    while position < len(blob):
+        key = varint()
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value = varint()
+            if field == wanted_field:
+                return value
+        elif wire_type == 1:
+            position += 8
+        elif wire_type == 2:
+            position += varint()
+        elif wire_type == 5:
+            position += 4
+        else:
+            break
+    return 0
+
+
+class Notetype:
+    __slots__ = ("name", "field_names", "field_ords", "sort_index", "is_cloze")
+
+    def __init__(self, name: str, field_names: List[str], sort_index: int, is_cloze: bool):
+        self.name = name
+        self.field_names = field_names
+        self.field_ords = {field_name: i for i, field_name in enumerate(field_names)}
+        self.sort_index = sort_index
+        self.is_cloze = is_cloze
+
+
+class SqliteClient:
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Collection '{path}' does not exist")
+        # mode=rw: sqlite3 would otherwise create an empty database at a
+        # mistyped path.  The prefetch and writer threads share the connection.
+        uri = pathlib.Path(path).absolute().as_uri() + "?mode=rw"
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        # Anki declares some columns with its own collation
+        self.conn.create_collation("unicase", _unicase)
+        self._lock = threading.RLock()
+        self.stats: Dict[str, ActionStats] = defaultdict(ActionStats)
+        self._last = threading.local()
+        self.changed = 0
+        # Cloze notes whose cloze numbers changed, so their cards are out of date
+        self.cards_out_of_date: set = set()
+        self.notetypes = self._load_notetypes()
+        self.decks = self._load_decks()
+
+    ###########################################################################
+    # Collection metadata (schema 11 keeps it as JSON in `col`, newer
+    # collections in the notetypes / fields / decks tables)
+    ###########################################################################
+    def _has_table(self, name: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).fetchone()
+        return row is not None
+
+    def _load_notetypes(self) -> Dict[int, Notetype]:
+        notetypes = {}
+        if self._has_table("notetypes"):
+            fields = defaultdict(list)
+            for ntid, ord_, name in self.conn.execute(
+                "SELECT ntid, ord, name FROM fields ORDER BY ntid, ord"
+            ):
+                fields[ntid].append(name)
+            for ntid, name, config in self.conn.execute(
+                "SELECT id, name, config FROM notetypes"
+            ):
+                sort_index = _protobuf_uint(config or b"", 2)
+                is_cloze = _protobuf_uint(config or b"", 1) == NOTETYPE_KIND_CLOZE
+                notetypes[ntid] = Notetype(name, fields[ntid], sort_index, is_cloze)
+        else:
+            (models,) = self.conn.execute("SELECT models FROM col").fetchone()
+            for mid, model in json.loads(models).items():
+                names = [f["name"] for f in sorted(model["flds"], key=lambda f: f["ord"])]
+                notetypes[int(mid)] = Notetype(
+                    model["name"],
+                    names,
+                    model.get("sortf", 0),
+                    model.get("type") == NOTETYPE_KIND_CLOZE,
+                )
+        return notetypes
+
+    def _load_decks(self) -> Dict[int, str]:
+        if self._has_table("decks"):
+            return {
+                did: name.replace(FIELD_SEPARATOR, "::")
+                for did, name in self.conn.execute("SELECT id, name FROM decks")
+            }
+        (decks,) = self.conn.execute("SELECT decks FROM col").fetchone()
+        return {int(did): deck["name"] for did, deck in json.loads(decks).items()}
+
+    def _config_value(self, key: str, default):
+        if self._has_table("config"):
+            row = self.conn.execute("SELECT val FROM config WHERE KEY = ?", (key,)).fetchone()
+            return json.loads(row[0]) if row is not None else default
+        (conf,) = self.conn.execute("SELECT conf FROM col").fetchone()
+        return json.loads(conf).get(key, default)
+
+    def next_day_at(self, now: float) -> int:
+        """
+        When Anki's current day ends: the next rollover hour in local time,
+        or for the v1 scheduler the next whole day since the collection's
+        creation (col.crt).
+        """
+        if self._config_value("schedVer", DEFAULT_SCHED_VERSION) == 1:
+            (crt,) = self.conn.execute("SELECT crt FROM col").fetchone()
+            return crt + (int(now - crt) // SECONDS_PER_DAY + 1) * SECONDS_PER_DAY
+
+        rollover = self._config_value("rollover", DEFAULT_ROLLOVER_HOUR)
+        local_now = datetime.datetime.fromtimestamp(now)
+        cutoff = local_now.replace(hour=rollover, minute=0, second=0, microsecond=0)
+        if cutoff <= local_now:
+            cutoff += datetime.timedelta(days=1)
+        return int(cutoff.timestamp())
+
+    ###########################################################################
+    # AnkiConnect-compatible interface
+    ###########################################################################
+    def invoke(self, action, **params):
+        handler = getattr(self, f"_action_{action}", None)
+        if handler is None:
+            raise AnkiConnectError(f"AnkiConnect error: unsupported action {action}")
+
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                result, payload_bytes = handler(**params)
+        except AnkiConnectError:
+            self._record(action, time.perf_counter() - start, error=True)
+            raise
+        seconds = time.perf_counter() - start
+        self._last.exchange = (seconds, payload_bytes)
+        self._record(action, seconds, payload_bytes=payload_bytes)
+        return result
+
+    def last_exchange(self) -> Tuple[float, int]:
+        """(seconds, bytes read or written) of this thread's last action."""
+        return getattr(self._last, "exchange", (0.0, 0))
+
+    def _record(self, action, seconds, error=False, payload_bytes=0):
+        with self._lock:
+            stats = self.stats[action]
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.errors += error
+            stats.bytes += payload_bytes
+
+    def format_stats(self) -> str:
+        lines = [f"SQLite collection {self.path}:"]
+        for action, stats in sorted(self.stats.items()):
+            avg_ms = 1000 * stats.seconds / stats.calls if stats.calls else 0.0
+            lines.append(
+                f"  {action:<20} {stats.calls:>6} calls  {stats.seconds:8.2f}s total"
+                f"  {avg_ms:8.1f}ms avg  {stats.bytes / 1e6:8.2f}MB"
+                f"  {stats.errors} errors"
+            )
+        lines.append(f"  {self.changed} notes changed (uncommitted until the run ends)")
+        if self.cards_out_of_date:
+            lines.append(f"  {len(self.cards_out_of_date)} of them need cards added or removed")
+        return "\n".join(lines)
+
+    def commit(self):
+        with self._lock:
+            if self.changed:
+                self.conn.execute("UPDATE col SET mod = ?", (int(time.time() * 1000),))
+            self.conn.commit()
+
+    def rollback(self):
+        with self._lock:
+            self.conn.rollback()
+            self.changed = 0
+            self.cards_out_of_date.clear()
+
+    def close(self):
+        """Close the connection; changes that were not committed are discarded."""
+        self.conn.close()
+
+    ###########################################################################
+    # Actions: each returns (result, bytes moved)
+    ###########################################################################
+    def _action_findNotes(self, query: str):
+        conditions, args = self._parse_query(query)
+        sql = "SELECT id FROM notes"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        note_ids = [row[0] for row in self.conn.execute(sql + " ORDER BY id", args)]
+        return note_ids, 8 * len(note_ids)
+
+    def _action_notesInfo(self, notes: List[int]):
+        rows = {row[0]: row for row in self._select_notes(notes)}
+        result = []
+        payload_bytes = 0
+        for note_id in notes:
+            row = rows.get(note_id)
+            if row is None:
+                result.append({})  # what AnkiConnect returns for unknown IDs
+                continue
+            _, mid, mod, tags, flds = row
+            notetype = self.notetypes[mid]
+            values = flds.split(FIELD_SEPARATOR)
+            result.append({
+                "noteId": note_id,
+                "modelName": notetype.name,
+                "tags": tags.split(),
+                "mod": mod,
+                "fields": {
+                    name: {"value": value, "order": order}
+                    for order, (name, value) in enumerate(zip(notetype.field_names, values))
+                },
+            })
+            payload_bytes += len(flds)
+        return result, payload_bytes
+
+    def _action_notesModTime(self, notes: List[int]):
+        rows = {row[0]: row[2] for row in self._select_notes(notes)}
+        result = [{"noteId": n, "mod": rows[n]} for n in notes if n in rows]
+        return result, 16 * len(result)
+
+    def _action_updateNoteFields(self, note: dict):
+        note_id = note["id"]
+        row = self.conn.execute(
+            "SELECT mid, flds FROM notes WHERE id = ?", (note_id,)
+        ).fetchone()
+        if row is None:
+            raise AnkiConnectError(f"AnkiConnect error: note was not found: {note_id}")
+        mid, flds = row
+        notetype = self.notetypes[mid]
+        values = flds.split(FIELD_SEPARATOR)
+        old_values = list(values)
+        for name, value in note["fields"].items():
+            ord_ = notetype.field_ords.get(name)
+            if ord_ is not None and ord_ < len(values):
+                values[ord_] = value
+
+        new_flds = FIELD_SEPARATOR.join(values)
+        if new_flds != flds:
+            sort_index = notetype.sort_index if notetype.sort_index < len(values) else 0
+            self.conn.execute(
+                "UPDATE notes SET flds = ?, sfld = ?, csum = ?, mod = ?, usn = -1"
+                " WHERE id = ?",
+                (
+                    new_flds,
+                    strip_html_preserving_media(values[sort_index]),
+                    field_checksum(values[0]),
+                    int(time.time()),
+                    note_id,
+                ),
+            )
+            self.changed += 1
+            if notetype.is_cloze and cloze_numbers(values) != cloze_numbers(old_values):
+                self.cards_out_of_date.add(note_id)
+        return None, len(new_flds)
+
+    def _action_multi(self, actions: List[dict]):
+        results = []
+        payload_bytes = 0
+        for action in actions:
+            handler = getattr(self, f"_action_{action['action']}", None)
+            try:
+                if handler is None:
+                    raise AnkiConnectError(f"unsupported action {action['action']}")
+                result, size = handler(**action.get("params", {}))
+                results.append({"result": result, "error": None})
+                payload_bytes += size
+            except AnkiConnectError as e:
+                results.append({"result": None, "error": str(e)})
+        return results, payload_bytes
+
+    def _select_notes(self, note_ids: List[int]) -> Iterator[tuple]:
+        # stay below SQLite's limit on bound parameters
+        for start in range(0, len(note_ids), 900):
+            chunk = note_ids[start:start + 900]
+            placeholders = ",".join("?" * len(chunk))
+            yield from self.conn.execute(
+                f"SELECT id, mid, mod, tags, flds FROM notes WHERE id IN ({placeholders})",
+                chunk,
+            )
+
+    ###########################################################################
+    # Search subset
+    ###########################################################################
+    def _parse_query(self, query: str) -> Tuple[List[str], list]:
+        query = query.strip()
+        if query.startswith("(") and ")" in query:
+            closing = query.index(")")
+            query = query[1:closing] + " " + query[closing + 1:]
+
+        conditions: List[str] = []
+        args: list = []
+        for term in shlex.split(query):
+            key, _, value = term.partition(":")
+            key = key.lower()
+            if key == "deck" and value:
+                dids = self._matching_decks(value)
+                if not dids:
+                    conditions.append("0")
+                    continue
+                placeholders = ",".join("?" * len(dids))
+                conditions.append(
+                    "id IN (SELECT nid FROM cards WHERE did IN "
+                    f"({placeholders}) OR odid IN ({placeholders}))"
+                )
+                args.extend(dids + dids)
+            elif key == "edited" and value.isdigit():
+                conditions.append("mod > ?")
+                args.append(self.next_day_at(time.time()) - int(value) * SECONDS_PER_DAY)
+            elif key == "nid" and value:
+                note_ids = [int(n) for n in value.split(",")]
+                conditions.append(f"id IN ({','.join('?' * len(note_ids))})")
+                args.extend(note_ids)
+            elif key == "note" and value:
+                mids = [
+                    mid
+                    for mid, notetype in self.notetypes.items()
+                    if fnmatch.fnmatchcase(notetype.name.lower(), value.lower())
+                ]
+                conditions.append(f"mid IN ({','.join('?' * len(mids))})" if mids else "0")
+                args.extend(mids)
+            else:
+                raise AnkiConnectError(
+                    f"AnkiConnect error: search term not supported offline: {term}"
+                )
+        return conditions, args
+
+    def _matching_decks(self, pattern: str) -> List[int]:
+        """deck:pattern matches the deck, its subdecks and * wildcards."""
+        pattern = pattern.lower()
+        return [
+            did
+            for did, name in self.decks.items()
+            if fnmatch.fnmatchcase(name.lower(), pattern)
+            or fnmatch.fnmatchcase(name.lower(), pattern + "::*")
+        ]
+
+
+def _unicase(a: str, b: str) -> int:
+    a, b = a.lower(), b.lower()
+    return (a > b) - (a < b)
+
+
+@contextlib.contextmanager
+def collection_backend(path: Optional[str]):
+    """
+    With a path, run the block against that collection.anki2 and commit
+    everything it wrote in one transaction at the end.  With None the block
+    uses AnkiConnect as usual.
+    """
+    if path is None:
+        yield None
+        return
+
+    try:
+        client = SqliteClient(path)
+    except FileNotFoundError as e:
+        raise SystemExit(str(e))
+    use_client(client)
+    try:
+        yield client
+    except BaseException:
+        client.rollback()
+        raise
+    else:
+        client.commit()
+        if client.cards_out_of_date:
+            print(
+                f"{len(client.cards_out_of_date)} changed Cloze notes now have other "
+                "cloze numbers, but their cards were not added or removed offline. "
+                "Open the collection in Anki and run Tools > Check Database, then "
+                "Tools > Empty Cards."
+            )
+    finally:
+        use_client(None)
+
+
+def add_collection_argument(parser):
+    parser.add_argument(
+        "--collection",
+        default=None,
+        help="Edit this collection.anki2 directly instead of using AnkiConnect "
+        "(close Anki and back the file up first; all changes are committed "
+        "in one transaction at the end)",
+    )
@@ -1,27 +1,23 @@
 #!/usr/bin/env python3
-import requests
 import re
 import os
-from tqdm import tqdm
 import argparse
 
+try:
+    from .anki_connect import BATCH_SIZE, fetch_batches, invoke, print_stats
+    from .cloze_parser import parse_field, strip_to_base_cloze, trailing_hint_start
+    from .sqlite_backend import add_collection_argument, collection_backend
+except ImportError:  # run as a standalone script
+    from anki_connect import BATCH_SIZE, fetch_batches, invoke, print_stats
+    from cloze_parser import parse_field, strip_to_base_cloze, trailing_hint_start
+    from sqlite_backend import add_collection_argument, collection_backend
+
 ###############################################################################
 # Configuration
 ###############################################################################
-ANKI_CONNECT_URL = "http://localhost:8765"
 CLOZE_RE = r"\{\{c\d+::[\s\S]*?\}\}"
 MAX_BASE_INDEX = 5  # We allow c1..c5 as clozes; if base index is >5, remove markup.
 
-def invoke(action, **params):
-    """
-    Helper function to send a JSON request to AnkiConnect.
-    """
-    payload = {"action": action, "version": 6, "params": params}
-    response = requests.post(ANKI_CONNECT_URL, json=payload).json()
-    if response.get("error"):
-        raise Exception(f"AnkiConnect error: {response['error']}")
-    return response["result"]
-
 def should_skip_field(field_name: str) -> bool:
     """
     Return True if we should not process this field (i.e. if its name is "Occlusion").
@@ -34,10 +30,6 @@ def find_clozes_in_text(text: str):
     """
     return re.findall(CLOZE_RE, text)
 
-TOKEN_REGEX = re.compile(r'(\{\{c(\d+)::|\}\})')
-MAX_BASE_INDEX = 5
-TOKEN_PATTERN = re.compile(r"(\{\{c(\d+)::|\}\})", flags=re.DOTALL)
-
 def remove_all_trailing_hints(s: str) -> str:
     """
     Remove *all* trailing '::someHint' segments from the end of s,
@@ -48,12 +40,7 @@ def remove_all_trailing_hints(s: str) -> str:
       "some text::h1:extra" -> (unchanged, because 'h1:extra' has a colon)
       "some text" -> unchanged
     """
-    while True:
-        new_s = re.sub(r'::[^:\}]+$', '', s)
-        if new_s == s:
-            break
-        s = new_s
-    return s
+    return s[: trailing_hint_start(s, 0, len(s))]
 
 def strip_nested_baseindex_hint(field_text: str) -> str:
     """
@@ -73,107 +60,42 @@ def strip_nested_baseindex_hint(field_text: str) -> str:
       - {{c7::{{c2::nested::hint2::extra}}::outerHint}} => base=2 => => {{c2::nested::hint2::extra}}
         (outerHint is removed)
     """
+    return strip_to_base_cloze(parse_field(field_text), MAX_BASE_INDEX)
+
+
+def main(
+    deck_name: str, query: str = None, batch_size: int = BATCH_SIZE, workers: int = 1
+):
+    from tqdm import tqdm
+
+    # maintenance_pipeline imports this module for its "strip" stage
+    try:
+        from .maintenance_pipeline import transformed_batches
+    except ImportError:  # run as a standalone script
+        from maintenance_pipeline import transformed_batches
 
-    result = []
-    last_pos = 0
-
-    # Stack of (base_idx, is_written)
-    #  - base_idx = the min index so far in this snippet chain
-    #  - is_written = True => physically write this snippet's markup
-    stack = []
-
-    for match in TOKEN_PATTERN.finditer(field_text):
-        start = match.start()
-        end = match.end()
-        token = match.group(0)       # e.g. "{{c7::" or "}}"
-        idx_str = match.group(2)     # e.g. "7" if opener, else None
-
-        # Copy literal text from [last_pos..start)
-        result.append(field_text[last_pos:start])
-
-        if token.startswith("{{c"):
-            # It's an opener: {{cX::
-            x = int(idx_str)
-            if not stack:
-                # No parent snippet => base = x
-                base = x
-            else:
-                parent_base, _ = stack[-1]
-                base = min(parent_base, x)
-
-            # If base <= 9, we only physically write markup if x == base
-            if base <= MAX_BASE_INDEX and x == base:
-                stack.append((base, True))
-                # Actually write the opener
-                result.append(f"{{{{c{base}::")
-            else:
-                stack.append((base, False))
-
-        else:
-            # It's a closer "}}"
-            if stack:
-                base_idx, is_written = stack.pop()
-
-                if is_written and base_idx <= MAX_BASE_INDEX:
-                    # physically write the closer
-                    result.append("}}")
-                else:
-                    # remove all trailing hints from the last piece of text
-                    if result:
-                        result[-1] = remove_all_trailing_hints(result[-1])
-            else:
-                # Stray closer => keep literal
-                result.append(token)
-
-        last_pos = end
-
-    # leftover text
-    result.append(field_text[last_pos:])
-
-    return "".join(result)
-
-
-def main(deck_name: str):
-    note_ids = invoke("findNotes", query=f"deck:{deck_name}")
+    note_ids = invoke("findNotes", query=query or f"deck:{deck_name}")
     print(f"Found {len(note_ids)} notes.\n")
     if not note_ids:
         return
 
-    batch_size = 50
+    # batch_size is the initial size, adapted by fetch_batches
     preview_file = os.path.join(os.getcwd(), f"{deck_name}_stripped_preview.txt")
     with open(preview_file, "w", encoding="utf-8") as f:
         f.write("=== Stripped Clozes Preview (No Changes in Anki) ===\n\n")
 
         with tqdm(total=len(note_ids), desc="Processing", unit="note") as pbar:
-            for start_index in range(0, len(note_ids), batch_size):
-                chunk = note_ids[start_index : start_index + batch_size]
-                notes_info = invoke("notesInfo", notes=chunk)
-
-                for note_info in notes_info:
-                    note_id = note_info["noteId"]
-                    fields = note_info["fields"]
-
-                    # We'll store all before/after changes for this note
-                    changes_for_note = []
-
-                    # Convert fields to a list of {name, value}, preserving order
-                    field_entries = []
-                    for field_name in fields.keys():
-                        field_entries.append({
-                            "name": field_name,
-                            "value": fields[field_name]["value"]
-                        })
-
-                    for fd in field_entries:
-                        name = fd["name"]
-                        old_val = fd["value"]
-                        # Skip "Occlusion"
-                        if should_skip_field(name):
-                            continue
-
-                        new_val = strip_nested_baseindex_hint(old_val)
-                        if new_val != old_val:
-                            changes_for_note.append((name, old_val, new_val))
+            # The next batches are prefetched while this one is processed; with
+            # workers > 1 the stripping runs in a process pool
+            batches = fetch_batches(note_ids, batch_size)
+            for results in transformed_batches(batches, ["strip"], workers, []):
+                for note_id, old_fields, new_fields, _ in results:
+                    # Skipped fields ("Occlusion") come back unchanged
+                    changes_for_note = [
+                        (name, old_fields[name], new_val)
+                        for name, new_val in new_fields.items()
+                        if new_val != old_fields[name]
+                    ]
 
                     # If we have changes, log them
                     if changes_for_note:
@@ -189,11 +111,16 @@ def main(deck_name: str):
                     pbar.update(1)
 
     print(f"Preview complete. See '{preview_file}' for details.")
+    print_stats()
 
 if __name__ == "__main__":
     # Add argument parsing for name of the deck
     parser = argparse.ArgumentParser()
     parser.add_argument("deck_name", help="Name of the deck to process", type=str)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes used for the stripping (default: 1, in-process)")
+    add_collection_argument(parser)
     args = parser.parse_args()
     print(args.deck_name)
-    main(args.deck_name)
+    with collection_backend(args.collection):
+        main(args.deck_name, workers=args.workers)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Seeded synthetic cloze fields for scaling tests.
+
+Real decks rarely reach the worst cases of the transforms, so PROFILES
+describes fields that do:
+
+  deep_nesting      clozes nested up to 50 levels deep
+  many_indices      30 distinct cloze indices in one field
+  huge_latex        megabyte-sized LaTeX fields
+  stray_closers     '}}' inside the math, so clozes close early and stray
+                    closers are left behind
+  hints_everywhere  a hint on every nesting level, often repeating the answer
+
+Every profile is a set of generate_field parameters; `scale` multiplies the
+field size and the profile's own knob (SCALED_PARAMETER), so timing a
+transform over increasing scales shows whether it stays linear in the input.
+The same seed always gives the same fields.
+
+  python synthetic_corpus.py PROFILE [--count N] [--scale X] [--seed S]
+                             [--output corpus.txt] [--notes-info notes.json]
+
+The corpus file can be passed to benchmark.py; --notes-info writes the fields
+as a fake AnkiConnect notesInfo result.
+"""
+import argparse
+import json
+import random
+from typing import Dict, List, Optional
+
+CORPUS_TITLE = "=== Synthetic Cloze Corpus"
+DEFAULT_COUNT = 50
+DEFAULT_SEED = 0
+FIELD_NAMES = ("Text", "Back Extra")
+FIRST_NOTE_ID = 1_600_000_000_000
+
+PROFILES: Dict[str, Dict] = {
+    "deep_nesting": dict(
+        field_bytes=4_000, depth=50, indices=5, hint_probability=0.1, stray_probability=0.0
+    ),
+    "many_indices": dict(
+        field_bytes=8_000, depth=2, indices=30, hint_probability=0.1, stray_probability=0.0
+    ),
+    "huge_latex": dict(
+        field_bytes=1_000_000, depth=3, indices=10, hint_probability=0.2, stray_probability=0.05
+    ),
+    "stray_closers": dict(
+        field_bytes=16_000, depth=3, indices=8, hint_probability=0.2, stray_probability=0.5
+    ),
+    "hints_everywhere": dict(
+        field_bytes=16_000, depth=8, indices=8, hint_probability=1.0, stray_probability=0.0
+    ),
+}
+# The parameter that `scale` grows together with field_bytes
+SCALED_PARAMETER = {
+    "deep_nesting": "depth",
+    "many_indices": "indices",
+    "huge_latex": "field_bytes",
+    "stray_closers": "stray_probability",
+    "hints_everywhere": "depth",
+}
+
+WORDS = [
+    "vector", "space", "basis", "linear", "map", "kernel", "image", "eigenvalue",
+    "dimension", "subspace", "injective", "surjective", "finite", "sequence",
+    "converges", "bounded", "continuous", "<b>theorem</b>", "<i>proof</i>", "<br>",
+]
+MATH = [
+    r"\(\frac{a}{b}\)",
+    r"\(x^{2} + y^{2}\)",
+    r"\(\mathbf{v} \in V\)",
+    r"\(\sum_{i=1}^{n} a_i v_i\)",
+    r"\(T: V \to W\)",
+    r"\(\dim \operatorname{null} T\)",
+    r"\[\lim_{n \to \infty} a_n = L\]",
+]
+# Math whose braces end in '}}'
+STRAY_MATH = [
+    r"\(\frac{1}{x^{2}}\)",
+    r"\(e^{i\pi^{2}}\)",
+    r"\(\{x : f(x) \in \{0\}}\)",
+    r"\(\sqrt{\frac{a}{b}}\)",
+]
+
+
+def latex_text(rng: random.Random, stray_probability: float) -> str:
+    """A few words and formulas, some of them containing '}}'."""
+    tokens = []
+    for _ in range(rng.randint(3, 12)):
+        roll = rng.random()
+        if roll < stray_probability * 0.5:
+            tokens.append(rng.choice(STRAY_MATH))
+        elif roll < 0.3:
+            tokens.append(rng.choice(MATH))
+        else:
+            tokens.append(rng.choice(WORDS))
+    return " ".join(tokens)
+
+
+def cloze(
+    rng: random.Random,
+    labels: List[int],
+    hint_probability: float,
+    stray_probability: float,
+) -> str:
+    """One answer inside a cloze per label, outermost first, built level by level."""
+    answer = latex_text(rng, stray_probability)
+    parts = [f"{{{{c{label}::" for label in labels]
+    parts.append(answer)
+    for _ in labels:
+        if rng.random() < hint_probability:
+            # Half of the hints repeat the answer, the case remove_hint_occurrences removes
+            hint = answer if rng.random() < 0.5 else rng.choice(WORDS)
+            parts.append("::" + hint)
+        parts.append("}}")
+    return "".join(parts)
+
+
+def generate_field(
+    rng: random.Random,
+    field_bytes: int,
+    depth: int,
+    indices: int,
+    hint_probability: float,
+    stray_probability: float,
+) -> str:
+    """
+    Text and clozes until the field is at least field_bytes characters long.
+    Every index from 1 to `indices` is used before any is drawn at random.
+    """
+    unused = list(range(1, indices + 1))
+    rng.shuffle(unused)
+    parts = []
+    size = 0
+    while size < field_bytes:
+        if rng.random() < 0.5:
+            part = latex_text(rng, stray_probability)
+        else:
+            # Half of the clozes reach the full depth
+            nesting = depth if rng.random() < 0.5 else rng.randint(1, depth)
+            labels = [unused.pop() if unused else rng.randint(1, indices) for _ in range(nesting)]
+            part = cloze(rng, labels, hint_probability, stray_probability)
+        parts.append(part)
+        size += len(part) + 1
+    return " ".join(parts)
+
+
+def profile_parameters(profile: str, scale: float = 1.0) -> Dict:
+    """The generate_field parameters of profile at the given scale."""
+    parameters = dict(PROFILES[profile])
+    parameters["field_bytes"] = max(1, int(parameters["field_bytes"] * scale))
+    knob = SCALED_PARAMETER[profile]
+    if knob == "stray_probability":
+        parameters[knob] = min(1.0, parameters[knob] * scale)
+    elif knob != "field_bytes":
+        parameters[knob] = max(1, int(parameters[knob] * scale))
+    return parameters
+
+
+def generate_fields(
+    profile: str, count: int = DEFAULT_COUNT, scale: float = 1.0, seed: int = DEFAULT_SEED
+) -> List[str]:
+    rng = random.Random(f"{profile}:{seed}:{scale}")
+    parameters = profile_parameters(profile, scale)
+    return [generate_field(rng, **parameters) for _ in range(count)]
+
+
+def notes_info_payload(
+    fields: List[str], field_names=FIELD_NAMES, first_note_id: int = FIRST_NOTE_ID
+) -> List[Dict]:
+    """The fields, len(field_names) per note, shaped like an AnkiConnect notesInfo result."""
+    notes = []
+    per_note = len(field_names)
+    for offset in range(0, len(fields), per_note):
+        values = fields[offset:offset + per_note]
+        values += [""] * (per_note - len(values))
+        note_id = first_note_id + offset // per_note
+        notes.append({
+            "noteId": note_id,
+            "modelName": "Cloze",
+            "tags": ["synthetic"],
+            "fields": {
+                name: {"value": value, "order": order}
+                for order, (name, value) in enumerate(zip(field_names, values))
+            },
+            "mod": note_id // 1000,
+            "cards": [],
+        })
+    return notes
+
+
+def write_corpus(path: str, fields: List[str], header: str = ""):
+    """One JSON string per field after a title line, the format benchmark.py reads."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"{CORPUS_TITLE} {header}===\n".replace("  ", " "))
+        for field in fields:
+            f.write(json.dumps(field, ensure_ascii=False))
+            f.write("\n")
+
+
+def read_corpus(text: str) -> List[str]:
+    lines = text.split("\n")[1:]
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def main(
+    profile: str,
+    count: int = DEFAULT_COUNT,
+    scale: float = 1.0,
+    seed: int = DEFAULT_SEED,
+    output: Optional[str] = None,
+    notes_info: Optional[str] = None,
+):
+    if profile not in PROFILES:
+        raise SystemExit(f"Unknown profile {profile}; choose from {', '.join(PROFILES)}")
+    fields = generate_fields(profile, count, scale, seed)
+    size = sum(len(field.encode("utf-8")) for field in fields)
+    print(f"Generated {len(fields)} '{profile}' fields ({size / 1e6:.2f} MB).")
+
+    output = output or f"synthetic_{profile}.txt"
+    write_corpus(output, fields, f"(profile={profile}, scale={scale}, seed={seed}) ")
+    print(f"Corpus written to '{output}'.")
+
+    if notes_info:
+        with open(notes_info, "w", encoding="utf-8") as f:
+            json.dump(notes_info_payload(fields), f, ensure_ascii=False)
+        print(f"notesInfo payload written to '{notes_info}'.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate adversarial cloze fields.")
+    parser.add_argument("profile", choices=list(PROFILES))
+    parser.add_argument("--count", type=int, default=DEFAULT_COUNT,
+                        help="Number of fields (default: %(default)s)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiplies the field size and the profile's knob (default: 1)")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="Random seed (default: %(default)s)")
+    parser.add_argument("--output", default=None,
+                        help="Corpus file (default: synthetic_PROFILE.txt)")
+    parser.add_argument("--notes-info", default=None,
+                        help="Also write the fields as a notesInfo JSON payload")
+    args = parser.parse_args()
+    main(args.profile, args.count, args.scale, args.seed, args.output, args.notes_info)
@@ -0,0 +1,144 @@
+"""
+"Edited since last run" watermarks for the AnkiConnect maintenance scripts.
+
+Every run saves, per script, the time it started, the IDs of the notes it
+failed to write and the `mod` of the notes it wrote.  An incremental run then
+only looks at notes modified since the previous start:
+
+  * findNotes narrows the query with an `edited:N` window.  Anki counts N
+    days back from its next day cutoff, not N*24h back from now, so the window
+    gets one day of margin;
+  * notesModTime keeps the notes with mod >= the watermark, minus the ones
+    whose mod is still the one left by our own write;
+  * the write failures of the previous run are retried, unless the notes
+    were deleted (or no longer match the query) since.
+
+Without a watermark file (first run) the whole query is processed.
+"""
+import json
+import math
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+try:
+    from .anki_connect import AnkiConnectError, invoke
+except ImportError:  # run as a standalone script
+    from anki_connect import AnkiConnectError, invoke
+
+WATERMARK_VERSION = 1
+SECONDS_PER_DAY = 86400
+
+
+def default_watermark_path(name: str) -> str:
+    return os.path.join(os.getcwd(), f".{name}.watermark.json")
+
+
+class Watermark:
+    def __init__(self, path: str, query: str):
+        self.path = path
+        self.query = query
+        # start time of the last completed run, None before the first one
+        self.since: Optional[float] = None
+        # note_id -> mod of the notes written by the last run
+        self.own_mods: Dict[int, int] = {}
+        self.retry: List[int] = []
+        self.started_at: Optional[float] = None
+
+    @classmethod
+    def load(cls, path: str, query: str) -> "Watermark":
+        """Read the watermark at `path`; a missing file means "never ran"."""
+        watermark = cls(path, query)
+        if not os.path.exists(path):
+            return watermark
+
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != WATERMARK_VERSION:
+            raise ValueError(f"Unsupported watermark version in '{path}'")
+        if data["query"] != query:
+            raise ValueError(
+                f"Watermark '{path}' was written for query '{data['query']}', "
+                f"not '{query}'"
+            )
+
+        watermark.since = data["since"]
+        watermark.own_mods = {int(k): mod for k, mod in data["own_mods"].items()}
+        watermark.retry = data["retry"]
+        return watermark
+
+    def find_notes(self, incremental: bool, started_at: Optional[float] = None) -> List[int]:
+        """
+        findNotes for the query; with incremental=True only the notes
+        modified since the last run (plus its write failures).
+
+        A resumed run passes the start time of the interrupted run it
+        continues (Checkpoint.started_at), which becomes the next watermark.
+        """
+        now = time.time()
+        self.started_at = started_at if started_at is not None else now
+        if not incremental or self.since is None:
+            return invoke("findNotes", query=self.query)
+
+        # edited:1 only reaches back to the last day cutoff, so add a day;
+        # notesModTime below does the exact filtering.
+        days = math.ceil(max(0.0, now - self.since) / SECONDS_PER_DAY) + 1
+        candidates = invoke("findNotes", query=f"({self.query}) edited:{days}")
+        if candidates:
+            try:
+                mod_times = invoke("notesModTime", notes=candidates)
+            except AnkiConnectError:
+                # notesModTime needs a recent AnkiConnect; edited:N alone is a
+                # superset of the modified notes, so it is still correct.
+                mod_times = None
+            if mod_times is not None:
+                since = int(self.since)
+                candidates = [
+                    entry["noteId"]
+                    for entry in mod_times
+                    if entry["mod"] >= since
+                    and self.own_mods.get(entry["noteId"]) != entry["mod"]
+                ]
+
+        self.retry = self._existing(self.retry)
+        seen = set(candidates)
+        return candidates + [note_id for note_id in self.retry if note_id not in seen]
+
+    def _existing(self, note_ids: List[int]) -> List[int]:
+        """The note_ids that still exist and match the query."""
+        if not note_ids:
+            return []
+        nids = ",".join(str(note_id) for note_id in note_ids)
+        found = set(invoke("findNotes", query=f"({self.query}) nid:{nids}"))
+        return [note_id for note_id in note_ids if note_id in found]
+
+    def finish(self, written_ids: Iterable[int], failed_ids: Iterable[int]):
+        """Save the watermark of a run that went through the whole note list."""
+        written_ids = list(written_ids)
+        own_mods = {}
+        if written_ids:
+            try:
+                mod_times = invoke("notesModTime", notes=written_ids)
+            except AnkiConnectError:
+                mod_times = []  # our writes will simply be looked at again
+            own_mods = {entry["noteId"]: entry["mod"] for entry in mod_times}
+
+        self.since = self.started_at
+        self.own_mods = own_mods
+        self.retry = sorted(set(failed_ids))
+
+        data = {
+            "version": WATERMARK_VERSION,
+            "query": self.query,
+            "since": self.since,
+            "own_mods": {str(note_id): mod for note_id, mod in own_mods.items()},
+            "retry": self.retry,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+
+def open_watermark(path: Optional[str], name: str, query: str) -> Watermark:
+    return Watermark.load(path or default_watermark_path(name), query)
@@ -0,0 +1,91 @@
+"""Builds small collection.anki2 files for the offline backend tests."""
+import json
+import sqlite3
+import time
+
+from nested_clz_generator.sqlite_backend import (
+    FIELD_SEPARATOR,
+    SECONDS_PER_DAY,
+    field_checksum,
+)
+
+CRT = 1_600_000_000
+BASIC_ID = 1
+CLOZE_ID = 2
+STUDYING_DECK = 10
+ALGEBRA_DECK = 11
+OTHER_DECK = 12
+
+
+def create_collection(path):
+    """A schema 11 collection.anki2 with three Cloze notes and one Basic note."""
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE col (
+            id integer PRIMARY KEY, crt integer NOT NULL, mod integer NOT NULL,
+            scm integer NOT NULL, ver integer NOT NULL, dty integer NOT NULL,
+            usn integer NOT NULL, ls integer NOT NULL, conf text NOT NULL,
+            models text NOT NULL, decks text NOT NULL, dconf text NOT NULL,
+            tags text NOT NULL
+        );
+        CREATE TABLE notes (
+            id integer PRIMARY KEY, guid text NOT NULL, mid integer NOT NULL,
+            mod integer NOT NULL, usn integer NOT NULL, tags text NOT NULL,
+            flds text NOT NULL, sfld integer NOT NULL, csum integer NOT NULL,
+            flags integer NOT NULL, data text NOT NULL
+        );
+        CREATE TABLE cards (
+            id integer PRIMARY KEY, nid integer NOT NULL, did integer NOT NULL,
+            ord integer NOT NULL, mod integer NOT NULL, usn integer NOT NULL,
+            type integer NOT NULL, queue integer NOT NULL, due integer NOT NULL,
+            ivl integer NOT NULL, factor integer NOT NULL, reps integer NOT NULL,
+            lapses integer NOT NULL, left integer NOT NULL, odue integer NOT NULL,
+            odid integer NOT NULL, flags integer NOT NULL, data text NOT NULL
+        );
+        """
+    )
+    models = {
+        str(BASIC_ID): {
+            "name": "Basic",
+            "type": 0,
+            "sortf": 0,
+            "flds": [{"name": "Front", "ord": 0}, {"name": "Back", "ord": 1}],
+        },
+        str(CLOZE_ID): {
+            "name": "Cloze",
+            "type": 1,
+            "sortf": 0,
+            "flds": [{"name": "Text", "ord": 0}, {"name": "Back Extra", "ord": 1}],
+        },
+    }
+    decks = {
+        str(STUDYING_DECK): {"name": "0Top::Studying"},
+        str(ALGEBRA_DECK): {"name": "0Top::Studying::Algebra"},
+        str(OTHER_DECK): {"name": "Other"},
+    }
+    conf = {"schedVer": 1}
+    conn.execute(
+        "INSERT INTO col VALUES (1, ?, 0, 0, 11, 0, 0, 0, ?, ?, ?, '{}', '{}')",
+        (CRT, json.dumps(conf), json.dumps(models), json.dumps(decks)),
+    )
+
+    now = int(time.time())
+    notes = [
+        (101, CLOZE_ID, STUDYING_DECK, ["{{c1::kernel}} of a map", "extra"], now),
+        (102, CLOZE_ID, ALGEBRA_DECK, ["{{c1::basis}} {{c2::span}}", ""], now),
+        (103, BASIC_ID, OTHER_DECK, ["<b>Front</b>", "Back"], now - 30 * SECONDS_PER_DAY),
+        (104, CLOZE_ID, OTHER_DECK, ["{{c1::old}}", ""], now - 30 * SECONDS_PER_DAY),
+    ]
+    for nid, mid, did, fields, mod in notes:
+        conn.execute(
+            "INSERT INTO notes VALUES (?, ?, ?, ?, 0, ' tag ', ?, ?, ?, 0, '')",
+            (nid, f"guid{nid}", mid, mod, FIELD_SEPARATOR.join(fields), fields[0],
+             field_checksum(fields[0])),
+        )
+        conn.execute(
+            "INSERT INTO cards VALUES (?, ?, ?, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+            (nid * 10, nid, did),
+        )
+    conn.commit()
+    conn.close()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The package lives under src/ and is not installed for the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
@@ -0,0 +1,49 @@
+import threading
+import time
+
+from nested_clz_generator.anki_connect import AnkiConnectClient
+
+REQUEST_SECONDS = 0.05
+
+
+class SlowSession:
+    """Answers every post with {"result": None} after REQUEST_SECONDS."""
+
+    def post(self, url, json, timeout):
+        time.sleep(REQUEST_SECONDS)
+        return FakeResponse()
+
+
+class FakeResponse:
+    content = b'{"result": null, "error": null}'
+
+    class request:
+        body = b"{}"
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"result": None, "error": None}
+
+
+def test_latency_excludes_the_wait_for_the_gate():
+    client = AnkiConnectClient(target_latency=0.5)
+    client.session = SlowSession()
+    entered = threading.Event()
+
+    def hold_gate():
+        with client.gate:
+            entered.set()
+            time.sleep(1.0)
+
+    holder = threading.Thread(target=hold_gate)
+    holder.start()
+    entered.wait()
+    client.invoke("version")
+    holder.join()
+
+    seconds, _ = client.last_exchange()
+    assert REQUEST_SECONDS <= seconds < 0.5
+    # A request that was fast once it got through raises the limit
+    assert client.gate.limit == 2
@@ -0,0 +1,68 @@
+import itertools
+import statistics
+
+import pytest
+
+from nested_clz_generator.cloze_combinations import (
+    generate_combination_positions,
+    generate_combinations,
+    ranked_combinations,
+)
+
+
+def legacy_generate_combinations(clozes, limit):
+    """The double-sort implementation cloze_combinations replaced."""
+    combinations = []
+    for i in reversed(range(1, len(clozes) - 1)):
+        if len(combinations) + len(clozes) >= limit:
+            break
+        combination = tuple(clozes[i:])
+        if combination not in combinations:
+            combinations.append(combination)
+
+    if len(combinations) + len(clozes) < limit:
+        for i in range(2, len(clozes)):
+            choose_i = itertools.combinations(clozes, i)
+            choose_i = sorted(
+                choose_i,
+                key=lambda c: statistics.mean([clozes.index(cloze) for cloze in c]),
+            )
+            choose_i = sorted(
+                choose_i,
+                key=lambda c: statistics.variance([clozes.index(cloze) for cloze in c]),
+            )
+            for combination in choose_i:
+                if len(combinations) + len(clozes) >= limit:
+                    break
+                if combination not in combinations:
+                    combinations.append(combination)
+
+    final_comb = tuple(clozes)
+    if final_comb not in combinations and len(clozes) > 1:
+        combinations.append(final_comb)
+
+    return combinations
+
+
+@pytest.mark.parametrize("limit", [0, 1, 5, 10, 25, 100, 1000])
+@pytest.mark.parametrize("n", range(0, 11))
+def test_positions_match_legacy(n, limit):
+    positions = list(range(n))
+    assert generate_combination_positions(n, limit) == legacy_generate_combinations(
+        positions, limit
+    )
+
+
+@pytest.mark.parametrize("n", [3, 6, 9])
+def test_combinations_match_legacy_on_cloze_keys(n):
+    clozes = [f"{{{{c{i}" for i in range(1, n + 1)]
+    assert generate_combinations(clozes, 10) == legacy_generate_combinations(clozes, 10)
+
+
+@pytest.mark.parametrize("n", range(2, 11))
+def test_every_subset_size_matches_the_double_sort(n):
+    items = list(range(n))
+    for size in range(2, n):
+        expected = sorted(itertools.combinations(items, size), key=statistics.mean)
+        expected = sorted(expected, key=statistics.variance)
+        assert list(ranked_combinations(n, size)) == expected
@@ -0,0 +1,182 @@
+import hashlib
+import random
+import re
+
+import pytest
+
+from nested_clz_generator.cloze_parser import (
+    markup_free_digest,
+    parse_field,
+    remove_cloze_markup,
+    remove_high_index_markup,
+    remove_repeated_openers,
+    strip_to_base_cloze,
+)
+
+# The regex/stack implementations the tokenizer replaced
+LEGACY_TOKEN = re.compile(r"(\{\{c(\d+)::|\}\})")
+
+
+def legacy_normalize_clozes(text):
+    result, stack, last_pos = [], [], 0
+    for match in LEGACY_TOKEN.finditer(text):
+        result.append(text[last_pos:match.start()])
+        if match.group(0).startswith("{{c"):
+            stack.append(True)
+        elif stack:
+            stack.pop()
+        else:
+            result.append(match.group(0))
+        last_pos = match.end()
+    result.append(text[last_pos:])
+    return "".join(result)
+
+
+def legacy_clip(text, max_index=9):
+    result, stack, last_pos = [], [], 0
+    for match in LEGACY_TOKEN.finditer(text):
+        result.append(text[last_pos:match.start()])
+        token = match.group(0)
+        if token.startswith("{{c"):
+            keep = int(match.group(2)) <= max_index
+            stack.append(keep)
+            if keep:
+                result.append(token)
+        elif stack:
+            if stack.pop():
+                result.append(token)
+        else:
+            result.append(token)
+        last_pos = match.end()
+    result.append(text[last_pos:])
+    return "".join(result)
+
+
+def legacy_remedy(text):
+    result, stack, last_pos = [], [], 0
+    for match in LEGACY_TOKEN.finditer(text):
+        result.append(text[last_pos:match.start()])
+        token, idx = match.group(0), match.group(2)
+        if token.startswith("{{c"):
+            if stack and stack[-1][0] == idx and stack[-1][1] is False:
+                stack.append((idx, True))
+            else:
+                stack.append((idx, False))
+                result.append(token)
+        elif stack:
+            if not stack.pop()[1]:
+                result.append(token)
+        else:
+            result.append(token)
+        last_pos = match.end()
+    result.append(text[last_pos:])
+    return "".join(result)
+
+
+def legacy_remove_all_trailing_hints(s):
+    while True:
+        new_s = re.sub(r"::[^:\}]+$", "", s)
+        if new_s == s:
+            return s
+        s = new_s
+
+
+def legacy_strip(text, max_base_index=5):
+    result, stack, last_pos = [], [], 0
+    for match in LEGACY_TOKEN.finditer(text):
+        result.append(text[last_pos:match.start()])
+        token = match.group(0)
+        if token.startswith("{{c"):
+            x = int(match.group(2))
+            base = x if not stack else min(stack[-1][0], x)
+            if base <= max_base_index and x == base:
+                stack.append((base, True))
+                result.append(f"{{{{c{base}::")
+            else:
+                stack.append((base, False))
+        elif stack:
+            base, is_written = stack.pop()
+            if is_written and base <= max_base_index:
+                result.append("}}")
+            elif result:
+                result[-1] = legacy_remove_all_trailing_hints(result[-1])
+        else:
+            result.append(token)
+        last_pos = match.end()
+    result.append(text[last_pos:])
+    return "".join(result)
+
+
+FIELDS = [
+    "",
+    "no clozes at all",
+    "{{c1::simple}}",
+    "{{c1::answer::hint}} and {{c2::other::a::b}}",
+    "{{c3::outer {{c1::inner::ih}} rest::oh}}",
+    "{{c7::{{c7::{{c7::x}}}}}} {{c7::{{c8::{{c8::y}}}}}}",
+    "{{c12::{{c3::deep {{c10::deeper::h}}}}::x}}",
+    "unclosed {{c1::opener {{c2::still open",
+    "stray }} closer {{c1::x}} }} again",
+    r"{{c1::\(\frac{1}{x^{2}}\)}} math closes the cloze early",
+    r"{{c2::\(\{x : x \in S\}\)::set}} hint after math",
+    "{{c05::leading zero}} {{c5::{{c05::same?}}}}",
+    "{{c1::a::}} empty hint {{c2::b:: }} blank hint",
+    "{{c1::line\nbreak::hint\nwith newline}}",
+]
+
+
+def _random_field(rng):
+    pieces = ["{{c1::", "{{c2::", "{{c7::", "{{c12::", "}}", "::h", "::", ":", "}",
+              " x ", r"\(a^{2}\)", "\n"]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+
+
+def _all_fields():
+    rng = random.Random(0)
+    return FIELDS + [_random_field(rng) for _ in range(2000)]
+
+
+def test_transforms_match_the_legacy_implementations():
+    for field in _all_fields():
+        parsed = parse_field(field)
+        assert remove_cloze_markup(parsed) == legacy_normalize_clozes(field), field
+        assert remove_high_index_markup(parsed) == legacy_clip(field), field
+        assert remove_repeated_openers(parsed) == legacy_remedy(field), field
+        assert strip_to_base_cloze(parsed) == legacy_strip(field), field
+        # Strings are parsed on demand
+        assert strip_to_base_cloze(field) == legacy_strip(field), field
+
+
+def test_markup_free_digest_hashes_the_markup_free_text():
+    for field in _all_fields():
+        expected = hashlib.blake2b(
+            legacy_normalize_clozes(field).encode("utf-8"), digest_size=16
+        ).digest()
+        assert markup_free_digest(field) == expected, field
+
+
+def test_parse_field_tree():
+    parsed = parse_field("}} {{c3::a {{c1::b::hint}} c")
+    assert [node.index for node in parsed.roots] == [3]
+    outer, inner = parsed.nodes
+    assert inner.parent is outer and outer.children == [inner]
+    assert inner.depth == 1
+    assert parsed.text[inner.hint_start:inner.content_end] == "::hint"
+    assert not outer.closed
+    assert parsed.tokens[0][2] is None  # the stray closer
+
+
+@pytest.mark.parametrize("depth", [1, 50, 5000])
+def test_deep_nesting(depth):
+    field = "{{c2::" * depth + "x::h" + "}}" * depth
+    parsed = parse_field(field)
+    assert parsed.nodes[-1].depth == depth - 1
+    assert remove_cloze_markup(parsed) == "x::h"
+    # Only openers whose parent was kept are dropped, so they alternate
+    assert remove_repeated_openers(parsed) == legacy_remedy(field)
+    assert strip_to_base_cloze(parsed) == field
+
+    # Only the outer c1 keeps its markup; the inner clozes lose theirs and their hints
+    chain = "".join(f"{{{{c{i}::" for i in range(1, depth + 1)) + "x::h" + "}}" * depth
+    expected = "{{c1::x}}" if depth > 1 else "{{c1::x::h}}"
+    assert strip_to_base_cloze(chain) == expected == legacy_strip(chain)
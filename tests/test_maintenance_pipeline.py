@@ -0,0 +1,16 @@
+from nested_clz_generator.maintenance_pipeline import DEFAULT_STAGES, transformed_batches
+from nested_clz_generator.synthetic_corpus import generate_fields, notes_info_payload
+
+
+def _batches(notes_info, size):
+    for start in range(0, len(notes_info), size):
+        yield notes_info[start:start + size]
+
+
+def test_worker_processes_match_the_single_process_results():
+    notes_info = notes_info_payload(generate_fields("hints_everywhere", count=24, scale=0.1))
+    expected = list(transformed_batches(_batches(notes_info, 5), DEFAULT_STAGES, 1, []))
+    timings = []
+    results = list(transformed_batches(_batches(notes_info, 5), DEFAULT_STAGES, 2, timings))
+    assert results == expected
+    assert len(timings) == len(expected)
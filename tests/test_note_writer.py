@@ -0,0 +1,53 @@
+import time
+
+from nested_clz_generator.anki_connect import NoteWriter
+from nested_clz_generator.change_log import ChangeLog, read_change_log
+
+
+class RejectingClient:
+    """Answers `multi` like AnkiConnect, rejecting the updates of `rejected` notes."""
+
+    def __init__(self, rejected):
+        self.rejected = set(rejected)
+
+    def invoke(self, action, actions):
+        assert action == "multi"
+        results = []
+        for update in actions:
+            note_id = update["params"]["note"]["id"]
+            error = f"note was not found: {note_id}" if note_id in self.rejected else None
+            results.append({"result": None, "error": error})
+        return results
+
+
+def test_failures_reach_the_change_log_before_close(tmp_path):
+    path = str(tmp_path / "changes.jsonl")
+    writer = NoteWriter(RejectingClient({2}), queue_depth=2)
+    with ChangeLog(path, "clip") as change_log:
+        writer.stream_failures(change_log.write_failure)
+        for note_id in (1, 2, 3):
+            writer.update_fields(note_id, {"Text": "x"})
+        writer.flush()
+        # The failure is logged by the writer thread, before close() is called
+        deadline = time.monotonic() + 5
+        while not change_log.failures and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert change_log.failures == 1
+        writer.close()
+
+    records = list(read_change_log(path))
+    assert [(r["type"], r["note_id"], r["stage"]) for r in records] == [
+        ("failure", 2, "write")
+    ]
+    assert writer.failures == [(2, "note was not found: 2")]
+    assert writer.written_ids == [1, 3]
+
+
+def test_stream_failures_replays_earlier_failures(tmp_path):
+    writer = NoteWriter(RejectingClient({7}))
+    writer.update_fields(7, {"Text": "x"})
+    assert writer.flush() == [(7, "note was not found: 7")]
+
+    reported = []
+    writer.stream_failures(lambda note_id, error: reported.append(note_id))
+    assert reported == [7]
@@ -0,0 +1,134 @@
+import random
+import re
+import sys
+
+import pytest
+
+from nested_clz_generator.remove_redundant_hints import remove_hint_occurrences
+from nested_clz_generator.synthetic_corpus import generate_fields
+
+# The recursive implementation the scanner replaced
+LEGACY_INNERMOST = re.compile(r"\{\{c\d+::([^{}:]+)(?:::[^{}]+)?\}\}")
+
+
+def legacy_process_text(text, i=0):
+    result = []
+    while i < len(text):
+        if text.startswith("{{c", i):
+            processed, i = legacy_process_cloze(text, i)
+            result.append(processed)
+        else:
+            result.append(text[i])
+            i += 1
+    return "".join(result)
+
+
+def legacy_process_cloze(text, i):
+    start = i
+    i += 3
+    num_start = i
+    while i < len(text) and text[i].isdigit():
+        i += 1
+    cloze_num = text[num_start:i]
+    if not text.startswith("::", i):
+        return text[start:], len(text)
+    i += 2
+
+    question_parts = []
+    while i < len(text):
+        if text.startswith("}}", i):
+            return "{{c" + cloze_num + "::" + "".join(question_parts) + "}}", i + 2
+        if text.startswith("::", i):
+            i += 2
+            hint_parts = []
+            while i < len(text):
+                if text.startswith("}}", i):
+                    break
+                if text.startswith("{{c", i):
+                    nested, i = legacy_process_cloze(text, i)
+                    hint_parts.append(nested)
+                else:
+                    hint_parts.append(text[i])
+                    i += 1
+            hint_text = "".join(hint_parts).strip()
+            question = "".join(question_parts)
+            inner_questions = {
+                match.group(1).strip() for match in LEGACY_INNERMOST.finditer(question)
+            }
+            if not inner_questions:
+                inner_questions = {question.strip()}
+            final_hint = "" if hint_text in inner_questions else "::" + "".join(hint_parts)
+            if text.startswith("}}", i):
+                i += 2
+            return "{{c" + cloze_num + "::" + question + final_hint + "}}", i
+        if text.startswith("{{c", i):
+            nested, i = legacy_process_cloze(text, i)
+            question_parts.append(nested)
+        else:
+            question_parts.append(text[i])
+            i += 1
+    return text[start:], i
+
+
+FIELDS = [
+    "plain text, no clozes",
+    "{{c1::answer::answer}}",
+    "{{c1::answer:: answer }}",
+    "{{c1::answer::other hint}}",
+    "{{c1::answer}} and {{c2::more::more}}",
+    # Nested hints: the outer hint repeats an innermost question
+    "{{c1::{{c2::inner}} text::inner}}",
+    "{{c1::{{c2::inner::inner}} and {{c3::other}}::other}}",
+    "{{c1::{{c2::{{c3::deep::deep}}::deep}}::deep}}",
+    "{{c1::{{c2::a::hint}}::{{c3::a}}}}",
+    "{{c1::{{c2::a}}::{{c2::a}}}}",
+    "{{c2::{{c1::x}}::{{c1::x::x}}}}",
+    # '::' and '}}' inside LaTeX
+    r"{{c1::\(a::b\)::\(a::b\)}}",
+    r"{{c1::\(x \in A\)::b::\(x \in A\)}}",
+    r"{{c1::\frac{1}{x^{2}}::\frac{1}{x^{2}}}}",
+    r"{{c1::\(\{x : f(x)\}\)::set}} {{c2::\(e^{i\pi}\)}}",
+    r"\(\mathbb{R}::\mathbb{C}\) {{c1::\(\mathbb{R}\)::\(\mathbb{R}\)}}",
+    # Malformed and unterminated clozes
+    "{{c1::open but never closed::open but never closed",
+    "{{c1::{{c2::inner}}::inner",
+    "{{c::no index::no index}}",
+    "{{cx::bad}} {{c1::a::a}}",
+    "}} stray {{c1::a::a}} }}",
+    "{{c1::a::}}",
+    "{{c1::::}}",
+]
+
+
+def _random_field(rng):
+    pieces = ["{{c1::", "{{c2::", "{{c12::", "::", "}}", "}", "{", ":", "a", "b", " ", r"\(x\)"]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+
+
+def test_matches_the_legacy_implementation():
+    rng = random.Random(0)
+    fields = FIELDS + [_random_field(rng) for _ in range(2000)]
+    for field in fields:
+        assert remove_hint_occurrences(field) == legacy_process_text(field), field
+
+
+@pytest.mark.parametrize("profile", ["hints_everywhere", "stray_closers"])
+def test_matches_the_legacy_implementation_on_synthetic_fields(profile):
+    for field in generate_fields(profile, count=20, scale=0.25):
+        assert remove_hint_occurrences(field) == legacy_process_text(field)
+
+
+def test_deep_nesting_matches_the_legacy_implementation():
+    # Shallow enough for the recursive version
+    depth = 100
+    field = "".join(f"{{{{c{k}::" for k in range(1, depth + 1)) + "x"
+    field += "::x}}" * depth
+    assert remove_hint_occurrences(field) == legacy_process_text(field)
+
+
+@pytest.mark.parametrize("depth", [1000, 5000])
+def test_deep_nesting_does_not_recurse(depth):
+    assert depth > sys.getrecursionlimit() // 2
+    field = "{{c1::" * depth + "x" + "::x}}" * depth
+    # Every hint repeats the innermost question, so all of them go
+    assert remove_hint_occurrences(field) == "{{c1::" * depth + "x" + "}}" * depth
@@ -0,0 +1,187 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+from anki_collection import CRT, create_collection
+from nested_clz_generator import anki_connect
+from nested_clz_generator.sqlite_backend import (
+    FIELD_SEPARATOR,
+    SECONDS_PER_DAY,
+    SqliteClient,
+    collection_backend,
+    field_checksum,
+)
+
+
+@pytest.fixture
+def collection(tmp_path):
+    path = str(tmp_path / "collection.anki2")
+    create_collection(path)
+    return path
+
+
+@pytest.fixture
+def client(collection):
+    client = SqliteClient(collection)
+    yield client
+    client.close()
+
+
+def _note_row(path, note_id):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(
+            "SELECT flds, sfld, csum, mod, usn FROM notes WHERE id = ?", (note_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def test_find_notes_by_deck_includes_subdecks(client):
+    assert client.invoke("findNotes", query="deck:0Top::Studying") == [101, 102]
+    assert client.invoke("findNotes", query="deck:0Top*") == [101, 102]
+    assert client.invoke("findNotes", query="deck:Missing") == []
+
+
+def test_find_notes_other_terms(client):
+    assert client.invoke("findNotes", query="note:Basic") == [103]
+    assert client.invoke("findNotes", query="nid:101,104") == [101, 104]
+    assert client.invoke("findNotes", query="(deck:*) edited:2") == [101, 102]
+    with pytest.raises(anki_connect.AnkiConnectError):
+        client.invoke("findNotes", query="tag:tag")
+
+
+def test_edited_counts_from_the_day_cutoff(client):
+    now = time.time()
+    cutoff = client.next_day_at(now)
+    # schedVer 1: days are counted from the collection's creation time
+    assert (cutoff - CRT) % SECONDS_PER_DAY == 0
+    assert now < cutoff <= now + SECONDS_PER_DAY
+
+    day_start = cutoff - SECONDS_PER_DAY
+    client.conn.execute("UPDATE notes SET mod = ? WHERE id = 103", (day_start + 10,))
+    client.conn.execute("UPDATE notes SET mod = ? WHERE id = 104", (day_start - 10,))
+    assert client.invoke("findNotes", query="nid:103,104 edited:1") == [103]
+    assert client.invoke("findNotes", query="nid:103,104 edited:2") == [103, 104]
+
+
+def test_notes_info(client):
+    info = client.invoke("notesInfo", notes=[102, 999])
+    assert info[1] == {}
+    assert info[0]["noteId"] == 102
+    assert info[0]["modelName"] == "Cloze"
+    assert info[0]["tags"] == ["tag"]
+    assert info[0]["fields"] == {
+        "Text": {"value": "{{c1::basis}} {{c2::span}}", "order": 0},
+        "Back Extra": {"value": "", "order": 1},
+    }
+
+
+def test_update_note_fields_sets_sort_field_checksum_mod_and_usn(client, collection):
+    before = time.time()
+    client.invoke(
+        "updateNoteFields", note={"id": 103, "fields": {"Front": "<i>New</i> front"}}
+    )
+    client.commit()
+
+    flds, sfld, csum, mod, usn = _note_row(collection, 103)
+    assert flds == FIELD_SEPARATOR.join(["<i>New</i> front", "Back"])
+    assert sfld == "New front"
+    assert csum == field_checksum("<i>New</i> front")
+    assert mod >= int(before)
+    assert usn == -1
+    assert client.changed == 1
+
+
+def test_update_note_fields_unknown_note(client):
+    with pytest.raises(anki_connect.AnkiConnectError):
+        client.invoke("updateNoteFields", note={"id": 999, "fields": {"Text": "x"}})
+
+
+def test_unchanged_update_is_not_written(client, collection):
+    row = _note_row(collection, 101)
+    client.invoke(
+        "updateNoteFields", note={"id": 101, "fields": {"Text": "{{c1::kernel}} of a map"}}
+    )
+    client.commit()
+    assert _note_row(collection, 101) == row
+    assert client.changed == 0
+
+
+def test_multi_reports_errors_per_action(client):
+    results = client.invoke(
+        "multi",
+        actions=[
+            {"action": "updateNoteFields",
+             "params": {"note": {"id": 101, "fields": {"Back Extra": "new"}}}},
+            {"action": "updateNoteFields",
+             "params": {"note": {"id": 999, "fields": {"Text": "x"}}}},
+            {"action": "deleteNotes", "params": {"notes": [101]}},
+            {"action": "notesModTime", "params": {"notes": [101]}},
+        ],
+    )
+    assert results[0] == {"result": None, "error": None}
+    assert results[1]["error"] is not None
+    assert results[2]["error"] is not None
+    assert results[3]["error"] is None
+    assert results[3]["result"][0]["noteId"] == 101
+    assert client.changed == 1
+
+
+def test_changed_cloze_numbers_are_reported(client):
+    client.invoke(
+        "updateNoteFields",
+        note={"id": 101, "fields": {"Text": "{{c1::kernel}} of a {{c2::map}}"}},
+    )
+    client.invoke("updateNoteFields", note={"id": 102, "fields": {"Back Extra": "x"}})
+    client.invoke("updateNoteFields", note={"id": 103, "fields": {"Back": "{{c1::x}}"}})
+    assert client.cards_out_of_date == {101}
+
+
+def test_collection_backend_commits_on_success(collection):
+    with collection_backend(collection):
+        anki_connect.invoke(
+            "updateNoteFields", note={"id": 104, "fields": {"Text": "{{c1::new}}"}}
+        )
+    assert _note_row(collection, 104)[0].startswith("{{c1::new}}")
+
+
+def test_collection_backend_rolls_back_on_error(collection):
+    row = _note_row(collection, 104)
+    with pytest.raises(RuntimeError):
+        with collection_backend(collection):
+            anki_connect.invoke(
+                "updateNoteFields", note={"id": 104, "fields": {"Text": "{{c1::new}}"}}
+            )
+            raise RuntimeError("interrupted")
+    assert _note_row(collection, 104) == row
+
+
+def test_edited_uses_the_rollover_hour_with_newer_schedulers(client):
+    client.conn.execute("UPDATE col SET conf = ?", (json.dumps({"schedVer": 2, "rollover": 7}),))
+    now = time.time()
+    cutoff = client.next_day_at(now)
+    assert time.localtime(cutoff).tm_hour == 7
+    assert now < cutoff <= now + SECONDS_PER_DAY
+
+
+def test_missing_collection_is_not_created(tmp_path):
+    path = tmp_path / "colection.anki2"
+    with pytest.raises(FileNotFoundError):
+        SqliteClient(str(path))
+    with pytest.raises(SystemExit, match="does not exist"):
+        with collection_backend(str(path)):
+            pass
+    assert not path.exists()
+
+
+def test_collection_path_with_uri_characters(tmp_path):
+    path = str(tmp_path / "my #1 deck?.anki2")
+    create_collection(path)
+    client = SqliteClient(path)
+    try:
+        assert client.invoke("findNotes", query="nid:101") == [101]
+    finally:
+        client.close()
@@ -0,0 +1,71 @@
+import json
+import time
+
+import pytest
+
+from anki_collection import create_collection
+from nested_clz_generator import anki_connect, maintenance_pipeline
+from nested_clz_generator.sqlite_backend import SqliteClient, collection_backend
+from nested_clz_generator.watermark import Watermark
+
+QUERY = "deck:*"
+DELETED_NOTE = 999
+
+
+@pytest.fixture
+def collection(tmp_path):
+    path = str(tmp_path / "collection.anki2")
+    create_collection(path)
+    return path
+
+
+def _watermark(path, retry):
+    """A watermark left by a run an hour ago whose writes of `retry` failed."""
+    watermark = Watermark(str(path), QUERY)
+    watermark.started_at = time.time() - 3600
+    with collection_backend(None):
+        watermark.finish([], retry)
+    return watermark
+
+
+def test_deleted_retry_notes_are_dropped(collection, tmp_path):
+    watermark = _watermark(tmp_path / "watermark.json", [101, DELETED_NOTE])
+    with collection_backend(collection):
+        note_ids = Watermark.load(watermark.path, QUERY).find_notes(True)
+    assert DELETED_NOTE not in note_ids
+    assert 101 in note_ids
+
+
+def test_retry_list_forgets_deleted_notes(collection, tmp_path):
+    watermark = _watermark(tmp_path / "watermark.json", [DELETED_NOTE])
+    loaded = Watermark.load(watermark.path, QUERY)
+    with collection_backend(collection):
+        loaded.find_notes(True)
+    assert loaded.retry == []
+
+
+def test_fetch_batches_skips_deleted_notes(collection):
+    client = SqliteClient(collection)
+    try:
+        batches = list(
+            anki_connect.fetch_batches([101, DELETED_NOTE, 102], 10, client=client)
+        )
+    finally:
+        client.close()
+    assert [info["noteId"] for batch in batches for info in batch] == [101, 102]
+
+
+def test_incremental_run_survives_a_deleted_retry_note(collection, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    watermark = _watermark(tmp_path / "watermark.json", [DELETED_NOTE])
+    with collection_backend(collection):
+        maintenance_pipeline.main(
+            QUERY,
+            ["clip"],
+            incremental=True,
+            watermark_path=watermark.path,
+            checkpoint_path=str(tmp_path / "checkpoint.json"),
+            change_log_path=str(tmp_path / "changes.jsonl"),
+        )
+    with open(watermark.path, encoding="utf-8") as f:
+        assert json.load(f)["retry"] == []